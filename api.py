@@ -0,0 +1,266 @@
+from flask import Blueprint, Response, current_app, jsonify, request, session, stream_with_context
+from werkzeug.datastructures import MultiDict
+from werkzeug.utils import secure_filename
+from werkzeug.exceptions import HTTPException, BadRequest, Unauthorized, Forbidden, NotFound
+from sqlalchemy import insert, update, delete
+from models import db, Feedback
+from forms import FeedbackForm
+from usercache import user_cache
+from search import feedback_search
+from dbpool import statement_timeout
+from replicas import replica_reads
+import csv
+import io
+import json
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+# the specific classes are listed because the app's own 401/404 pages would otherwise win over a catch-all
+@api.errorhandler(HTTPException)
+@api.errorhandler(Unauthorized)
+@api.errorhandler(NotFound)
+def json_error(error):
+    """API errors are JSON, not the HTML error pages"""
+    if error.response is not None:
+        return error.response
+    return jsonify({'error': error.name, 'message': error.description}), error.code
+
+
+def serialize(feedback):
+    return {'id': feedback.id, 'title': feedback.title, 'content': feedback.content, 'username': feedback.username}
+
+
+def require_login():
+    """return the logged in username or raise Unauthorized"""
+    if "username" not in session:
+        raise Unauthorized('You must be logged in.')
+    return session['username']
+
+
+def require_owner(username):
+    """raise unless the logged in user is username or an admin"""
+    if require_login() != username and session.get('admin') != True:
+        raise Forbidden('You do not have permissions for this user.')
+
+
+def require_admin():
+    """raise unless the logged in user is an admin"""
+    require_login()
+    if session.get('admin') != True:
+        raise Forbidden('Only admins can do that.')
+
+
+def json_list(key, single=False):
+    """read the list under key from a JSON body; with single, a bare object counts as a list of one.
+    Writes must be JSON, which a cross-site HTML form can't send"""
+    if not request.is_json:
+        raise BadRequest('Expected a JSON body.')
+    body = request.get_json()
+    items = body.get(key) if isinstance(body, dict) and key in body else body
+    if single and isinstance(items, dict):
+        items = [items]
+    if not isinstance(items, list) or not items:
+        raise BadRequest(f'Expected a non-empty "{key}" list.')
+    if len(items) > current_app.config['API_BATCH_LIMIT']:
+        raise BadRequest(f'At most {current_app.config["API_BATCH_LIMIT"]} items per request.')
+    return items
+
+
+def validate(items, partial=False):
+    """check each item against FeedbackForm's rules; returns the cleaned items or raises with per-item errors"""
+    cleaned = []
+    errors = {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors[index] = {'item': ['Expected an object.']}
+            continue
+        fields = {key: item[key] for key in ('title', 'content') if key in item}
+        item_errors = {key: ['Must be a string.'] for key, value in fields.items() if not isinstance(value, str)}
+        if not item_errors:
+            form = FeedbackForm(formdata=MultiDict(fields), meta={'csrf': False})
+            form.validate()
+            item_errors = {name: messages for name, messages in form.errors.items() if not partial or name in fields}
+        if item_errors:
+            errors[index] = item_errors
+        cleaned.append(fields)
+    if errors:
+        response = jsonify({'error': 'Bad Request', 'errors': errors})
+        response.status_code = 400
+        raise BadRequest(response=response)
+    return cleaned
+
+
+def load_owned(ids):
+    """load feedback rows by id in one query and check the caller may change every one of them.
+    Someone else's row is reported missing, so ids can't be probed. Returns {id: feedback} in the order the ids were given"""
+    username = require_login()
+    if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        raise BadRequest('Feedback ids must be integers.')
+    if len(set(ids)) != len(ids):
+        raise BadRequest('Feedback ids must not repeat.')
+    rows = db.session.execute(db.select(Feedback).where(Feedback.id.in_(ids))).scalars().all()
+    by_id = {row.id: row for row in rows if row.username == username or session.get('admin') == True}
+    missing = [i for i in ids if i not in by_id]
+    if missing:
+        raise NotFound(f'No feedback with ids {missing}.')
+    return {i: by_id[i] for i in ids}
+
+
+@api.route('/users/<username>/feedback')
+@replica_reads
+def list_feedback(username):
+    """one page of a user's feedback, with an ETag so unchanged pages come back as 304"""
+    require_login()
+    user = user_cache.get_or_404(username)
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    limit = request.args.get('limit', current_app.config['FEEDBACK_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, current_app.config['API_BATCH_LIMIT']))
+    feedbacks, prev_cursor, next_cursor = Feedback.page_for_user(user.username, after=after, before=before, per_page=limit)
+    response = jsonify({'items': [serialize(f) for f in feedbacks], 'prev': prev_cursor, 'next': next_cursor})
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+EXPORT_COLUMNS = ('id', 'username', 'title', 'content')
+
+
+def ndjson_chunks(batches):
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n' for row in rows)
+
+
+def csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.getvalue():
+        # only the header, when there were no rows
+        yield buffer.getvalue()
+
+
+def export(username, filename):
+    """stream feedback as NDJSON (the default) or CSV with ?format=csv, one batch of rows at a time"""
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        raise BadRequest('format must be ndjson or csv.')
+    batches = Feedback.stream_rows(username, batch_size=current_app.config['EXPORT_BATCH_SIZE'])
+    if fmt == 'csv':
+        chunks, mimetype = csv_chunks(batches), 'text/csv'
+    else:
+        chunks, mimetype = ndjson_chunks(batches), 'application/x-ndjson'
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{secure_filename(filename)}.{fmt}"'})
+
+
+@api.route('/users/<username>/feedback/export')
+@replica_reads
+@statement_timeout(0)
+def export_user_feedback(username):
+    """stream all of a user's feedback to the user or an admin"""
+    user = user_cache.get_or_404(username)
+    require_owner(user.username)
+    return export(user.username, f'{user.username}-feedback')
+
+
+@api.route('/feedback/export')
+@replica_reads
+@statement_timeout(0)
+def export_all_feedback():
+    """stream every user's feedback to an admin"""
+    require_admin()
+    return export(None, 'feedback')
+
+
+@api.route('/feedback/search')
+@replica_reads
+def search_feedback():
+    """ranked full-text search over every user's feedback titles and content, for admins"""
+    require_admin()
+    query = request.args.get('q', '').strip()
+    if not query:
+        raise BadRequest('Expected a search query in q.')
+    page = max(1, request.args.get('page', 1, type=int))
+    rows, more = feedback_search.search(query, page, current_app.config['FEEDBACK_PAGE_SIZE'])
+    return jsonify({'items': rows, 'page': page, 'next': page + 1 if more else None})
+
+
+@api.route('/users/<username>/feedback', methods=["POST"])
+def create_feedback(username):
+    """create one or more feedback items for a user in a single multi-row INSERT"""
+    user = user_cache.get_or_404(username)
+    require_owner(user.username)
+    items = validate(json_list('items', single=True))
+    rows = [{'title': item['title'], 'content': item['content'], 'username': user.username} for item in items]
+    created = db.session.execute(insert(Feedback).returning(Feedback.id, Feedback.title, Feedback.content, Feedback.username,
+                                                            sort_by_parameter_order=True), rows).all()
+    db.session.commit()
+    return jsonify({'items': [dict(row._mapping) for row in created]}), 201
+
+
+@api.route('/feedback/<int:feedback_id>')
+@replica_reads
+def get_feedback(feedback_id):
+    """a single feedback item"""
+    require_login()
+    feedback = db.session.get(Feedback, feedback_id)
+    if feedback is None:
+        raise NotFound()
+    return jsonify(serialize(feedback))
+
+
+@api.route('/feedback', methods=["PATCH"])
+def update_feedback_batch():
+    """update several feedback items in one transaction; each item needs an id and any of title/content"""
+    require_login()
+    items = json_list('items')
+    changes = validate(items, partial=True)
+    found = load_owned([item.get('id') for item in items])
+    rows = [{'id': feedback_id, **fields} for feedback_id, fields in zip(found, changes) if fields]
+    if rows:
+        db.session.execute(update(Feedback), rows)
+    # serialize before commit expires the rows, so the response doesn't reload them
+    updated = [{**serialize(found[feedback_id]), **fields} for feedback_id, fields in zip(found, changes)]
+    db.session.commit()
+    return jsonify({'items': updated})
+
+
+@api.route('/feedback/<int:feedback_id>', methods=["PATCH"])
+def update_feedback(feedback_id):
+    """update one feedback item"""
+    require_login()
+    items = json_list('item', single=True)
+    if len(items) != 1:
+        raise BadRequest('Expected a single object.')
+    changes = validate(items, partial=True)[0]
+    found = load_owned([feedback_id])
+    if changes:
+        db.session.execute(update(Feedback), [{'id': feedback_id, **changes}])
+    updated = {**serialize(found[feedback_id]), **changes}
+    db.session.commit()
+    return jsonify(updated)
+
+
+@api.route('/feedback', methods=["DELETE"])
+def delete_feedback_batch():
+    """delete several feedback items with one DELETE"""
+    require_login()
+    found = load_owned(json_list('ids'))
+    db.session.execute(delete(Feedback).where(Feedback.id.in_(list(found))))
+    db.session.commit()
+    return jsonify({'deleted': sorted(found)})
+
+
+@api.route('/feedback/<int:feedback_id>', methods=["DELETE"])
+def delete_feedback(feedback_id):
+    """delete one feedback item"""
+    found = load_owned([feedback_id])
+    db.session.execute(delete(Feedback).where(Feedback.id.in_(list(found))))
+    db.session.commit()
+    return jsonify({'deleted': [feedback_id]})
@@ -1,57 +1,123 @@
-from flask import Flask, render_template, redirect, session, flash, request
-from flask_debugtoolbar import DebugToolbarExtension
-from models import connect_db, db, User, Feedback
+from flask import Flask, Blueprint, current_app, render_template, redirect, session, flash, request, jsonify
+from models import connect_db, db, hasher, AuthResult, User, Feedback
+from deletion import AccountDeletions
+from sessions import init_sessions, revoke_user_sessions
+from usercache import user_cache
+from mailqueue import MailQueue
+from metrics import metrics
+from dbpool import db_pool
+from replicas import read_replicas, replica_reads
+from asyncdb import async_db
+from asyncviews import async_views
+from ratelimit import login_limiter
+from config import Config
+from api import api
+from userimport import UserImport
+from search import feedback_search
 from forms import RegisterForm, LoginForm, FeedbackForm, EmailForm, UpdatePasswordForm
 from werkzeug.exceptions import NotFound, Unauthorized
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, OperationalError, SQLAlchemyError, TimeoutError as PoolTimeout
 from flask_mail import Mail, Message
 from sqlalchemy import update
-from local_settings import MAIL_PASSWORD
-
-
-app = Flask(__name__)
-
-app.app_context().push()
-
-app.config["SQLALCHEMY_DATABASE_URI"] = "postgresql:///feedback"
-# app.config["SQLALCHEMY_DATABASE_URI"] = "postgresql:///feedback_test"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
-app.config["SECRET_KEY"] = 'requin'
-app.config["DEBUG_TB_INTERCEPT_REDIRECTS"] = False
-app.config['MAIL_SERVER'] = 'smtp.gmail.com'
-app.config['MAIL_PORT'] = 465
-app.config['MAIL_USE_SSL'] = True
-app.config['MAIL_USERNAME'] = 'theenbydeveloper@gmail.com'
-app.config['MAIL_PASSWORD'] = MAIL_PASSWORD
-
-mail = Mail(app)
-
-connect_db(app)
-db.create_all()
-
-toolbar = DebugToolbarExtension(app)
-
-@app.route('/')
+from markupsafe import escape
+import click
+import os
+from datetime import datetime, timedelta
+
+
+mail = Mail()
+mail_queue = MailQueue()
+deletions = AccountDeletions()
+
+bp = Blueprint('main', __name__, cli_group=None)
+
+
+def create_app(config=None):
+    """Build the app. config is a dict or object of settings that override the defaults in config.Config.
+    Nothing touches the database here; run 'flask create-db' to create the tables"""
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config['MAIL_PASSWORD'] = load_mail_password()
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+
+    db_pool.init_app(app)
+    read_replicas.init_app(app)
+    connect_db(app)
+    mail.init_app(app)
+    hasher.init_app(app)
+    mail_queue.init_app(app, mail)
+    deletions.init_app(app)
+    init_sessions(app)
+    user_cache.init_app(app)
+    metrics.init_app(app)
+    login_limiter.init_app(app)
+    feedback_search.init_app(app)
+    if metrics.enabled:
+        hasher.timer = metrics.timer
+        mail_queue.timer = metrics.timer
+        db_pool.timer = metrics.timer
+        metrics.add_gauge('feedback_db_pool_checked_out', 'Database connections checked out of the pool.',
+                          lambda: db_pool.stats(db.engine).get('checked_out', 0))
+    if app.debug:
+        # only pay for importing the toolbar when it can actually show up
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    app.register_blueprint(bp)
+    app.register_blueprint(api)
+    if app.config['ASYNC_MODE']:
+        async_db.init_app(app)
+        async_views.init_app(app, mail_queue)
+    return app
+
+
+def load_mail_password():
+    """read the SMTP password from local_settings.py, falling back to the environment"""
+    try:
+        from local_settings import MAIL_PASSWORD
+    except ImportError:
+        return os.environ.get('MAIL_PASSWORD')
+    return MAIL_PASSWORD
+
+
+@bp.cli.command('create-db')
+def create_db_command():
+    """creates any missing tables"""
+    db.create_all()
+    click.echo('Created tables')
+
+
+@bp.cli.command('drop-db')
+@click.confirmation_option(prompt='This deletes every table. Continue?')
+def drop_db_command():
+    """drops every table"""
+    db.drop_all()
+    click.echo('Dropped tables')
+
+@bp.route('/')
+@replica_reads
 def display_home():
     if 'username' in session:
         loggedinuser = session['username']
         return render_template('index.html', loggedinuser=loggedinuser)
     return render_template('index.html')
 
-@app.errorhandler(NotFound)
+@bp.app_errorhandler(NotFound)
 def not_found(error):
     loggedinuser = session.get('username')
     return render_template("404.html", loggedinuser=loggedinuser)
 
-@app.errorhandler(Unauthorized)
+@bp.app_errorhandler(Unauthorized)
 def not_authorized(error):
     loggedinuser = session.get('username')
     return render_template("401.html", loggedinuser=loggedinuser)
 
 #AUTHENTICATION ROUTES
 
-@app.route('/register', methods=["GET", "POST"])
+@bp.route('/register', methods=["GET", "POST"])
 def register_user():
     """displays registration form and registers new users. If user already logged in, redirects to home"""
     if "username" in session: 
@@ -74,6 +140,7 @@ def register_user():
                 new_user = User.register(username, password, email, first_name, last_name)
                 db.session.add(new_user)
                 db.session.commit()
+                user_cache.invalidate(new_user.username)
             except IntegrityError as e:
                 db.session.rollback()
                 if 'Key (username)' in str(e):
@@ -87,7 +154,7 @@ def register_user():
             return redirect(f'/user/{new_user.username}')
     return render_template('register.html', form=form)
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
 def login_user():
     """displays login form and logs in authorized users. If user already logged in, redirects to home"""
     if "username" in session: 
@@ -99,18 +166,20 @@ def login_user():
     if form.validate_on_submit():
         username = form.username.data
         password = form.password.data
-        user = User.authenticate(username, password)
-        if user: 
+        login_limiter.check(username, request.remote_addr)
+        result = User.authenticate(username, password)
+        if result: 
+            user = result.user
             session["username"] = user.username
             session["admin"] = user.is_admin
             return redirect(f'/user/{user.username}')
-        elif not db.session.execute(db.select(User).where(User.username == username)).scalar():
+        elif result.status == AuthResult.UNKNOWN_USER:
             form.username.errors = ['Invalid username'] 
         else:
             form.password.errors=['Invalid password']
     return render_template('login.html', form=form)
 
-@app.route('/logout', methods=["POST"])
+@bp.route('/logout', methods=["POST"])
 def logout_user():
     """clear data from session and redirect to home"""
     session.pop('username')
@@ -119,7 +188,7 @@ def logout_user():
     flash('Goodbye!', 'primary')
     return redirect('/')
 
-@app.route('/passwordreset', methods=["GET", "POST"])
+@bp.route('/passwordreset', methods=["GET", "POST"])
 def reset_password():
     """displays password reset request form and sends password reset email"""
     if "username" in session:
@@ -132,20 +201,106 @@ def reset_password():
         email = form.email.data
         user = db.session.execute(db.select(User).where(User.email == email)).scalar()
         if user: 
-            prt = user.get_password_reset_token()
-            stmt = update(User).where(User.email == email).values(password_reset_token=prt)
-            db.session.execute(stmt)
-            db.session.commit()
+            prt = issue_reset_token(user)
             msg = Message(subject='Password Reset Link', sender='theenbydeveloper@gmail.com', recipients=[email])
             msg.html = render_template('passwordresetemail.html', prt=prt, email=email)
-            mail.send(msg)
+            mail_queue.send(msg)
             return redirect('/login')
         else:
             form.email.errors=['Email not in database. Please register to proceed.']
 
     return render_template('reset.html', form=form)
 
-@app.route('/updatepassword', methods=["GET", "POST"])
+def issue_reset_token(user):
+    """returns a new reset token for user. In 'database' mode the token's hash is saved on the user,
+    in 'signed' mode nothing is written"""
+    config = current_app.config
+    if config['PASSWORD_RESET_MODE'] == 'signed':
+        return user.get_signed_password_reset_token(config['SECRET_KEY'])
+    prt = user.issue_password_reset_token(config['PASSWORD_RESET_TTL'])
+    db.session.commit()
+    return prt
+
+def find_reset_user(prt):
+    """returns the user a valid reset token belongs to, or None"""
+    config = current_app.config
+    if config['PASSWORD_RESET_MODE'] == 'signed':
+        return User.from_signed_password_reset_token(prt, config['SECRET_KEY'], config['PASSWORD_RESET_TTL'])
+    return User.from_password_reset_token(prt)
+
+def send_password_reset_links(emails):
+    """issues reset tokens for every registered email in one UPDATE and sends all the reset links over shared connections.
+    The email template is rendered once and filled in for each recipient. Returns the number of links sent"""
+    users = db.session.execute(db.select(User).where(User.email.in_(emails))).scalars().all()
+    if not users:
+        return 0
+    if current_app.config['PASSWORD_RESET_MODE'] == 'signed':
+        recipients = [(user.email, user.get_signed_password_reset_token(current_app.config['SECRET_KEY'])) for user in users]
+    else:
+        expires_at = datetime.utcnow() + timedelta(seconds=current_app.config['PASSWORD_RESET_TTL'])
+        tokens = {user.username: user.get_password_reset_token() for user in users}
+        recipients = [(user.email, tokens[user.username]) for user in users]
+        db.session.execute(update(User), [{'username': username, 'password_reset_token': User.hash_password_reset_token(prt),
+                                           'password_reset_expires_at': expires_at} for username, prt in tokens.items()])
+        db.session.commit()
+    html = render_template('passwordresetemail.html', prt='__PRT__', email='__EMAIL__')
+    msgs = []
+    for email, prt in recipients:
+        msg = Message(subject='Password Reset Link', sender='theenbydeveloper@gmail.com', recipients=[email])
+        msg.html = html.replace('__PRT__', str(escape(prt))).replace('__EMAIL__', str(escape(email)))
+        msgs.append(msg)
+    mail_queue.send_many(msgs)
+    return len(msgs)
+
+@bp.cli.command('purge-reset-tokens')
+def purge_reset_tokens_command():
+    """clears expired password reset tokens; run it periodically, e.g. from cron"""
+    purged = User.purge_expired_reset_tokens()
+    click.echo(f'Purged {purged} expired password reset tokens')
+
+@bp.cli.command('send-resets')
+@click.argument('email_file', type=click.File())
+def send_resets_command(email_file):
+    """sends password reset links to every email address listed (one per line) in EMAIL_FILE"""
+    emails = [line.strip() for line in email_file if line.strip()]
+    sent = send_password_reset_links(emails)
+    click.echo(f'Sent {sent} password reset links ({len(emails) - sent} addresses not registered)')
+
+@bp.cli.command('mail-worker')
+@click.option('--once', is_flag=True, help='deliver what is due and exit, e.g. from cron')
+def mail_worker_command(once):
+    """delivers queued email in the foreground; the web processes also start a delivery thread on their first request"""
+    if once:
+        click.echo(f'Attempted {mail_queue.drain()} emails')
+        return
+    try:
+        mail_queue.run()
+    except KeyboardInterrupt:
+        pass
+
+@bp.cli.group('users')
+def users_command():
+    """manages user accounts in bulk"""
+
+@users_command.command('import')
+@click.argument('user_file', type=click.File())
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='defaults to the file extension')
+@click.option('--batch-size', default=1000, show_default=True, help='rows validated, hashed and inserted together')
+@click.option('--workers', type=int, help='hashing processes; defaults to the number of CPUs')
+def import_users_command(user_file, fmt, batch_size, workers):
+    """creates accounts from USER_FILE, a CSV with a header row or JSONL, with username, password, email,
+    first_name and last_name fields. Rows that fail validation or clash with an existing account are reported and skipped"""
+    if fmt is None:
+        fmt = 'jsonl' if user_file.name.endswith(('.jsonl', '.ndjson')) else 'csv'
+    importer = UserImport(batch_size=batch_size, workers=workers)
+    imported = importer.run(user_file, fmt)
+    for number, message in sorted(importer.errors):
+        click.echo(f'line {number}: {message}', err=True)
+    click.echo(f'Imported {imported} users ({len({number for number, message in importer.errors})} rows rejected)')
+    if importer.errors:
+        raise SystemExit(1)
+
+@bp.route('/updatepassword', methods=["GET", "POST"])
 def update_password():
     """Displays password reset form and resets password"""
     if "username" in session:
@@ -153,9 +308,11 @@ def update_password():
         return redirect('/')
     
     form = UpdatePasswordForm()
-    email = request.args.get('email')
     prt = request.args.get('prt')
-    user = db.session.execute(db.select(User).where(User.email == email)).scalar()
+    user = find_reset_user(prt)
+    if not user:
+        flash('Unauthorized password reset attempt', 'danger')
+        return redirect('/')
 
     if form.validate_on_submit():
         password = form.password.data
@@ -163,28 +320,30 @@ def update_password():
         if password != password2:
             form.password2.errors=['Passwords do not match']
             return render_template('updatepassword.html', form=form)
-        stmt = user.update_password(pwd=password, email=email)
-        db.session.execute(stmt)
         try:
+            if current_app.config['PASSWORD_RESET_MODE'] == 'signed':
+                username = user.replace_password(password)
+            else:
+                username = User.consume_password_reset_token(prt, password)
             db.session.commit()
-        except: 
+        except (OperationalError, PoolTimeout):
+            # db_pool answers pool and statement timeouts with a 503
+            db.session.rollback()
+            raise
+        except SQLAlchemyError:
+            db.session.rollback()
             flash('Something went wrong. Please try again.')
             return redirect('/passwordreset')
-        stmt2 = update(User).where(User.email == email).values(password_reset_token=None)
-        db.session.execute(stmt2)
-        try:
-            db.session.commit()
-        except:
-            flash('Something went wrong. Please try again')
-            return redirect('/passwordreset')
+        if not username:
+            # the token was used by another request after we looked it up
+            flash('Unauthorized password reset attempt', 'danger')
+            return redirect('/')
+        user_cache.invalidate(user.username)
+        revoke_user_sessions(current_app, user.username)
         return redirect('/login')
-    elif user and user.password_reset_token == prt:
-        return render_template('updatepassword.html', form=form)
-    else: 
-        flash('Unauthorized password reset attempt', 'danger')
-        return redirect('/')
+    return render_template('updatepassword.html', form=form)
     
-@app.route('/getusername', methods=["GET", "POST"])
+@bp.route('/getusername', methods=["GET", "POST"])
 def get_username():
     """displays username request form and sends username via email"""
     if "username" in session:
@@ -199,7 +358,7 @@ def get_username():
         if user: 
             msg = Message(subject='Feedback App Username', sender='theenbydeveloper@gmail.com', recipients=[email])
             msg.html = render_template('usernameemail.html', username=user.username)
-            mail.send(msg)
+            mail_queue.send(msg)
             return redirect('/login')
         else:
             form.email.errors=['Email not in database. Please register to proceed.']
@@ -209,55 +368,74 @@ def get_username():
 
 #USER ROUTES
 
-@app.route('/user/<username>')
+@bp.route('/user/<username>')
+@replica_reads
 def display_user(username):
     """displays a user to authorized users"""
     if "username" not in session: 
         flash('You must be logged in to view this page', 'danger')
         raise Unauthorized()
-    user = User.query.get_or_404(username)
-    feedbacks = db.session.execute(db.select(Feedback).where(Feedback.username == user.username)).scalars()
+    user = user_cache.get_or_404(username)
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    feedbacks, prev_cursor, next_cursor = Feedback.page_for_user(user.username, after=after, before=before, per_page=current_app.config['FEEDBACK_PAGE_SIZE'])
     loggedinuser = session['username']
-    return render_template('user.html', user=user, feedbacks=feedbacks, loggedinuser=loggedinuser)
+    return render_template('user.html', user=user, feedbacks=feedbacks, prev_cursor=prev_cursor, next_cursor=next_cursor, loggedinuser=loggedinuser)
 
-@app.route('/user/<username>/delete', methods=["POST"])
+@bp.route('/user/<username>/delete', methods=["POST"])
 def delete_user(username):
     """deletes a user's account and all associated feedback"""
-    user = User.query.get_or_404(username)
+    user = user_cache.get_or_404(username)
     if "username" not in session:
         flash('You must be logged in to view this page', 'danger')
         raise Unauthorized()
     elif session['username'] == user.username or session.get('admin') == True:
-        feedbacks = db.session.execute(db.select(Feedback).where(Feedback.username == user.username)).scalars()
-        for feedback in feedbacks:
-            db.session.delete(feedback)
+        total = Feedback.count_for_user(user.username)
+        if total > deletions.threshold:
+            deletions.start(current_app._get_current_object(), user.username, total)
+            # the owner is logged out below, so the link carries its own permission
+            token = deletions.status_token(user.username, current_app.config['SECRET_KEY'])
+            message = f'Account deletion started. It may take a few minutes to finish. Progress: /user/{user.username}/delete/status?token={token}'
+        else:
             try: 
-                db.session.commit()
-            except: 
+                User.delete_account(user.username)
+            except:
+                db.session.rollback()
                 flash('Something went wrong. Please try again.')
                 return redirect(f'/user/{username}')
-        db.session.delete(user)
-        try: 
-            db.session.commit()
-        except:
-            flash('Something went wrong. Please try again.')
-            return redirect(f'/user/{username}')
+            message = 'Account deleted'
+        user_cache.invalidate(user.username)
+        revoke_user_sessions(current_app, user.username)
         if session['username'] == user.username:
             session.pop('username')
             if session.get('admin'):
                session.pop('admin')
-        flash('Account deleted', 'danger')
+        flash(message, 'danger')
         return redirect('/')
     else: 
         flash('You do not have permissions to delete this account', 'danger')
         raise Unauthorized()
 
+@bp.route('/user/<username>/delete/status')
+def delete_user_status(username):
+    """reports the progress of a background account deletion to the owner, an admin or anyone with its status token"""
+    if not deletions.check_status_token(request.args.get('token'), username, current_app.config['SECRET_KEY']):
+        if "username" not in session:
+            raise Unauthorized()
+        elif session['username'] != username and session.get('admin') != True:
+            raise Unauthorized()
+    status = deletions.status(username)
+    if status is None:
+        raise NotFound()
+    return jsonify(status)
+
 #FEEDBACK ROUTES
 
-@app.route('/user/<username>/feedback/add', methods=["GET", "POST"])
+@bp.route('/user/<username>/feedback/add', methods=["GET", "POST"])
+@replica_reads
 def add_feedback(username):
     """displays a form for adding feedback and adds feedback to the database"""
-    user = User.query.get_or_404(username)
+    user = user_cache.get_or_404(username)
     if "username" not in session:
         flash('You must be logged in to add feedback', 'danger')
         raise Unauthorized()
@@ -282,11 +460,14 @@ def add_feedback(username):
         flash('You do not have permissions to add feedback for this user', 'danger')        
         raise Unauthorized()
     
-@app.route('/feedback/<feedback_id>/update', methods=["GET", "POST"])
+@bp.route('/feedback/<feedback_id>/update', methods=["GET", "POST"])
+@replica_reads
 def update_feedback(feedback_id):
     """displays a form to update feedback and updates feedback in the database"""
-    feedback = Feedback.query.get_or_404(feedback_id)
+    feedback = Feedback.get_with_user_or_404(feedback_id)
     user = feedback.user
+    # read before commit expires it, so the redirect doesn't reload the user
+    owner = user.username
     if "username" not in session: 
         flash('You must be logged in to update feedback', 'danger')
         raise Unauthorized()
@@ -302,18 +483,20 @@ def update_feedback(feedback_id):
             except: 
                 flash('Something went wrong. Please try again.')
                 return redirect(f'/feedback/{feedback_id}/update', form=form, loggedinuser=loggedinuser)
-            return redirect(f'/user/{user.username}')
+            return redirect(f'/user/{owner}')
 
         return render_template("updatefeedback.html", form=form, loggedinuser=loggedinuser)
     else: 
         flash('You do not have permissions to update feedback for this user', 'danger')
         raise Unauthorized()
     
-@app.route('/feedback/<feedback_id>/delete', methods=["POST"])
+@bp.route('/feedback/<feedback_id>/delete', methods=["POST"])
 def delete_feedback(feedback_id):
     """deletes a piece of feedback from the database if the user is authorized"""
-    feedback = Feedback.query.get_or_404(feedback_id)
+    feedback = Feedback.get_with_user_or_404(feedback_id)
     user = feedback.user
+    # read before commit expires it, so the redirect doesn't reload the user
+    owner = user.username
     if "username" not in session: 
         flash('You must be logged in to delete feedback', 'danger')
         raise Unauthorized()
@@ -324,7 +507,7 @@ def delete_feedback(feedback_id):
         except:
             flash('Something went wrong. Please try again.')
             return redirect(f'/feedback/{feedback_id}')
-        return redirect(f'/user/{user.username}')
+        return redirect(f'/user/{owner}')
     else:
         flash('You do not have permissions to delete that feedback.')
         raise Unauthorized()
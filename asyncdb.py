@@ -0,0 +1,62 @@
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+from dbpool import db_pool
+
+# the async driver used for each backend when ASYNC_DATABASE_URI isn't set
+ASYNC_DRIVERS = {'postgresql': 'asyncpg', 'sqlite': 'aiosqlite'}
+
+
+def async_url(url):
+    """the same database with its async driver, e.g. postgresql+asyncpg for postgresql"""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f'No async driver for {backend}; set ASYNC_DATABASE_URI')
+    return url.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}')
+
+
+class AsyncDatabase:
+    """AsyncSession access to the app's database for the async views
+
+    Flask runs each async view in an event loop of its own, and an asyncpg
+    connection can't be used from any loop but the one that opened it, so the
+    engine doesn't pool: a session opens its connection when it first needs
+    it and closes it when it ends. Run PgBouncer in front (DB_PGBOUNCER) to
+    keep that cheap. The engine is created on first use, so the async drivers
+    are only imported when something asks for a session."""
+
+    def __init__(self, app=None):
+        self.url = None
+        self.connect_args = {}
+        self.engine = None
+        self.sessionmaker = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """read the async database URL from the app config"""
+        self.url = make_url(app.config.get('ASYNC_DATABASE_URI') or async_url(app.config['SQLALCHEMY_DATABASE_URI']))
+        self.connect_args = db_pool.connect_args(self.url, app.config)
+        self.dispose()
+
+    def _start(self):
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+        self.engine = create_async_engine(self.url, poolclass=NullPool, connect_args=self.connect_args)
+        self.sessionmaker = async_sessionmaker(self.engine, expire_on_commit=False)
+
+    def session(self):
+        """a new AsyncSession; use it as 'async with async_db.session() as s'"""
+        if self.sessionmaker is None:
+            self._start()
+        return self.sessionmaker()
+
+    def dispose(self):
+        """drop the engine; it is recreated on the next session"""
+        if self.engine is not None:
+            # nothing is pooled, so there are no connections for this to await
+            self.engine.sync_engine.dispose()
+        self.engine = None
+        self.sessionmaker = None
+
+
+async_db = AsyncDatabase()
@@ -0,0 +1,122 @@
+from flask import current_app, flash, jsonify, redirect, render_template, request, session
+from flask_mail import Message
+from werkzeug.exceptions import NotFound
+from models import db, AuthResult, User, Feedback
+from forms import LoginForm, EmailForm
+from asyncdb import async_db
+from ratelimit import login_limiter
+from api import serialize, require_login
+
+
+async def login_user():
+    """login_user, authenticating on an AsyncSession with bcrypt awaited on the hasher's pool"""
+    if "username" in session:
+        flash('You are already logged in.', 'danger')
+        return redirect('/')
+
+    form = LoginForm()
+
+    if form.validate_on_submit():
+        username = form.username.data
+        login_limiter.check(username, request.remote_addr)
+        async with async_db.session() as s:
+            result = await User.authenticate_async(s, username, form.password.data)
+        if result:
+            session["username"] = result.user.username
+            session["admin"] = result.user.is_admin
+            return redirect(f'/user/{result.user.username}')
+        elif result.status == AuthResult.UNKNOWN_USER:
+            form.username.errors = ['Invalid username']
+        else:
+            form.password.errors = ['Invalid password']
+    return render_template('login.html', form=form)
+
+
+async def reset_password():
+    """reset_password, issuing the token on an AsyncSession and sending the email with send_async"""
+    if "username" in session:
+        flash('You are already logged in.', 'danger')
+        return redirect('/')
+
+    form = EmailForm()
+
+    if form.validate_on_submit():
+        email = form.email.data
+        config = current_app.config
+        async with async_db.session() as s:
+            user = (await s.execute(db.select(User).where(User.email == email))).scalar()
+            if user and config['PASSWORD_RESET_MODE'] == 'signed':
+                prt = user.get_signed_password_reset_token(config['SECRET_KEY'])
+            elif user:
+                prt = user.issue_password_reset_token(config['PASSWORD_RESET_TTL'])
+                await s.commit()
+        if user:
+            msg = Message(subject='Password Reset Link', sender='theenbydeveloper@gmail.com', recipients=[email])
+            msg.html = render_template('passwordresetemail.html', prt=prt, email=email)
+            await async_views.mail_queue.send_async(msg)
+            return redirect('/login')
+        else:
+            form.email.errors = ['Email not in database. Please register to proceed.']
+
+    return render_template('reset.html', form=form)
+
+
+async def list_feedback(username):
+    """the API's list_feedback on an AsyncSession"""
+    require_login()
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    limit = request.args.get('limit', current_app.config['FEEDBACK_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, current_app.config['API_BATCH_LIMIT']))
+    async with async_db.session() as s:
+        if await s.get(User, username) is None:
+            raise NotFound()
+        feedbacks, prev_cursor, next_cursor = await Feedback.page_for_user_async(s, username, after=after, before=before, per_page=limit)
+    response = jsonify({'items': [serialize(f) for f in feedbacks], 'prev': prev_cursor, 'next': next_cursor})
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+async def get_feedback(feedback_id):
+    """the API's get_feedback on an AsyncSession"""
+    require_login()
+    async with async_db.session() as s:
+        feedback = await s.get(Feedback, feedback_id)
+    if feedback is None:
+        raise NotFound()
+    return jsonify(serialize(feedback))
+
+
+# endpoint: the async view that replaces it in async mode
+ASYNC_VIEWS = {
+    'main.login_user': login_user,
+    'main.reset_password': reset_password,
+    'api.list_feedback': list_feedback,
+    'api.get_feedback': get_feedback,
+}
+
+
+class AsyncViews:
+    """Async mode: swaps async versions in for the views that spend their time waiting
+
+    The swapped views keep their endpoints, URLs and blueprint error handlers.
+    They query through AsyncSession, await bcrypt on the hasher's pool and
+    send mail with aiosmtplib, instead of blocking on each in turn. Flask runs
+    an async view in an event loop on the worker handling the request, so
+    this needs flask[async], an async driver for the database (asyncpg or
+    aiosqlite) and aiosmtplib. init_app runs after the blueprints are
+    registered."""
+
+    def __init__(self, app=None, mail_queue=None):
+        self.mail_queue = None
+        if app is not None:
+            self.init_app(app, mail_queue)
+
+    def init_app(self, app, mail_queue):
+        """replace the views in ASYNC_VIEWS with their async versions"""
+        self.mail_queue = mail_queue
+        for endpoint, view in ASYNC_VIEWS.items():
+            app.view_functions[endpoint] = view
+
+
+async_views = AsyncViews()
@@ -0,0 +1,175 @@
+"""Compares how many concurrent connections the sync views and async mode (ASYNC_MODE) can serve
+
+Each mode runs in a fresh interpreter behind the same server: a fixed pool of
+--threads worker threads, like gunicorn's gthread worker. Clients then open
+an increasing number of concurrent connections, each logging in (bcrypt) or
+listing its feedback through the API in a seeded mix, and the throughput,
+p50/p99 latency and errors (including 503s from a saturated hasher) are
+reported per mode and concurrency level. Flask runs an async view in an event
+loop on the worker thread handling it, so both modes are capped by
+--threads; this shows what async mode does and doesn't buy at each level.
+Set BENCHMARK_DATABASE_URL to run against Postgres; the default is a SQLite file.
+Run with: python benchmarks/concurrency.py [--threads N] [--levels 1,8,32,128] [--duration S] [--save FILE] [--compare FILE]"""
+import argparse
+import http.client
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+from harness import PASSWORD, compare, make_app, save, seed, summarize
+
+MODES = ['sync', 'async']
+
+
+class PooledServer(WSGIServer):
+    """WSGIServer that hands each connection to a fixed pool of threads"""
+
+    request_queue_size = 1024
+
+    def __init__(self, address, threads):
+        super().__init__(address, QuietHandler)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve(url, mode, port, threads, rounds):
+    """run the app in one mode until killed"""
+    app = make_app(url, BCRYPT_LOG_ROUNDS=rounds, ASYNC_MODE=mode == 'async', USER_CACHE_ENABLED=False)
+    server = PooledServer(('127.0.0.1', port), threads)
+    server.set_app(app)
+    print('ready', flush=True)
+    server.serve_forever()
+
+
+def request(port, method, path, body=None, cookie=None):
+    """send one request on a new connection; returns (status, Set-Cookie)"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    headers = {'Cookie': cookie} if cookie else {}
+    if body is not None:
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        body = urlencode(body)
+    try:
+        conn.request(method, path, body, headers)
+        resp = conn.getresponse()
+        resp.read()
+        return resp.status, resp.getheader('Set-Cookie')
+    finally:
+        conn.close()
+
+
+def client(port, number, users, ready, window, samples):
+    """log in as a bench user, wait for the others, then send the mix until the window ends, appending (seconds, ok) to samples"""
+    rng = random.Random(number)
+    username = f'bench{number % users}'
+    login = {'username': username, 'password': PASSWORD}
+    status, cookie = request(port, 'POST', '/login', login)
+    cookie = cookie.split(';')[0] if cookie else None
+    ready.wait()
+    while time.perf_counter() < window['end']:
+        start = time.perf_counter()
+        try:
+            if rng.random() < 0.2:
+                status, _ = request(port, 'POST', '/login', login)
+            else:
+                status, _ = request(port, 'GET', f'/api/v1/users/{username}/feedback', cookie=cookie)
+            ok = status < 400
+        except OSError:
+            ok = False
+        samples.append((time.perf_counter() - start, ok))
+
+
+def run_level(port, level, users, duration):
+    samples = []
+    window = {}
+
+    def open_window():
+        # the first logins are setup, so timing starts once every client has one
+        window['start'] = time.perf_counter()
+        window['end'] = window['start'] + duration
+
+    ready = threading.Barrier(level, action=open_window)
+    clients = [threading.Thread(target=client, args=(port, i, users, ready, window, samples)) for i in range(level)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - window['start']
+    result = summarize([seconds for seconds, ok in samples])
+    result['rps'] = result['count'] / elapsed
+    result['errors'] = sum(not ok for seconds, ok in samples)
+    return result
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8, help='server worker threads')
+    parser.add_argument('--levels', default='1,8,32,128', help='concurrent connections to try, comma separated')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per level')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=12, help='BCRYPT_LOG_ROUNDS')
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--save')
+    parser.add_argument('--compare')
+    parser.add_argument('--serve', nargs=3, metavar=('URL', 'MODE', 'PORT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        url, mode, port = args.serve
+        serve(url, mode, int(port), args.threads, args.rounds)
+        return
+
+    url = os.environ.get('BENCHMARK_DATABASE_URL') or f'sqlite:///{os.path.join(tempfile.mkdtemp(), "bench.db")}'
+    with make_app(url, BCRYPT_LOG_ROUNDS=args.rounds).app_context():
+        seed(users=args.users, feedback_per_user=20)
+    results = {}
+    print(f'{args.threads} server threads, {args.duration:.0f}s per level')
+    print(f'{"mode":<8}{"clients":>8}{"requests":>10}{"req/s":>9}{"p50 ms":>9}{"p99 ms":>10}{"errors":>8}')
+    for mode in args.modes.split(','):
+        port = free_port()
+        server = subprocess.Popen([sys.executable, __file__, '--serve', url, mode, str(port), '--threads', str(args.threads),
+                                   '--rounds', str(args.rounds)], stdout=subprocess.PIPE, text=True)
+        try:
+            server.stdout.readline()
+            for level in [int(level) for level in args.levels.split(',')]:
+                result = run_level(port, level, args.users, args.duration)
+                results[f'{mode} x{level}'] = result
+                print(f'{mode:<8}{level:>8}{result["count"]:>10}{result["rps"]:>9.1f}{result["p50"]:>9.2f}{result["p99"]:>10.2f}{result["errors"]:>8}')
+        finally:
+            server.terminate()
+            server.wait()
+    if args.save:
+        save(args.save, results)
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == '__main__':
+    main()
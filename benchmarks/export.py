@@ -0,0 +1,80 @@
+"""Measures time and peak memory of the streaming feedback export against loading every row at once
+
+Seeds one user with ROWS feedback rows (a million by default), then runs each
+scenario in a fresh interpreter so peak RSS isn't shared between them. Set
+BENCHMARK_DATABASE_URL to run against Postgres; the default is a SQLite file.
+Run with: python benchmarks/export.py [rows]"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SCENARIOS = ['ndjson', 'csv', 'buffered']
+
+
+def make_app(url):
+    from app import create_app
+    return create_app({'SQLALCHEMY_DATABASE_URI': url, 'METRICS_ENABLED': False, 'USER_CACHE_ENABLED': False})
+
+
+def seed(url, rows):
+    from sqlalchemy import insert
+    from models import db, User, Feedback
+    with make_app(url).app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add(User(username='bench', password='x', email='bench@example.com', first_name='Bench', last_name='Mark'))
+        db.session.commit()
+        for start in range(0, rows, 10000):
+            db.session.execute(insert(Feedback), [{'username': 'bench', 'title': f'feedback {i}', 'content': 'x' * 200}
+                                                  for i in range(start, min(start + 10000, rows))])
+        db.session.commit()
+
+
+def run(url, scenario):
+    """export every row once and print seconds, bytes and peak RSS in MB"""
+    import json
+    from models import Feedback
+    app = make_app(url)
+    start = time.perf_counter()
+    size = 0
+    if scenario == 'buffered':
+        with app.app_context():
+            rows = Feedback.query.filter_by(username='bench').order_by(Feedback.id).all()
+            body = ''.join(json.dumps({'id': f.id, 'username': f.username, 'title': f.title, 'content': f.content}) + '\n' for f in rows)
+            size = len(body)
+    else:
+        client = app.test_client()
+        with client.session_transaction() as change_session:
+            change_session['username'] = 'bench'
+        resp = client.get(f'/api/v1/users/bench/feedback/export?format={scenario}', buffered=False)
+        for chunk in resp.response:
+            size += len(chunk)
+        resp.close()
+    elapsed = time.perf_counter() - start
+    print(elapsed, size, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def main(rows=1000000):
+    url = os.environ.get('BENCHMARK_DATABASE_URL') or f'sqlite:///{os.path.join(tempfile.mkdtemp(), "export.db")}'
+    start = time.perf_counter()
+    seed(url, rows)
+    print(f'seeded {rows} rows in {time.perf_counter() - start:.1f}s')
+    print(f'{"scenario":<12}{"seconds":>10}{"rows/s":>12}{"MB out":>10}{"peak RSS MB":>14}')
+    for scenario in SCENARIOS:
+        out = subprocess.run([sys.executable, __file__, '--run', url, scenario], cwd=ROOT, check=True,
+                             capture_output=True, text=True).stdout.split()
+        elapsed, size, rss = float(out[-3]), int(out[-2]), float(out[-1])
+        print(f'{scenario:<12}{elapsed:>10.2f}{rows / elapsed:>12.0f}{size / 2**20:>10.1f}{rss:>14.1f}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        run(sys.argv[2], sys.argv[3])
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
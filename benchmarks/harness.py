@@ -0,0 +1,76 @@
+"""Shared helpers for micro.py, load.py and concurrency.py: a seeded app, percentiles, and saving/comparing results across commits"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'benchmark-password!'
+
+
+def make_app(url=None, **config):
+    """an app on BENCHMARK_DATABASE_URL (or a fresh SQLite file) with mail, CSRF and rate limiting off"""
+    from app import create_app, mail_queue
+    url = url or os.environ.get('BENCHMARK_DATABASE_URL') or f'sqlite:///{os.path.join(tempfile.mkdtemp(), "bench.db")}'
+    app = create_app({'TESTING': True, 'WTF_CSRF_ENABLED': False, 'LOGIN_RATE_LIMIT_ENABLED': False,
+                      'METRICS_ENABLED': False, 'SQLALCHEMY_DATABASE_URI': url, **config})
+    mail_queue.enabled = False
+    return app
+
+
+def seed(users=20, feedback_per_user=50):
+    """recreate the tables with users bench0..benchN, all with PASSWORD, each with some feedback. Needs an app context"""
+    from sqlalchemy import insert
+    from models import db, hasher, User, Feedback
+    db.drop_all()
+    db.create_all()
+    pw_hash = hasher.generate_password_hash(PASSWORD)
+    db.session.execute(insert(User), [{'username': f'bench{i}', 'password': pw_hash, 'email': f'bench{i}@example.com',
+                                       'first_name': 'Bench', 'last_name': str(i), 'is_admin': False} for i in range(users)])
+    if feedback_per_user:
+        db.session.execute(insert(Feedback), [{'username': f'bench{i}', 'title': f'feedback {j}', 'content': 'x' * 200}
+                                              for i in range(users) for j in range(feedback_per_user)])
+    db.session.commit()
+
+
+def percentile(samples, p):
+    """nearest-rank percentile of a sorted list"""
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, max(0, round(p / 100 * len(samples)) - 1))]
+
+
+def summarize(samples):
+    """count and p50/p95/p99 in milliseconds of a list of durations in seconds"""
+    samples = sorted(samples)
+    return {'count': len(samples), **{f'p{p}': percentile(samples, p) * 1000 for p in (50, 95, 99)}}
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def save(path, results):
+    """write results with the current commit, for comparing against later"""
+    with open(path, 'w') as f:
+        json.dump({'commit': commit(), 'results': results}, f, indent=2)
+
+
+def compare(path, results, key='p50'):
+    """print how each result's key moved against a file written by save()"""
+    with open(path) as f:
+        baseline = json.load(f)
+    print(f'\n{key} against {baseline.get("commit") or path}')
+    for name, result in results.items():
+        before = baseline['results'].get(name, {}).get(key)
+        if not before:
+            print(f'  {name:<32}{result[key]:>10.2f} ms  (new)')
+            continue
+        change = (result[key] - before) / before * 100
+        print(f'  {name:<32}{before:>10.2f} ->{result[key]:>10.2f} ms  {change:+6.1f}%')
@@ -0,0 +1,124 @@
+"""In-process load test of the auth and feedback routes
+
+Seeds users with feedback, then runs worker threads that each log in as their
+own user and send a weighted mix of requests straight to the WSGI app through
+Flask's test client, so no server or network is involved. Reports throughput
+and p50/p95/p99 latency per route. The mix is seeded so runs are repeatable;
+--save and --compare work as in micro.py.
+Run with: python benchmarks/load.py [--workers N] [--duration S] [--save FILE] [--compare FILE]"""
+import argparse
+import itertools
+import random
+import threading
+import time
+from collections import defaultdict
+from harness import PASSWORD, compare, make_app, save, seed, summarize
+
+names = itertools.count()
+
+
+class Worker(threading.Thread):
+    """sends requests as bench<n> until the deadline, recording (route, seconds, ok) for each"""
+
+    def __init__(self, app, number, deadline, feedback_ids):
+        super().__init__(name=f'load{number}')
+        self.app = app
+        self.username = f'bench{number}'
+        self.deadline = deadline
+        self.feedback_ids = feedback_ids
+        self.rng = random.Random(number)
+        self.samples = []
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session['username'] = self.username
+
+    def routes(self):
+        """(name, weight, request) for each route in the mix"""
+        return [
+            ('GET /login', 5, lambda: self.anonymous().get('/login')),
+            ('POST /login', 5, lambda: self.anonymous().post('/login', data={'username': self.username, 'password': PASSWORD})),
+            ('POST /register', 2, self.register),
+            ('GET /user/<username>', 40, lambda: self.client.get(f'/user/{self.username}')),
+            ('GET /api/v1 feedback list', 20, lambda: self.client.get(f'/api/v1/users/{self.username}/feedback')),
+            ('POST /feedback add', 10, lambda: self.client.post(f'/user/{self.username}/feedback/add', data={'title': 'load', 'content': 'test'})),
+            ('POST /feedback update', 10, lambda: self.client.post(f'/feedback/{self.rng.choice(self.feedback_ids)}/update', data={'title': 'updated', 'content': 'test'})),
+            ('POST /feedback delete', 3, self.delete),
+        ]
+
+    def anonymous(self):
+        return self.app.test_client()
+
+    def register(self):
+        n = next(names)
+        return self.anonymous().post('/register', data={'username': f'load{n}', 'password': PASSWORD, 'password2': PASSWORD,
+                                                        'email': f'load{n}@example.com', 'first_name': 'Load', 'last_name': 'Test'})
+
+    def delete(self):
+        if len(self.feedback_ids) < 2:
+            return None
+        return self.client.post(f'/feedback/{self.feedback_ids.pop()}/delete')
+
+    def run(self):
+        routes = self.routes()
+        weights = [weight for name, weight, request in routes]
+        while time.perf_counter() < self.deadline:
+            name, weight, request = self.rng.choices(routes, weights)[0]
+            start = time.perf_counter()
+            resp = request()
+            if resp is None:
+                continue
+            self.samples.append((name, time.perf_counter() - start, resp.status_code < 400))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--feedback', type=int, default=50, help='feedback items seeded per user')
+    parser.add_argument('--rounds', type=int, default=12, help='BCRYPT_LOG_ROUNDS')
+    parser.add_argument('--save')
+    parser.add_argument('--compare')
+    args = parser.parse_args()
+
+    app = make_app(BCRYPT_LOG_ROUNDS=args.rounds)
+    with app.app_context():
+        from models import db, Feedback
+        seed(users=args.workers, feedback_per_user=args.feedback)
+        rows = db.session.execute(db.select(Feedback.username, Feedback.id)).all()
+    owned = defaultdict(list)
+    for username, feedback_id in rows:
+        owned[username].append(feedback_id)
+
+    start = time.perf_counter()
+    workers = [Worker(app, i, start + args.duration, owned[f'bench{i}']) for i in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    by_route = defaultdict(list)
+    errors = defaultdict(int)
+    for worker in workers:
+        for name, seconds, ok in worker.samples:
+            by_route[name].append(seconds)
+            errors[name] += not ok
+    results = {}
+    print(f'{args.workers} workers for {elapsed:.1f}s')
+    print(f'{"route":<28}{"requests":>10}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"errors":>8}')
+    for name in sorted(by_route):
+        result = summarize(by_route[name])
+        result['rps'] = result['count'] / elapsed
+        result['errors'] = errors[name]
+        results[name] = result
+        print(f'{name:<28}{result["count"]:>10}{result["rps"]:>9.1f}{result["p50"]:>9.2f}{result["p95"]:>9.2f}{result["p99"]:>9.2f}{result["errors"]:>8}')
+    total = sum(result['count'] for result in results.values())
+    print(f'{"total":<28}{total:>10}{total / elapsed:>9.1f}')
+    if args.save:
+        save(args.save, results)
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == '__main__':
+    main()
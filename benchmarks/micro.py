@@ -0,0 +1,66 @@
+"""Micro-benchmarks for registration, authentication and form validation
+
+Each operation runs a fixed number of times inside one app context and is
+reported as p50/p95/p99. --save writes the results to a JSON file and
+--compare prints the change against one saved from another commit.
+Run with: python benchmarks/micro.py [--iterations N] [--rounds R] [--save FILE] [--compare FILE]"""
+import argparse
+import itertools
+import time
+from harness import PASSWORD, compare, make_app, save, seed, summarize
+
+
+def operations():
+    from werkzeug.datastructures import MultiDict
+    from forms import RegisterForm, FeedbackForm
+    from models import db, User
+    names = itertools.count()
+
+    def register():
+        n = next(names)
+        db.session.add(User.register(f'micro{n}', PASSWORD, f'micro{n}@example.com', 'Micro', 'Bench'))
+        db.session.commit()
+
+    register_data = MultiDict({'username': 'someone', 'password': PASSWORD, 'password2': PASSWORD,
+                               'email': 'someone@example.com', 'first_name': 'Some', 'last_name': 'One'})
+    feedback_data = MultiDict({'title': 'a title', 'content': 'some content'})
+    return {
+        'User.register': register,
+        'User.authenticate ok': lambda: User.authenticate('bench0', PASSWORD),
+        'User.authenticate bad password': lambda: User.authenticate('bench0', 'wrong-password!'),
+        'User.authenticate unknown user': lambda: User.authenticate('nobody', PASSWORD),
+        'RegisterForm.validate': lambda: RegisterForm(formdata=register_data, meta={'csrf': False}).validate(),
+        'FeedbackForm.validate': lambda: FeedbackForm(formdata=feedback_data, meta={'csrf': False}).validate(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=12, help='BCRYPT_LOG_ROUNDS')
+    parser.add_argument('--save')
+    parser.add_argument('--compare')
+    args = parser.parse_args()
+
+    app = make_app(BCRYPT_LOG_ROUNDS=args.rounds)
+    results = {}
+    print(f'{"operation":<32}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    with app.test_request_context():
+        seed(users=1, feedback_per_user=0)
+        for name, operation in operations().items():
+            operation()
+            samples = []
+            for i in range(args.iterations):
+                start = time.perf_counter()
+                operation()
+                samples.append(time.perf_counter() - start)
+            results[name] = summarize(samples)
+            print(f'{name:<32}{results[name]["p50"]:>10.2f}{results[name]["p95"]:>10.2f}{results[name]["p99"]:>10.2f}')
+    if args.save:
+        save(args.save, results)
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == '__main__':
+    main()
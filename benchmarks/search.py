@@ -0,0 +1,64 @@
+"""Measures feedback search latency as the corpus grows
+
+Seeds a corpus of random feedback at each size and times a few queries through
+feedback_search. Set BENCHMARK_DATABASE_URL to measure Postgres (tsvector + GIN);
+the default SQLite file measures the in-memory inverted index, whose one-off
+build time is reported separately.
+Run with: python benchmarks/search.py [size ...]"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = [f'word{i}' for i in range(5000)]
+QUERIES = [('common term', 'word1'), ('two terms', 'word1 word2'), ('rare term', 'word4999'), ('no match', 'zebra')]
+
+
+def text(rng, words):
+    # a skewed distribution, so low-numbered words are common and high-numbered ones rare
+    return ' '.join(WORDS[min(int(rng.paretovariate(1.2)) - 1, len(WORDS) - 1)] for i in range(words))
+
+
+def seed(db, User, Feedback, size):
+    from sqlalchemy import insert
+    rng = random.Random(size)
+    db.drop_all()
+    db.create_all()
+    db.session.add(User(username='bench', password='x', email='bench@example.com', first_name='Bench', last_name='Mark'))
+    db.session.commit()
+    for start in range(0, size, 10000):
+        db.session.execute(insert(Feedback), [{'username': 'bench', 'title': text(rng, 6), 'content': text(rng, 40)}
+                                              for i in range(start, min(start + 10000, size))])
+    db.session.commit()
+
+
+def main(sizes, repeats=20):
+    from app import create_app
+    from models import db, User, Feedback
+    from search import feedback_search
+    url = os.environ.get('BENCHMARK_DATABASE_URL') or f'sqlite:///{os.path.join(tempfile.mkdtemp(), "search.db")}'
+    app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'METRICS_ENABLED': False})
+    print(f'{"size":>8}  {"query":<14}{"median ms":>12}{"p95 ms":>10}')
+    with app.app_context():
+        for size in sizes:
+            seed(db, User, Feedback, size)
+            if db.engine.dialect.name != 'postgresql':
+                start = time.perf_counter()
+                feedback_search.search('word1')
+                print(f'{size:>8}  {"index build":<14}{(time.perf_counter() - start) * 1000:>12.1f}')
+            for name, query in QUERIES:
+                times = []
+                for i in range(repeats):
+                    start = time.perf_counter()
+                    feedback_search.search(query)
+                    times.append(time.perf_counter() - start)
+                times.sort()
+                print(f'{size:>8}  {name:<14}{statistics.median(times) * 1000:>12.2f}{times[int(len(times) * 0.95) - 1] * 1000:>10.2f}')
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or [1000, 10000, 100000])
@@ -0,0 +1,57 @@
+"""Compares the per-request cost of loading and saving a session on each backend
+
+Run with: python benchmarks/sessions.py [requests]"""
+import os
+import sys
+import tempfile
+import timeit
+from flask import Flask, session
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sessions import ServerSideSessionInterface, MemoryStore, FilesystemStore, RedisStore
+
+
+def make_app(interface=None):
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'benchmark'
+    if interface is not None:
+        app.session_interface = interface
+
+    @app.route('/')
+    def index():
+        return session.get('username', '')
+
+    @app.route('/touch')
+    def touch():
+        session['visits'] = session.get('visits', 0) + 1
+        return ''
+
+    return app
+
+
+def backends():
+    yield 'cookie', None
+    yield 'memory', ServerSideSessionInterface(MemoryStore())
+    yield 'filesystem', ServerSideSessionInterface(FilesystemStore(tempfile.mkdtemp()))
+    try:
+        import fakeredis
+    except ImportError:
+        return
+    yield 'redis (fakeredis)', ServerSideSessionInterface(RedisStore(fakeredis.FakeRedis()))
+
+
+def main(requests=2000):
+    print(f'{"backend":<20}{"read us/req":>14}{"write us/req":>14}')
+    for name, interface in backends():
+        app = make_app(interface)
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['username'] = 'JaneDoe'
+            sess['admin'] = False
+        read = timeit.timeit(lambda: client.get('/'), number=requests) / requests
+        write = timeit.timeit(lambda: client.get('/touch'), number=requests) / requests
+        print(f'{name:<20}{read * 1e6:>14.1f}{write * 1e6:>14.1f}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
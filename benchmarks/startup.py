@@ -0,0 +1,34 @@
+"""Measures the cold cost of importing app.py and of building the app with create_app
+
+Each sample runs in a fresh interpreter so nothing is cached between runs.
+Run with: python benchmarks/startup.py [samples]"""
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = [
+    ('python startup', 'pass'),
+    ('import app', 'import app'),
+    ('import app + create_app()', 'import app; app.create_app()'),
+]
+
+
+def sample(code):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True)
+    return time.perf_counter() - start
+
+
+def main(samples=5):
+    print(f'{"scenario":<30}{"median ms":>12}{"min ms":>12}')
+    for name, code in SCENARIOS:
+        times = [sample(code) for i in range(samples)]
+        print(f'{name:<30}{statistics.median(times) * 1000:>12.1f}{min(times) * 1000:>12.1f}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,93 @@
+import os
+
+
+class Config:
+    """Default settings for the feedback app. create_app(config) overrides any of these"""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql:///feedback')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    # Postgres connection pool; SQLALCHEMY_ENGINE_OPTIONS overrides any of these
+    DB_POOL_SIZE = 5
+    DB_MAX_OVERFLOW = 10
+    DB_POOL_TIMEOUT = 10
+    DB_POOL_RECYCLE = 1800
+    DB_POOL_PRE_PING = True
+    # True behind PgBouncer in transaction pooling mode: no server-side prepared statements
+    DB_PGBOUNCER = False
+    # milliseconds any one statement may run during a request; 0 for no limit
+    DB_STATEMENT_TIMEOUT = 5000
+    DB_RETRY_AFTER = 1
+    # read replicas for read-only routes, added as binds replica0, replica1, ...; empty reads from the primary
+    SQLALCHEMY_REPLICA_URLS = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+    # seconds after a client writes that its reads stay on the primary, to cover replication lag
+    READ_REPLICA_STICKY_SECONDS = 5
+    # serve login, password reset and the API's reads from async views; needs flask[async], asyncpg and aiosmtplib
+    ASYNC_MODE = False
+    # defaults to SQLALCHEMY_DATABASE_URI with its async driver, e.g. postgresql+asyncpg
+    ASYNC_DATABASE_URI = os.environ.get('ASYNC_DATABASE_URL')
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'requin')
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+    MAIL_SERVER = 'smtp.gmail.com'
+    MAIL_PORT = 465
+    MAIL_USE_SSL = True
+    MAIL_USERNAME = 'theenbydeveloper@gmail.com'
+    # MAIL_PASSWORD comes from local_settings.py or the MAIL_PASSWORD environment variable
+    MAIL_QUEUE_ENABLED = True
+    MAIL_QUEUE_BATCH_SIZE = 50
+    MAIL_QUEUE_MAX_ATTEMPTS = 5
+    MAIL_QUEUE_BACKOFF = 30
+    MAIL_POOL_SIZE = 2
+    MAIL_POOL_MAX_IDLE = 60
+    # 'database' stores a hashed token on the user; 'signed' emails a signed token and writes nothing
+    PASSWORD_RESET_MODE = 'database'
+    PASSWORD_RESET_TTL = 3600
+    # login attempts allowed per username and per client IP in a sliding LOGIN_RATE_LIMIT_WINDOW seconds
+    LOGIN_RATE_LIMIT_ENABLED = True
+    LOGIN_RATE_LIMIT_USERNAME = 10
+    LOGIN_RATE_LIMIT_IP = 50
+    LOGIN_RATE_LIMIT_WINDOW = 60
+    # 'memory' counts per process; 'redis' shares counts between workers
+    LOGIN_RATE_LIMIT_BACKEND = 'memory'
+    LOGIN_RATE_LIMIT_REDIS_URL = 'redis://localhost:6379/0'
+    BCRYPT_LOG_ROUNDS = 12
+    BCRYPT_REHASH_ON_LOGIN = True
+    HASHER_MAX_WORKERS = 4
+    HASHER_QUEUE_SIZE = 16
+    HASHER_RETRY_AFTER = 1
+    FEEDBACK_PAGE_SIZE = 20
+    FEEDBACK_USER_LOADER = 'joined'
+    # most items one /api/v1 request may create, update or delete, and the largest page it may ask for
+    API_BATCH_LIMIT = 500
+    # rows fetched per round trip by the streaming feedback export
+    EXPORT_BATCH_SIZE = 1000
+    ACCOUNT_DELETE_BATCH_SIZE = 1000
+    ACCOUNT_DELETE_ASYNC_THRESHOLD = 10000
+    # seconds the status link given when a background deletion starts keeps working
+    ACCOUNT_DELETE_STATUS_TTL = 86400
+    # a background deletion with no progress for this long is assumed dead (e.g. its worker restarted) and can be started again
+    ACCOUNT_DELETE_STALE_SECONDS = 300
+    # 'cookie' keeps Flask's signed cookie sessions; 'memory', 'filesystem' or 'redis' store them server side
+    SESSION_BACKEND = 'cookie'
+    SESSION_TTL = 86400
+    SESSION_REDIS_URL = 'redis://localhost:6379/0'
+    USER_CACHE_ENABLED = True
+    USER_CACHE_TTL = 60
+    USER_CACHE_SIZE = 1024
+    # per-request SQL/bcrypt/template/mail counters served at /metrics; METRICS_LOG adds a JSON log line per request
+    METRICS_ENABLED = True
+    METRICS_LOG = False
+    # who may read /metrics: these addresses, or anyone sending 'Authorization: Bearer <METRICS_TOKEN>'.
+    # Behind a reverse proxy on the same host every client looks local, so empty the list and set a token
+    METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+
+class TestingConfig(Config):
+    """Settings for the test suite"""
+
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL', 'postgresql:///feedback_test')
+    # the minimum cost; at the production cost bcrypt dominates the suite's runtime
+    BCRYPT_LOG_ROUNDS = 4
@@ -0,0 +1,136 @@
+from threading import Lock
+import time
+from flask import current_app, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeout
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+from werkzeug.exceptions import ServiceUnavailable
+
+# Postgres's SQLSTATE for a statement cancelled by statement_timeout
+QUERY_CANCELED = '57014'
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that reports how long each checkout waited for a free connection"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool.record_wait(time.perf_counter() - start)
+
+
+def statement_timeout(ms):
+    """override DB_STATEMENT_TIMEOUT for one view; 0 turns it off, e.g. for long streaming exports"""
+    def decorator(view):
+        view.statement_timeout = ms
+        return view
+    return decorator
+
+
+class DatabasePool:
+    """Engine pool settings, checkout wait timing and per-request statement timeouts
+
+    init_app turns the DB_* settings into SQLALCHEMY_ENGINE_OPTIONS, so it runs
+    before connect_db. On Postgres every transaction begun during a request
+    starts with SET LOCAL statement_timeout, so one slow query is cancelled
+    instead of holding a pooled connection indefinitely. SET LOCAL only lasts
+    for the transaction, which keeps it safe behind PgBouncer in transaction
+    pooling mode. Pool and statement timeouts are answered with a 503."""
+
+    def __init__(self, app=None):
+        self.statement_timeout = 0
+        self.retry_after = 1
+        # optional callback(kind, seconds) for request metrics
+        self.timer = None
+        self._lock = Lock()
+        self.reset_stats()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """set SQLALCHEMY_ENGINE_OPTIONS from the DB_* settings and install the timeout hooks"""
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {**self.engine_options(app.config), **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})}
+        self.statement_timeout = app.config.get('DB_STATEMENT_TIMEOUT', 0)
+        self.retry_after = app.config.get('DB_RETRY_AFTER', 1)
+        if not event.contains(Session, 'after_begin', self._after_begin):
+            event.listen(Session, 'after_begin', self._after_begin)
+        app.register_error_handler(PoolTimeout, self._pool_timeout)
+        app.register_error_handler(OperationalError, self._operational_error)
+
+    def engine_options(self, config):
+        """pool settings for a Postgres URI; other databases keep SQLAlchemy's defaults"""
+        url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+        if url.get_backend_name() != 'postgresql':
+            return {}
+        options = {
+            'poolclass': TimedQueuePool,
+            'pool_size': config.get('DB_POOL_SIZE', 5),
+            'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+            'pool_timeout': config.get('DB_POOL_TIMEOUT', 10),
+            'pool_recycle': config.get('DB_POOL_RECYCLE', 1800),
+            'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+        }
+        connect_args = self.connect_args(url, config)
+        if connect_args:
+            options['connect_args'] = connect_args
+        return options
+
+    def connect_args(self, url, config):
+        """driver arguments for a Postgres URL; behind PgBouncer these turn off server-side prepared statements"""
+        if not config.get('DB_PGBOUNCER', False):
+            return {}
+        # PgBouncer hands each transaction to any server connection, so nothing may be prepared server side
+        if url.get_driver_name() == 'asyncpg':
+            return {'prepared_statement_cache_size': 0, 'statement_cache_size': 0}
+        if url.get_driver_name() == 'psycopg':
+            return {'prepare_threshold': None}
+        return {}
+
+    def _after_begin(self, session, transaction, connection):
+        if connection.dialect.name != 'postgresql' or not has_request_context():
+            return
+        view = current_app.view_functions.get(request.endpoint)
+        timeout = getattr(view, 'statement_timeout', self.statement_timeout)
+        if timeout:
+            # straight to the driver, so it isn't counted as the request's SQL
+            cursor = connection.connection.cursor()
+            cursor.execute(f'SET LOCAL statement_timeout = {int(timeout)}')
+            cursor.close()
+
+    def _pool_timeout(self, error):
+        return ServiceUnavailable('The database is busy. Please try again shortly.', retry_after=self.retry_after)
+
+    def _operational_error(self, error):
+        if getattr(error.orig, 'pgcode', None) == QUERY_CANCELED:
+            return ServiceUnavailable('That took too long. Please try again shortly.', retry_after=self.retry_after)
+        raise error
+
+    def record_wait(self, elapsed):
+        """count one checkout and how long it waited"""
+        if self.timer is not None:
+            self.timer('pool_wait', elapsed)
+        with self._lock:
+            self.waits['count'] += 1
+            self.waits['total'] += elapsed
+            self.waits['max'] = max(self.waits['max'], elapsed)
+
+    def reset_stats(self):
+        """clear the checkout wait counters"""
+        with self._lock:
+            self.waits = {'count': 0, 'total': 0.0, 'max': 0.0}
+
+    def stats(self, engine=None):
+        """checkout wait counters, plus the pool's current state when given an engine"""
+        with self._lock:
+            stats = {'waits': dict(self.waits)}
+        pool = getattr(engine, 'pool', None)
+        if isinstance(pool, QueuePool):
+            stats.update({'size': pool.size(), 'checked_out': pool.checkedout(), 'overflow': pool.overflow()})
+        return stats
+
+
+db_pool = DatabasePool()
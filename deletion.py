@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+from threading import Thread, Lock
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from sqlalchemy import update
+from models import db, User, Feedback, AccountDeletion
+from usercache import user_cache
+
+
+class AccountDeletions:
+    """Deletes very large accounts in the background
+
+    Feedback is removed in batches, each in its own short transaction, so a
+    huge account never holds one long lock on the feedback table. Progress for
+    each account is kept in the account_deletions table, so any worker can
+    read it with status(), and a deletion whose worker died (no progress for
+    ACCOUNT_DELETE_STALE_SECONDS) is started again by the next request for
+    it. Someone deleting their own account is logged out straight away, so
+    they read it with a signed status token instead of their session."""
+
+    def __init__(self, app=None):
+        self.batch_size = 1000
+        self.threshold = 10000
+        self.status_ttl = 86400
+        self.stale_seconds = 300
+        # this process's deletion threads, for wait()
+        self.threads = {}
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """read batch settings from the app config"""
+        self.batch_size = app.config.get('ACCOUNT_DELETE_BATCH_SIZE', 1000)
+        self.threshold = app.config.get('ACCOUNT_DELETE_ASYNC_THRESHOLD', 10000)
+        self.status_ttl = app.config.get('ACCOUNT_DELETE_STATUS_TTL', 86400)
+        self.stale_seconds = app.config.get('ACCOUNT_DELETE_STALE_SECONDS', 300)
+
+    def start(self, app, username, total):
+        """start deleting an account in a background thread and return its progress record"""
+        job = db.session.get(AccountDeletion, username)
+        if job and job.state == 'running' and job.updated_at > datetime.utcnow() - timedelta(seconds=self.stale_seconds):
+            return self._as_dict(job)
+        if job is None:
+            job = AccountDeletion(username=username)
+            db.session.add(job)
+        job.state, job.total, job.deleted, job.error, job.updated_at = 'running', total, 0, None, datetime.utcnow()
+        db.session.commit()
+        status = self._as_dict(job)
+        thread = Thread(target=self._run, args=(app, username), daemon=True)
+        with self._lock:
+            self.threads[username] = thread
+        thread.start()
+        return status
+
+    def _progress(self, username, **values):
+        db.session.execute(update(AccountDeletion).where(AccountDeletion.username == username)
+                           .values(updated_at=datetime.utcnow(), **values))
+        db.session.commit()
+
+    def _run(self, app, username):
+        with app.app_context():
+            try:
+                while True:
+                    deleted = Feedback.delete_batch_for_user(username, self.batch_size)
+                    if not deleted:
+                        break
+                    self._progress(username, deleted=AccountDeletion.deleted + deleted)
+                User.delete_account(username)
+                user_cache.invalidate(username)
+                self._progress(username, state='done')
+            except Exception as e:
+                db.session.rollback()
+                self._progress(username, state='failed', error=str(e))
+            finally:
+                db.session.remove()
+
+    @staticmethod
+    def _as_dict(job):
+        return {'state': job.state, 'total': job.total, 'deleted': job.deleted, 'error': job.error}
+
+    def status_token(self, username, secret_key):
+        """a signed token that lets whoever holds it read username's deletion progress"""
+        return URLSafeTimedSerializer(secret_key, salt='account-deletion').dumps(username)
+
+    def check_status_token(self, token, username, secret_key):
+        """return True if token was issued for username's deletion less than status_ttl seconds ago"""
+        if not token:
+            return False
+        try:
+            return URLSafeTimedSerializer(secret_key, salt='account-deletion').loads(token, max_age=self.status_ttl) == username
+        except BadSignature:
+            return False
+
+    def status(self, username):
+        """return an account's deletion progress, or None if none was started"""
+        job = db.session.get(AccountDeletion, username, populate_existing=True)
+        return self._as_dict(job) if job else None
+
+    def wait(self, username, timeout=None):
+        """block until an account's background deletion started by this process finishes"""
+        with self._lock:
+            thread = self.threads.get(username)
+        if thread:
+            thread.join(timeout)
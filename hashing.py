@@ -0,0 +1,175 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from threading import BoundedSemaphore, Lock
+import time
+import secrets
+from werkzeug.exceptions import ServiceUnavailable
+
+
+class HasherSaturated(ServiceUnavailable):
+    """raised when every hashing worker is busy and the wait queue is full"""
+
+    description = 'The server is busy. Please try again shortly.'
+
+
+class PasswordHasher:
+    """Runs bcrypt hashing and checking on a bounded worker pool
+
+    bcrypt releases the GIL, so a thread pool lets hashes run in parallel while
+    the number of in-flight hashes (workers + queue) stays capped. Once the cap
+    is reached new calls are rejected with a 503 instead of piling up."""
+
+    def __init__(self, bcrypt, app=None):
+        self.bcrypt = bcrypt
+        self.executor = None
+        self.slots = None
+        self.max_workers = 4
+        self.queue_size = 16
+        self.queue_timeout = 0
+        self.retry_after = 1
+        self.executor_type = 'thread'
+        self.log_rounds = 12
+        self.rehash = True
+        # optional callback(kind, seconds) for request metrics
+        self.timer = None
+        self._dummy = None
+        self._lock = Lock()
+        self.reset_stats()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """read pool settings from the app config"""
+        self.max_workers = app.config.get('HASHER_MAX_WORKERS', 4)
+        self.queue_size = app.config.get('HASHER_QUEUE_SIZE', 16)
+        self.queue_timeout = app.config.get('HASHER_QUEUE_TIMEOUT', 0)
+        self.retry_after = app.config.get('HASHER_RETRY_AFTER', 1)
+        self.executor_type = app.config.get('HASHER_EXECUTOR', 'thread')
+        self.log_rounds = app.config.get('BCRYPT_LOG_ROUNDS', 12)
+        self.rehash = app.config.get('BCRYPT_REHASH_ON_LOGIN', True)
+        self.shutdown()
+
+    def _start(self):
+        """create the worker pool on first use"""
+        with self._lock:
+            if self.executor is None:
+                if self.executor_type == 'process':
+                    self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                else:
+                    self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='bcrypt')
+                self.slots = BoundedSemaphore(self.max_workers + self.queue_size)
+
+    def shutdown(self):
+        """stop the worker pool; it is recreated on the next call"""
+        with self._lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+            self.executor = None
+            self.slots = None
+
+    def _run(self, kind, fn, *args):
+        """run fn on the pool, waiting for the result, and record its latency"""
+        if self.executor is None:
+            self._start()
+        slots = self.slots
+        if self.queue_timeout:
+            acquired = slots.acquire(timeout=self.queue_timeout)
+        else:
+            acquired = slots.acquire(blocking=False)
+        if not acquired:
+            self._reject()
+        start = time.perf_counter()
+        try:
+            return self.executor.submit(fn, *args).result()
+        finally:
+            slots.release()
+            self._record(kind, time.perf_counter() - start)
+
+    async def _run_async(self, kind, fn, *args):
+        """like _run, but awaits the result so the event loop carries on while bcrypt runs"""
+        if self.executor is None:
+            self._start()
+        slots = self.slots
+        if self.queue_timeout:
+            # waiting for a slot blocks, so do it off the loop
+            acquired = await asyncio.to_thread(slots.acquire, timeout=self.queue_timeout)
+        else:
+            acquired = slots.acquire(blocking=False)
+        if not acquired:
+            self._reject()
+        start = time.perf_counter()
+        try:
+            return await asyncio.wrap_future(self.executor.submit(fn, *args))
+        finally:
+            slots.release()
+            self._record(kind, time.perf_counter() - start)
+
+    def _reject(self):
+        with self._lock:
+            self.rejected += 1
+        raise HasherSaturated(retry_after=self.retry_after)
+
+    def _record(self, kind, elapsed):
+        if self.timer is not None:
+            self.timer('bcrypt', elapsed)
+        with self._lock:
+            stats = self.timings[kind]
+            stats['count'] += 1
+            stats['total'] += elapsed
+            stats['max'] = max(stats['max'], elapsed)
+
+    def reset_stats(self):
+        """clear the latency counters"""
+        with self._lock:
+            self.timings = {kind: {'count': 0, 'total': 0.0, 'max': 0.0} for kind in ('hash', 'check')}
+            self.rejected = 0
+
+    def stats(self):
+        """return a copy of the latency counters"""
+        with self._lock:
+            return {'hash': dict(self.timings['hash']), 'check': dict(self.timings['check']), 'rejected': self.rejected, 'log_rounds': self.log_rounds}
+
+    def generate_password_hash(self, pwd):
+        """hash a password on the pool and return it as a utf8 string"""
+        return self._run('hash', self.bcrypt.generate_password_hash, pwd, self.log_rounds).decode('utf8')
+
+    def check_password_hash(self, pw_hash, pwd):
+        """check a password against a stored hash on the pool"""
+        return self._run('check', self.bcrypt.check_password_hash, pw_hash, pwd)
+
+    async def generate_password_hash_async(self, pwd):
+        """generate_password_hash for async views"""
+        return (await self._run_async('hash', self.bcrypt.generate_password_hash, pwd, self.log_rounds)).decode('utf8')
+
+    async def check_password_hash_async(self, pw_hash, pwd):
+        """check_password_hash for async views"""
+        return await self._run_async('check', self.bcrypt.check_password_hash, pw_hash, pwd)
+
+    def needs_rehash(self, pw_hash):
+        """return True if a stored hash was made with a different cost than the configured one"""
+        if not self.rehash:
+            return False
+        try:
+            rounds = int(pw_hash.split('$')[2])
+        except (IndexError, ValueError):
+            return False
+        return rounds != self.log_rounds
+
+    def check_dummy(self, pwd):
+        """run one check against a throwaway hash at the configured cost, so a login for a username that
+        doesn't exist takes as long as one with a wrong password. Always returns False"""
+        dummy = self._dummy
+        if dummy is None or dummy[0] != self.log_rounds:
+            dummy = (self.log_rounds, self.generate_password_hash(secrets.token_hex(16)))
+            self._dummy = dummy
+        self.check_password_hash(dummy[1], pwd)
+        return False
+
+    async def check_dummy_async(self, pwd):
+        """check_dummy for async views"""
+        dummy = self._dummy
+        if dummy is None or dummy[0] != self.log_rounds:
+            dummy = (self.log_rounds, await self.generate_password_hash_async(secrets.token_hex(16)))
+            self._dummy = dummy
+        await self.check_password_hash_async(dummy[1], pwd)
+        return False
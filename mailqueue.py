@@ -0,0 +1,207 @@
+from datetime import datetime, timedelta
+from threading import Thread, Event, Lock
+import time
+from flask import current_app
+from flask_mail import BadHeaderError, Message, email_dispatched, sanitize_address, sanitize_addresses
+from models import db, OutboundEmail
+from asyncdb import async_db
+from smtppool import SMTPPool
+
+
+class MailQueue:
+    """Durable outbound email queue backed by the outbound_emails table
+
+    Routes call send(), which stores the message and returns right away. A
+    background thread, started by the first request, delivers due messages
+    over pooled SMTP connections and retries failures with exponential
+    backoff; 'flask mail-worker' does the same in a process of its own. With
+    the queue disabled, send() delivers inline over the same pool."""
+
+    def __init__(self, app=None, mail=None):
+        self.app = None
+        self.mail = None
+        self.enabled = True
+        self.batch_size = 50
+        self.max_attempts = 5
+        self.backoff = 30
+        self.poll_interval = 5
+        self.thread = None
+        self.pool = SMTPPool()
+        # optional callback(kind, seconds) for request metrics
+        self.timer = None
+        self._wake = Event()
+        self._stop = Event()
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app, mail)
+
+    def init_app(self, app, mail):
+        """read queue settings from the app config"""
+        self.app = app
+        self.mail = mail
+        self.enabled = app.config.get('MAIL_QUEUE_ENABLED', True)
+        self.batch_size = app.config.get('MAIL_QUEUE_BATCH_SIZE', 50)
+        self.max_attempts = app.config.get('MAIL_QUEUE_MAX_ATTEMPTS', 5)
+        self.backoff = app.config.get('MAIL_QUEUE_BACKOFF', 30)
+        self.poll_interval = app.config.get('MAIL_QUEUE_POLL_INTERVAL', 5)
+        self.pool.init_app(app)
+        app.before_request(self._start_on_request)
+
+    def _start_on_request(self):
+        # mail left pending or waiting on a retry before a restart goes out without waiting for new mail
+        if self.enabled and (self.thread is None or not self.thread.is_alive()):
+            self.start()
+
+    def send(self, msg):
+        """queue a message for delivery, or send it now if the queue is disabled"""
+        return self.send_many([msg])[0]
+
+    def send_many(self, msgs):
+        """queue several messages in one transaction, or send them now over one connection if the queue is disabled"""
+        start = time.perf_counter()
+        try:
+            if not self.enabled:
+                with self.pool.connection() as conn:
+                    for msg in msgs:
+                        conn.send(msg)
+                return [None] * len(msgs)
+            emails = self.enqueue_many(msgs)
+        finally:
+            if self.timer is not None:
+                self.timer('mail', time.perf_counter() - start)
+        self.start()
+        self._wake.set()
+        return emails
+
+    async def send_async(self, msg):
+        """send() for async views: queue the message through an AsyncSession, or deliver it with aiosmtplib
+        if the queue is disabled"""
+        start = time.perf_counter()
+        try:
+            if not self.enabled:
+                await self.deliver_async(msg)
+                return None
+            email = OutboundEmail(subject=msg.subject, sender=msg.sender, recipients=','.join(msg.recipients), html=msg.html)
+            async with async_db.session() as session:
+                session.add(email)
+                await session.commit()
+        finally:
+            if self.timer is not None:
+                self.timer('mail', time.perf_counter() - start)
+        self.start()
+        self._wake.set()
+        return email
+
+    async def deliver_async(self, msg):
+        """Send one message over its own aiosmtplib connection, with the checks and signal of Flask-Mail's send.
+        Connections aren't pooled, since none can outlive the event loop of the view that opened it"""
+        import aiosmtplib
+        state = current_app.extensions['mail']
+        if msg.has_bad_headers():
+            raise BadHeaderError
+        if msg.date is None:
+            msg.date = time.time()
+        if not state.suppress:
+            await aiosmtplib.send(msg.as_bytes(), sender=sanitize_address(msg.sender), recipients=list(sanitize_addresses(msg.send_to)),
+                                  hostname=state.server, port=state.port, use_tls=state.use_ssl, start_tls=state.use_tls,
+                                  username=state.username or None, password=state.password or None)
+        email_dispatched.send(msg, app=current_app._get_current_object())
+
+    def enqueue(self, msg):
+        """store a message in the outbound_emails table"""
+        return self.enqueue_many([msg])[0]
+
+    def enqueue_many(self, msgs):
+        """store several messages in the outbound_emails table with one commit"""
+        emails = [OutboundEmail(subject=msg.subject, sender=msg.sender, recipients=','.join(msg.recipients), html=msg.html) for msg in msgs]
+        db.session.add_all(emails)
+        db.session.commit()
+        return emails
+
+    def send_pending(self):
+        """deliver one batch of due messages over a pooled connection; returns how many were attempted"""
+        now = datetime.utcnow()
+        stmt = (db.select(OutboundEmail)
+                .where(OutboundEmail.status == 'pending', OutboundEmail.next_attempt_at <= now)
+                .order_by(OutboundEmail.next_attempt_at)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True))
+        emails = db.session.execute(stmt).scalars().all()
+        if not emails:
+            db.session.rollback()
+            return 0
+        attempted = 0
+        try:
+            with self.pool.connection() as conn:
+                for email in emails:
+                    attempted += 1
+                    email.attempts += 1
+                    msg = Message(subject=email.subject, sender=email.sender, recipients=email.recipients.split(','))
+                    msg.html = email.html
+                    try:
+                        conn.send(msg)
+                    except Exception as e:
+                        self._retry(email, e)
+                        # the connection may be unusable; the rest wait for the next batch
+                        break
+                    email.status = 'sent'
+                    email.last_error = None
+        except Exception as e:
+            # connecting failed, so nothing in this batch was sent
+            if not attempted:
+                for email in emails:
+                    email.attempts += 1
+                    self._retry(email, e)
+                attempted = len(emails)
+        db.session.commit()
+        return attempted
+
+    def _retry(self, email, error):
+        """schedule another attempt with exponential backoff, or give up"""
+        email.last_error = str(error)
+        if email.attempts >= self.max_attempts:
+            email.status = 'failed'
+        else:
+            email.next_attempt_at = datetime.utcnow() + timedelta(seconds=self.backoff * 2 ** (email.attempts - 1))
+
+    def start(self):
+        """start the background delivery thread if it isn't running"""
+        with self._lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self._stop.clear()
+            self.thread = Thread(target=self.run, name='mailqueue', daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout=None):
+        """stop the background delivery thread"""
+        self._stop.set()
+        self._wake.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+        self.pool.close_all()
+
+    def drain(self):
+        """deliver batches until nothing is due; returns how many messages were attempted"""
+        attempted = 0
+        while True:
+            sent = self.send_pending()
+            if not sent:
+                return attempted
+            attempted += sent
+
+    def run(self):
+        """deliver due messages until stop() is called, waking when new mail is queued"""
+        with self.app.app_context():
+            while not self._stop.is_set():
+                self._wake.clear()
+                try:
+                    sent = self.send_pending()
+                except Exception:
+                    db.session.rollback()
+                    sent = 0
+                finally:
+                    db.session.remove()
+                if not sent:
+                    self._wake.wait(self.poll_interval)
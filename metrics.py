@@ -0,0 +1,159 @@
+from collections import defaultdict
+from threading import Lock
+import hmac
+import json
+import logging
+import time
+from flask import g, request, has_request_context, before_render_template, template_rendered
+from werkzeug.exceptions import Forbidden
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('feedback.metrics')
+
+# per-request timers that other modules report into
+TIMERS = ('sql', 'bcrypt', 'template', 'mail', 'pool_wait')
+
+
+class Metrics:
+    """Per-request counters for SQL, bcrypt, template rendering, mail and pool waits
+
+    When enabled, each request records how many SQL statements it ran and how
+    long it spent in the database, bcrypt, templates and mail. Totals per
+    endpoint are served in Prometheus text format at /metrics and, with
+    METRICS_LOG, each request also writes one JSON log line. /metrics only
+    answers clients in METRICS_ALLOWED_IPS or sending METRICS_TOKEN as a
+    bearer token. When disabled no hooks are installed at all."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.log = False
+        self.allowed_ips = ()
+        self.token = None
+        self.totals = defaultdict(float)
+        # name -> (help, callable returning the current value)
+        self.gauges = {}
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """install request hooks and the /metrics route if METRICS_ENABLED is set"""
+        self.enabled = app.config.get('METRICS_ENABLED', False)
+        self.log = app.config.get('METRICS_LOG', False)
+        self.allowed_ips = tuple(app.config.get('METRICS_ALLOWED_IPS', ()))
+        self.token = app.config.get('METRICS_TOKEN')
+        if not self.enabled:
+            return
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.add_url_rule('/metrics', 'metrics', self.render)
+        if not event.contains(Engine, 'before_cursor_execute', self._before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+
+    def _current(self):
+        if has_request_context():
+            return g.get('_metrics')
+        return None
+
+    def _start_request(self):
+        g._metrics = {'start': time.perf_counter(), 'sql_count': 0, **{timer: 0.0 for timer in TIMERS}}
+
+    def _finish_request(self, response):
+        current = g.pop('_metrics', None)
+        if current is None:
+            return response
+        duration = time.perf_counter() - current['start']
+        endpoint = request.endpoint or 'unknown'
+        with self._lock:
+            self.totals[('requests', endpoint, request.method, response.status_code)] += 1
+            self.totals[('seconds', endpoint)] += duration
+            self.totals[('sql_count', endpoint)] += current['sql_count']
+            for timer in TIMERS:
+                self.totals[(timer, endpoint)] += current[timer]
+        if self.log:
+            logger.info(json.dumps({'endpoint': endpoint, 'method': request.method, 'path': request.path,
+                                    'status': response.status_code, 'duration_ms': round(duration * 1000, 3),
+                                    'sql_count': current['sql_count'],
+                                    **{f'{timer}_ms': round(current[timer] * 1000, 3) for timer in TIMERS}}))
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._current() is not None:
+            conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        current = self._current()
+        if current is not None and conn.info.get('metrics_start'):
+            current['sql_count'] += 1
+            current['sql'] += time.perf_counter() - conn.info['metrics_start'].pop()
+
+    def _before_render(self, sender, template, context, **extra):
+        current = self._current()
+        if current is not None:
+            current.setdefault('template_start', []).append(time.perf_counter())
+
+    def _after_render(self, sender, template, context, **extra):
+        current = self._current()
+        if current is not None and current.get('template_start'):
+            current['template'] += time.perf_counter() - current['template_start'].pop()
+
+    def timer(self, kind, elapsed):
+        """add time spent in bcrypt, mail or waiting for a database connection to the current request"""
+        current = self._current()
+        if current is not None:
+            current[kind] += elapsed
+
+    def allowed(self):
+        """whether the current request may read /metrics"""
+        if request.remote_addr in self.allowed_ips:
+            return True
+        auth = request.headers.get('Authorization', '')
+        return bool(self.token) and hmac.compare_digest(auth.encode(), f'Bearer {self.token}'.encode())
+
+    def render(self):
+        """return the totals in Prometheus text format"""
+        if not self.allowed():
+            raise Forbidden()
+        lines = [
+            '# HELP feedback_requests_total Requests handled.',
+            '# TYPE feedback_requests_total counter',
+        ]
+        with self._lock:
+            totals = dict(self.totals)
+        for key, value in sorted(totals.items(), key=str):
+            if key[0] == 'requests':
+                lines.append(f'feedback_requests_total{{endpoint="{key[1]}",method="{key[2]}",status="{key[3]}"}} {int(value)}')
+        series = [('seconds', 'feedback_request_seconds_total', 'Time spent handling requests.'),
+                  ('sql_count', 'feedback_sql_statements_total', 'SQL statements executed.'),
+                  ('sql', 'feedback_sql_seconds_total', 'Time spent executing SQL.'),
+                  ('bcrypt', 'feedback_bcrypt_seconds_total', 'Time spent hashing and checking passwords.'),
+                  ('template', 'feedback_template_seconds_total', 'Time spent rendering templates.'),
+                  ('mail', 'feedback_mail_seconds_total', 'Time spent sending or queueing mail.'),
+                  ('pool_wait', 'feedback_db_pool_wait_seconds_total', 'Time spent waiting for a pooled database connection.')]
+        for kind, name, help_text in series:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for key, value in sorted(totals.items(), key=str):
+                if key[0] == kind:
+                    lines.append(f'{name}{{endpoint="{key[1]}"}} {value:g}')
+        for name, (help_text, read) in sorted(self.gauges.items()):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {read():g}')
+        return '\n'.join(lines) + '\n', 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+    def add_gauge(self, name, help_text, read):
+        """serve the value read() returns at scrape time as a gauge"""
+        self.gauges[name] = (help_text, read)
+
+    def reset(self):
+        """clear the totals"""
+        with self._lock:
+            self.totals.clear()
+
+
+metrics = Metrics()
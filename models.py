@@ -1,16 +1,43 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_bcrypt import Bcrypt
 import secrets
-from sqlalchemy import update
+import hashlib
+import hmac
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from datetime import datetime, timedelta
+from sqlalchemy import update, delete, func, event, DDL
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import joinedload, selectinload
+from hashing import PasswordHasher
+from replicas import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 bcrypt = Bcrypt()
+hasher = PasswordHasher(bcrypt)
 
 def connect_db(app):
     """Connect to feedback database"""
 
     db.app = app
     db.init_app(app)
+    Feedback.user_loader = app.config.get('FEEDBACK_USER_LOADER', 'joined')
+
+class AuthResult:
+    """Outcome of User.authenticate. Truthy only when the password was right"""
+
+    OK = 'ok'
+    UNKNOWN_USER = 'unknown_user'
+    BAD_PASSWORD = 'bad_password'
+
+    def __init__(self, status, user=None):
+        self.status = status
+        self.user = user
+
+    def __bool__(self):
+        return self.status == AuthResult.OK
+
+    def __repr__(self):
+        return f"<AuthResult {self.status}>"
 
 class User(db.Model):
 
@@ -22,42 +49,154 @@ class User(db.Model):
     first_name = db.Column(db.String(length=30), nullable=False)
     last_name = db.Column(db.String(length=30), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
-    password_reset_token = db.Column(db.String)
+    # sha256 of the emailed token, never the token itself
+    password_reset_token = db.Column(db.String, unique=True, index=True)
+    password_reset_expires_at = db.Column(db.DateTime)
 
     @classmethod
     def register(cls, username, pwd, email, first_name, last_name):
         """Register user w/ hashed password and return user"""
 
-        hashed = bcrypt.generate_password_hash(pwd)
-        # turn byte string into normal string
-        hashed_utf8 = hashed.decode('utf8')
+        hashed_utf8 = hasher.generate_password_hash(pwd)
 
         #return instance of user w/ username and hashed password
         return cls(username=username, password=hashed_utf8, email=email, first_name=first_name, last_name=last_name)
     
     @classmethod
     def authenticate(cls, username, pwd):
-        """Validate that a user exists, have given the right password. Return user if valid, else false"""
+        """Validate that a user exists and gave the right password, using a single query.
+        Returns an AuthResult that is truthy only on success. Unknown usernames still pay for one bcrypt check
+        so the failure path takes the same time either way"""
 
         u = User.query.filter_by(username=username).first()
 
-        if u and bcrypt.check_password_hash(u.password, pwd):
-            #return user instance
-            return u
-        else:
-            return False
+        if not u:
+            hasher.check_dummy(pwd)
+            return AuthResult(AuthResult.UNKNOWN_USER)
+        if not hasher.check_password_hash(u.password, pwd):
+            return AuthResult(AuthResult.BAD_PASSWORD)
+        # upgrade or downgrade the stored hash if the configured cost has changed
+        if hasher.needs_rehash(u.password):
+            u.password = hasher.generate_password_hash(pwd)
+            try:
+                db.session.commit()
+            except SQLAlchemyError:
+                db.session.rollback()
+        return AuthResult(AuthResult.OK, u)
+
+    @classmethod
+    async def authenticate_async(cls, session, username, pwd):
+        """authenticate on an AsyncSession, awaiting bcrypt on the hasher's pool"""
+
+        u = (await session.execute(db.select(cls).filter_by(username=username))).scalars().first()
+
+        if not u:
+            await hasher.check_dummy_async(pwd)
+            return AuthResult(AuthResult.UNKNOWN_USER)
+        if not await hasher.check_password_hash_async(u.password, pwd):
+            return AuthResult(AuthResult.BAD_PASSWORD)
+        if hasher.needs_rehash(u.password):
+            u.password = await hasher.generate_password_hash_async(pwd)
+            try:
+                await session.commit()
+            except SQLAlchemyError:
+                await session.rollback()
+        return AuthResult(AuthResult.OK, u)
     
     def get_password_reset_token(self):
         """creates a password reset token"""
         return secrets.token_hex(16)
+
+    @staticmethod
+    def hash_password_reset_token(prt):
+        """returns the form of a reset token that is stored in the database"""
+        return hashlib.sha256(prt.encode('utf8')).hexdigest()
+
+    def issue_password_reset_token(self, ttl):
+        """creates a reset token valid for ttl seconds, stores its hash on the user and returns the token.
+        The caller commits"""
+        prt = self.get_password_reset_token()
+        self.password_reset_token = User.hash_password_reset_token(prt)
+        self.password_reset_expires_at = datetime.utcnow() + timedelta(seconds=ttl)
+        return prt
+
+    @classmethod
+    def from_password_reset_token(cls, prt):
+        """Return the user holding this unexpired reset token, or None. One indexed lookup on the token hash"""
+
+        if not prt:
+            return None
+        stmt = db.select(cls).where(cls.password_reset_token == cls.hash_password_reset_token(prt),
+                                    cls.password_reset_expires_at > datetime.utcnow())
+        return db.session.execute(stmt).scalar()
+
+    def password_fingerprint(self):
+        """short digest of the current password hash; changes whenever the password does"""
+        return hashlib.sha256(self.password.encode('utf8')).hexdigest()[:16]
+
+    def get_signed_password_reset_token(self, secret_key):
+        """creates a timed, signed reset token bound to the current password. Nothing is written to the database"""
+        serializer = URLSafeTimedSerializer(secret_key, salt='password-reset')
+        return serializer.dumps({'username': self.username, 'password': self.password_fingerprint()})
+
+    @classmethod
+    def from_signed_password_reset_token(cls, prt, secret_key, max_age):
+        """Return the user a signed reset token was issued to, or None if the signature is bad, the token is older
+        than max_age seconds or the password has changed since it was issued"""
+
+        if not prt:
+            return None
+        serializer = URLSafeTimedSerializer(secret_key, salt='password-reset')
+        try:
+            data = serializer.loads(prt, max_age=max_age)
+        except BadSignature:
+            return None
+        u = db.session.get(cls, data.get('username'))
+        if u and hmac.compare_digest(u.password_fingerprint(), data.get('password', '')):
+            return u
+        return None
+
+    @classmethod
+    def consume_password_reset_token(cls, prt, pwd):
+        """Set a new password and clear the reset token in one UPDATE ... WHERE token matches RETURNING.
+        Returns the username, or None if the token was invalid or already used. The caller commits"""
+
+        stmt = (update(cls)
+                .where(cls.password_reset_token == cls.hash_password_reset_token(prt),
+                       cls.password_reset_expires_at > datetime.utcnow())
+                .values(password=hasher.generate_password_hash(pwd), password_reset_token=None, password_reset_expires_at=None)
+                .returning(cls.username))
+        return db.session.execute(stmt).scalar()
+
+    def replace_password(self, pwd):
+        """Set a new password only if the stored hash is still the one this user was loaded with, in one
+        UPDATE ... RETURNING. Used with signed reset tokens so a token can't be spent twice. Returns the
+        username or None. The caller commits"""
+
+        stmt = (update(User)
+                .where(User.username == self.username, User.password == self.password)
+                .values(password=hasher.generate_password_hash(pwd))
+                .returning(User.username))
+        return db.session.execute(stmt).scalar()
+
+    @classmethod
+    def purge_expired_reset_tokens(cls):
+        """Clear every expired reset token in one UPDATE and commit. Returns the number of users cleared"""
+
+        stmt = (update(cls).where(cls.password_reset_expires_at < datetime.utcnow())
+                .values(password_reset_token=None, password_reset_expires_at=None))
+        result = db.session.execute(stmt)
+        db.session.commit()
+        return result.rowcount
     
-    def update_password(self, pwd, email):
-        hashed = bcrypt.generate_password_hash(pwd)
-        # turn byte string into normal string
-        hashed_utf8 = hashed.decode('utf8')
-        #returns update statement 
-        return update(User).where(User.email == email).values(password=hashed_utf8)
-    
+    @classmethod
+    def delete_account(cls, username):
+        """Delete a user and all of their feedback with set-based deletes in one transaction"""
+
+        db.session.execute(delete(Feedback).where(Feedback.username == username))
+        db.session.execute(delete(User).where(User.username == username))
+        db.session.commit()
+
     @property
     def fullname(self):
         """return user's full name"""
@@ -70,6 +209,141 @@ class Feedback(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     title = db.Column(db.String(length=100), nullable=False)
     content = db.Column(db.Text, nullable=False)
-    username = db.Column(db.Text, db.ForeignKey('users.username'))
+    username = db.Column(db.Text, db.ForeignKey('users.username', ondelete='CASCADE'))
+
+    user = db.relationship('User', backref=db.backref("feedback", passive_deletes=True))
+
+    __table_args__ = (db.Index('ix_feedback_username_id', 'username', 'id'),)
+
+    # how get_with_user loads the owner: 'joined' (one query), 'selectin' (two queries up front) or 'select' (lazy)
+    user_loader = 'joined'
+
+    @classmethod
+    def get_with_user_or_404(cls, feedback_id):
+        """Return a feedback item with its user loaded according to user_loader, or raise NotFound"""
+
+        stmt = db.select(cls).where(cls.id == feedback_id)
+        if cls.user_loader == 'joined':
+            stmt = stmt.options(joinedload(cls.user))
+        elif cls.user_loader == 'selectin':
+            stmt = stmt.options(selectinload(cls.user))
+        return db.first_or_404(stmt)
+
+    @classmethod
+    def page_for_user(cls, username, after=None, before=None, per_page=20):
+        """Return one page of a user's feedback ordered by id, plus the cursors for the previous and next pages.
+        Uses keyset pagination on (username, id) so every page costs the same no matter how deep it is"""
+
+        rows = db.session.execute(cls._page_query(username, after, before, per_page)).scalars().all()
+        probe = cls._earlier_query(username, rows, after, before)
+        earlier = probe is not None and db.session.execute(probe).first() is not None
+        return cls._page(rows, before, per_page, earlier)
+
+    @classmethod
+    async def page_for_user_async(cls, session, username, after=None, before=None, per_page=20):
+        """page_for_user on an AsyncSession"""
+
+        rows = (await session.execute(cls._page_query(username, after, before, per_page))).scalars().all()
+        probe = cls._earlier_query(username, rows, after, before)
+        earlier = probe is not None and (await session.execute(probe)).first() is not None
+        return cls._page(rows, before, per_page, earlier)
+
+    @classmethod
+    def _page_query(cls, username, after, before, per_page):
+        stmt = db.select(cls).where(cls.username == username)
+        if before is not None:
+            stmt = stmt.where(cls.id < before).order_by(cls.id.desc())
+        else:
+            if after is not None:
+                stmt = stmt.where(cls.id > after)
+            stmt = stmt.order_by(cls.id)
+        # fetch one extra row to find out whether there is another page
+        return stmt.limit(per_page + 1)
+
+    @classmethod
+    def _earlier_query(cls, username, rows, after, before):
+        # a page reached going forwards only has a previous page if a smaller id exists; None when there is nothing to ask
+        if before is not None or after is None or not rows:
+            return None
+        return db.select(cls.id).where(cls.username == username, cls.id < rows[0].id).limit(1)
+
+    @staticmethod
+    def _page(rows, before, per_page, earlier):
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if before is not None:
+            rows.reverse()
+            prev_cursor = rows[0].id if rows and more else None
+            next_cursor = rows[-1].id if rows else None
+        else:
+            prev_cursor = rows[0].id if rows and earlier else None
+            next_cursor = rows[-1].id if rows and more else None
+        return rows, prev_cursor, next_cursor
+
+    @classmethod
+    def stream_rows(cls, username=None, batch_size=1000):
+        """Yield lists of (id, username, title, content) rows ordered by id, for one user or everyone.
+        Uses a server-side cursor, so only one batch is held in memory at a time"""
+
+        stmt = db.select(cls.id, cls.username, cls.title, cls.content).order_by(cls.id)
+        if username is not None:
+            stmt = stmt.where(cls.username == username)
+        result = db.session.execute(stmt.execution_options(yield_per=batch_size))
+        try:
+            yield from result.partitions()
+        finally:
+            result.close()
+
+    @classmethod
+    def count_for_user(cls, username):
+        """Return the number of feedback items a user has"""
+
+        return db.session.execute(db.select(func.count(cls.id)).where(cls.username == username)).scalar()
+
+    @classmethod
+    def delete_batch_for_user(cls, username, batch_size):
+        """Delete up to batch_size of a user's feedback items and commit. Returns the number of rows deleted"""
+
+        ids = db.select(cls.id).where(cls.username == username).limit(batch_size).scalar_subquery()
+        result = db.session.execute(delete(cls).where(cls.id.in_(ids)))
+        db.session.commit()
+        return result.rowcount
+
+# Postgres keeps a weighted tsvector of each item for search.py, so it isn't mapped on the model
+event.listen(Feedback.__table__, 'after_create', DDL(
+    "ALTER TABLE feedback ADD COLUMN search_vector tsvector GENERATED ALWAYS AS "
+    "(setweight(to_tsvector('english', title), 'A') || setweight(to_tsvector('english', content), 'B')) STORED"
+).execute_if(dialect='postgresql'))
+event.listen(Feedback.__table__, 'after_create', DDL(
+    "CREATE INDEX ix_feedback_search_vector ON feedback USING GIN (search_vector)"
+).execute_if(dialect='postgresql'))
+
+class OutboundEmail(db.Model):
+
+    __tablename__ = "outbound_emails"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    subject = db.Column(db.Text, nullable=False)
+    sender = db.Column(db.Text, nullable=False)
+    recipients = db.Column(db.Text, nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(length=10), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_outbound_emails_status_next_attempt_at', 'status', 'next_attempt_at'),)
+
+class AccountDeletion(db.Model):
+    """Progress of a background account deletion, shared by every worker"""
+
+    __tablename__ = "account_deletions"
 
-    user = db.relationship('User', backref="feedback")
\ No newline at end of file
+    # no foreign key: the row outlives the user it describes
+    username = db.Column(db.Text, primary_key=True)
+    state = db.Column(db.String(length=10), nullable=False, default='running')
+    total = db.Column(db.Integer, nullable=False)
+    deleted = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
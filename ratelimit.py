@@ -0,0 +1,116 @@
+from threading import Lock
+import math
+import time
+from werkzeug.exceptions import TooManyRequests
+
+
+def sliding_count(prev, curr, now, window):
+    """weight the previous window's count by how much of it still overlaps the sliding window"""
+    overlap = 1 - (now % window) / window
+    return prev * overlap + curr
+
+
+class MemoryCounter:
+    """Sliding window counters kept in this process"""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.windows = {}
+        self._lock = Lock()
+
+    def hit(self, key, window, now):
+        """count one attempt for key and return the sliding window total including it"""
+        index = int(now // window)
+        with self._lock:
+            entry = self.windows.get(key)
+            if entry is None or entry[0] < index - 1:
+                entry = [index, 0, 0]
+            elif entry[0] == index - 1:
+                entry = [index, 0, entry[1]]
+            entry[1] += 1
+            self.windows[key] = entry
+            if len(self.windows) > self.max_keys:
+                self._evict(index)
+            return sliding_count(entry[2], entry[1], now, window)
+
+    def _evict(self, index):
+        for key in [key for key, entry in self.windows.items() if entry[0] < index - 1]:
+            del self.windows[key]
+
+    def reset(self):
+        with self._lock:
+            self.windows.clear()
+
+
+class RedisCounter:
+    """Sliding window counters on any client that speaks the Redis protocol, shared by every worker"""
+
+    def __init__(self, client, prefix='ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+
+    def hit(self, key, window, now):
+        """count one attempt for key and return the sliding window total including it"""
+        index = int(now // window)
+        pipe = self.client.pipeline()
+        pipe.incr(f'{self.prefix}{key}:{index}')
+        pipe.expire(f'{self.prefix}{key}:{index}', window * 2)
+        pipe.get(f'{self.prefix}{key}:{index - 1}')
+        curr, _, prev = pipe.execute()
+        return sliding_count(int(prev or 0), curr, now, window)
+
+    def reset(self):
+        for key in self.client.scan_iter(f'{self.prefix}*'):
+            self.client.delete(key)
+
+
+class LoginRateLimiter:
+    """Limits login attempts per username and per client IP
+
+    check() runs before any password is checked, so once a key is over its
+    budget the request is turned away with a 429 without touching bcrypt or
+    the database."""
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.counter = MemoryCounter()
+        self.username_limit = 10
+        self.ip_limit = 50
+        self.window = 60
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """read limits and the counter backend from the app config"""
+        self.enabled = app.config.get('LOGIN_RATE_LIMIT_ENABLED', True)
+        self.username_limit = app.config.get('LOGIN_RATE_LIMIT_USERNAME', 10)
+        self.ip_limit = app.config.get('LOGIN_RATE_LIMIT_IP', 50)
+        self.window = app.config.get('LOGIN_RATE_LIMIT_WINDOW', 60)
+        if app.config.get('LOGIN_RATE_LIMIT_BACKEND', 'memory') == 'redis':
+            client = app.config.get('LOGIN_RATE_LIMIT_REDIS')
+            if client is None:
+                import redis
+                client = redis.Redis.from_url(app.config.get('LOGIN_RATE_LIMIT_REDIS_URL', 'redis://localhost:6379/0'))
+            self.counter = RedisCounter(client)
+        else:
+            self.counter = MemoryCounter()
+
+    def check(self, username, ip):
+        """count a login attempt and raise TooManyRequests if the username or IP is over its limit"""
+        if not self.enabled:
+            return
+        now = time.time()
+        over = False
+        if username and self.counter.hit(f'user:{username.lower()}', self.window, now) > self.username_limit:
+            over = True
+        if ip and self.counter.hit(f'ip:{ip}', self.window, now) > self.ip_limit:
+            over = True
+        if over:
+            raise TooManyRequests(retry_after=math.ceil(self.window - now % self.window))
+
+    def reset(self):
+        """forget every counter"""
+        self.counter.reset()
+
+
+login_limiter = LoginRateLimiter()
@@ -0,0 +1,84 @@
+import random
+import time
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+def replica_reads(view):
+    """mark a view whose GET requests only read, so they may be served from a replica"""
+    view.replica_reads = True
+    return view
+
+
+class RoutingSession(Session):
+    """Session that sends reads during read-only requests to a replica; see ReadReplicas"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not getattr(clause, 'is_dml', False):
+            engine = read_replicas.engine_for_request(self._db)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReadReplicas:
+    """Routes read-only requests to replica databases
+
+    Each URL in SQLALCHEMY_REPLICA_URLS becomes a SQLAlchemy bind (replica0,
+    replica1, ...), so init_app runs before connect_db. GET and HEAD requests
+    to views marked with @replica_reads read from one replica picked per
+    request; everything else, including any write made during such a
+    request, goes to the primary. After a client writes, its session
+    remembers when, and for READ_REPLICA_STICKY_SECONDS its reads stay on the
+    primary so it sees its own changes despite replication lag."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.names = []
+        self.sticky_seconds = 5
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """add a bind per replica URL and the hooks that track writes"""
+        urls = app.config.get('SQLALCHEMY_REPLICA_URLS', [])
+        self.names = [f'replica{i}' for i in range(len(urls))]
+        self.enabled = bool(urls)
+        self.sticky_seconds = app.config.get('READ_REPLICA_STICKY_SECONDS', 5)
+        app.config['SQLALCHEMY_BINDS'] = {**app.config.get('SQLALCHEMY_BINDS', {}), **dict(zip(self.names, urls))}
+        if not event.contains(RoutingSession, 'after_flush', self._wrote):
+            event.listen(RoutingSession, 'after_flush', self._wrote)
+            event.listen(RoutingSession, 'do_orm_execute', self._orm_execute)
+        app.after_request(self._remember_write)
+
+    def _wrote(self, *args):
+        # with no replicas there is nothing to stick to the primary, so leave sessions alone
+        if self.enabled and has_request_context():
+            g._db_wrote = True
+
+    def _orm_execute(self, orm_execute_state):
+        if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+            self._wrote()
+
+    def _remember_write(self, response):
+        if g.pop('_db_wrote', False):
+            session['db_wrote_at'] = time.time()
+        return response
+
+    def engine_for_request(self, db):
+        """the replica engine for this request, or None to use the primary"""
+        if not self.enabled or not has_request_context() or request.method not in READ_METHODS:
+            return None
+        if not getattr(current_app.view_functions.get(request.endpoint), 'replica_reads', False):
+            return None
+        if g.get('_db_wrote') or time.time() - session.get('db_wrote_at', 0) < self.sticky_seconds:
+            return None
+        if '_replica' not in g:
+            g._replica = random.choice(self.names)
+        return db.engines.get(g._replica)
+
+
+read_replicas = ReadReplicas()
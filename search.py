@@ -0,0 +1,133 @@
+from collections import Counter, defaultdict
+from threading import Lock
+import math
+import re
+from sqlalchemy import event, func, literal_column
+from sqlalchemy.engine import Engine
+from models import db, Feedback
+
+TOKEN = re.compile(r'\w+')
+# ts_rank_cd's default weights for the A (title) and B (content) labels
+TITLE_WEIGHT = 1.0
+CONTENT_WEIGHT = 0.4
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+class InvertedIndex:
+    """Maps each term to the feedback ids containing it and a weighted term count"""
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.size = 0
+
+    def add(self, feedback_id, title, content):
+        weights = Counter()
+        for term in tokenize(title):
+            weights[term] += TITLE_WEIGHT
+        for term in tokenize(content):
+            weights[term] += CONTENT_WEIGHT
+        for term, weight in weights.items():
+            self.postings[term][feedback_id] = weight
+        self.size += 1
+
+    def search(self, query):
+        """return [(score, id)] for items containing every query term, best first"""
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        postings = sorted((self.postings.get(term, {}) for term in terms), key=len)
+        ids = set(postings[0]).intersection(*postings[1:])
+        # rarer terms count for more, like tf-idf
+        scores = [(sum(p[i] * math.log(1 + self.size / len(p)) for p in postings), i) for i in ids]
+        return sorted(scores, key=lambda score: (-score[0], score[1]))
+
+
+class FeedbackSearch:
+    """Ranked full-text search over feedback titles and content
+
+    On Postgres this queries the search_vector tsvector column (titles weighted
+    above content) through its GIN index and ranks with ts_rank_cd. Other
+    databases, such as SQLite in tests, get an in-memory inverted index built
+    from the table on first search and rebuilt after any write to feedback or
+    users, and again when that write is committed or rolled back."""
+
+    def __init__(self, app=None):
+        self.index = None
+        self.generation = 0
+        self.built = -1
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """watch for writes that make the in-memory index stale"""
+        if not event.contains(Engine, 'after_cursor_execute', self._after_cursor_execute):
+            event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(Engine, 'commit', self._end_transaction)
+            event.listen(Engine, 'rollback', self._end_transaction)
+        self.clear()
+
+    def _stale(self):
+        with self._lock:
+            self.generation += 1
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if conn.dialect.name == 'postgresql':
+            return
+        if statement.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+            lowered = statement.lower()
+            if 'feedback' in lowered or 'users' in lowered:
+                # stale now for this connection, and again once other connections can see the write or it's undone
+                conn.info['search_stale'] = True
+                self._stale()
+
+    def _end_transaction(self, conn):
+        if conn.info.pop('search_stale', False):
+            self._stale()
+
+    def clear(self):
+        """drop the in-memory index"""
+        with self._lock:
+            self.index = None
+            self.built = -1
+
+    def _build(self):
+        with self._lock:
+            generation = self.generation
+            if self.index is not None and self.built == generation:
+                return self.index
+        index = InvertedIndex()
+        for rows in Feedback.stream_rows():
+            for feedback_id, username, title, content in rows:
+                index.add(feedback_id, title, content)
+        with self._lock:
+            self.index = index
+            self.built = generation
+        return index
+
+    def search(self, query, page=1, per_page=20):
+        """return one page of matches as dicts with a rank, best first, and whether there are more pages"""
+        offset = (page - 1) * per_page
+        if db.session.get_bind().dialect.name == 'postgresql':
+            tsquery = func.websearch_to_tsquery(literal_column("'english'"), query)
+            vector = literal_column('feedback.search_vector')
+            rank = func.ts_rank_cd(vector, tsquery).label('rank')
+            stmt = (db.select(Feedback.id, Feedback.username, Feedback.title, Feedback.content, rank)
+                    .where(vector.op('@@')(tsquery))
+                    .order_by(rank.desc(), Feedback.id)
+                    .offset(offset)
+                    .limit(per_page + 1))
+            rows = [dict(row._mapping) for row in db.session.execute(stmt)]
+        else:
+            matches = self._build().search(query)[offset:offset + per_page + 1]
+            ranks = {feedback_id: score for score, feedback_id in matches}
+            stmt = db.select(Feedback.id, Feedback.username, Feedback.title, Feedback.content).where(Feedback.id.in_(ranks))
+            found = {row.id: dict(row._mapping, rank=ranks[row.id]) for row in db.session.execute(stmt)}
+            rows = [found[feedback_id] for score, feedback_id in matches if feedback_id in found]
+        return rows[:per_page], len(rows) > per_page
+
+
+feedback_search = FeedbackSearch()
@@ -0,0 +1,241 @@
+from collections import OrderedDict
+from threading import Lock
+import secrets
+import time
+from cachelib import FileSystemCache
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+serializer = TaggedJSONSerializer()
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """session dict whose contents live in a SessionStore, keyed by sid"""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        # who the session belonged to when it was loaded; the sid is replaced when that changes
+        self.loaded_username = self.get('username')
+
+
+class MemoryStore:
+    """In-process session store with LRU eviction. Only suitable for a single worker"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.sessions = OrderedDict()
+        self.users = {}
+        self.owners = {}
+        self._lock = Lock()
+
+    def _forget(self, sid):
+        """drop a removed session from its user's index. Call with the lock held"""
+        username = self.owners.pop(sid, None)
+        if username is not None:
+            sids = self.users.get(username)
+            sids.discard(sid)
+            if not sids:
+                del self.users[username]
+
+    def get(self, sid):
+        with self._lock:
+            entry = self.sessions.get(sid)
+            if entry is None:
+                return None
+            expires, data = entry
+            if expires < time.time():
+                del self.sessions[sid]
+                self._forget(sid)
+                return None
+            self.sessions.move_to_end(sid)
+            return data
+
+    def set(self, sid, data, ttl):
+        with self._lock:
+            self.sessions[sid] = (time.time() + ttl, data)
+            self.sessions.move_to_end(sid)
+            while len(self.sessions) > self.max_entries:
+                evicted, entry = self.sessions.popitem(last=False)
+                self._forget(evicted)
+
+    def delete(self, sid, username=None):
+        with self._lock:
+            self.sessions.pop(sid, None)
+            self._forget(sid)
+
+    def add_user_session(self, username, sid, ttl):
+        with self._lock:
+            if sid not in self.sessions:
+                return
+            self._forget(sid)
+            self.owners[sid] = username
+            self.users.setdefault(username, set()).add(sid)
+
+    def revoke_user(self, username):
+        with self._lock:
+            sids = self.users.pop(username, set())
+            for sid in sids:
+                self.sessions.pop(sid, None)
+                self.owners.pop(sid, None)
+            return len(sids)
+
+
+class FilesystemStore:
+    """Session store on local disk, shared by every worker on one machine"""
+
+    def __init__(self, cache_dir, threshold=10000):
+        self.cache = FileSystemCache(cache_dir, threshold=threshold)
+
+    def get(self, sid):
+        return self.cache.get(f'session:{sid}')
+
+    def set(self, sid, data, ttl):
+        self.cache.set(f'session:{sid}', data, timeout=ttl)
+
+    def delete(self, sid, username=None):
+        # the user index drops it on the next add_user_session
+        self.cache.delete(f'session:{sid}')
+
+    def add_user_session(self, username, sid, ttl):
+        # drop sessions that have expired, been evicted or were replaced at login
+        sids = [other for other in self.cache.get(f'user:{username}') or [] if self.cache.has(f'session:{other}')]
+        if sid not in sids:
+            sids.append(sid)
+        self.cache.set(f'user:{username}', sids, timeout=ttl)
+
+    def revoke_user(self, username):
+        sids = self.cache.get(f'user:{username}') or []
+        self.cache.delete_many(*[f'session:{sid}' for sid in sids])
+        self.cache.delete(f'user:{username}')
+        return len(sids)
+
+
+class RedisStore:
+    """Session store on any client that speaks the Redis protocol (redis-py, fakeredis)"""
+
+    def __init__(self, client, prefix='session:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, sid):
+        return self.client.get(f'{self.prefix}{sid}')
+
+    def set(self, sid, data, ttl):
+        self.client.set(f'{self.prefix}{sid}', data, ex=ttl)
+
+    def _members(self, key):
+        return [sid.decode() if isinstance(sid, bytes) else sid for sid in self.client.smembers(key)]
+
+    def delete(self, sid, username=None):
+        pipe = self.client.pipeline()
+        pipe.delete(f'{self.prefix}{sid}')
+        if username is not None:
+            pipe.srem(f'{self.prefix}user:{username}', sid)
+        pipe.execute()
+
+    def add_user_session(self, username, sid, ttl):
+        key = f'{self.prefix}user:{username}'
+        # drop sessions that have expired or were deleted without their username
+        others = [other for other in self._members(key) if other != sid]
+        pipe = self.client.pipeline()
+        for other in others:
+            pipe.exists(f'{self.prefix}{other}')
+        dead = [other for other, alive in zip(others, pipe.execute()) if not alive]
+        pipe = self.client.pipeline()
+        if dead:
+            pipe.srem(key, *dead)
+        pipe.sadd(key, sid)
+        pipe.expire(key, ttl)
+        pipe.execute()
+
+    def revoke_user(self, username):
+        key = f'{self.prefix}user:{username}'
+        sids = self._members(key)
+        self.client.delete(key, *[f'{self.prefix}{sid}' for sid in sids])
+        return len(sids)
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Keeps session data in a SessionStore and only a random session id in the cookie
+
+    Every session that belongs to a logged in user is indexed under the
+    username, so all of a user's sessions can be revoked at once. The sid is
+    replaced whenever the session's username changes, so an id handed out
+    before login is worthless after it (no session fixation)."""
+
+    session_class = ServerSideSession
+
+    def __init__(self, store, ttl=86400):
+        self.store = store
+        self.ttl = ttl
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.get(sid)
+            if data is not None:
+                return self.session_class(serializer.loads(data), sid=sid)
+        return self.session_class(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                self.store.delete(session.sid, session.loaded_username)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if session.get('username') != session.loaded_username:
+            if not session.new:
+                self.store.delete(session.sid, session.loaded_username)
+            session.sid = secrets.token_urlsafe(32)
+            session.loaded_username = session.get('username')
+        elif not self.should_set_cookie(app, session):
+            return
+        self.store.set(session.sid, serializer.dumps(dict(session)), self.ttl)
+        if session.get('username'):
+            self.store.add_user_session(session['username'], session.sid, self.ttl)
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+    def revoke_user(self, username):
+        """end every session belonging to username; returns how many were removed"""
+        return self.store.revoke_user(username)
+
+
+def make_store(app):
+    """build the session store named by SESSION_BACKEND, or None for signed cookie sessions"""
+    backend = app.config.get('SESSION_BACKEND', 'cookie')
+    if backend == 'memory':
+        return MemoryStore(app.config.get('SESSION_MAX_ENTRIES', 10000))
+    if backend == 'filesystem':
+        return FilesystemStore(app.config.get('SESSION_FILE_DIR', 'flask_session'), app.config.get('SESSION_MAX_ENTRIES', 10000))
+    if backend == 'redis':
+        client = app.config.get('SESSION_REDIS')
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(app.config.get('SESSION_REDIS_URL', 'redis://localhost:6379/0'))
+        return RedisStore(client)
+    return None
+
+
+def init_sessions(app):
+    """install the configured server-side session interface on the app"""
+    store = make_store(app)
+    if store is not None:
+        app.session_interface = ServerSideSessionInterface(store, app.config.get('SESSION_TTL', 86400))
+
+
+def revoke_user_sessions(app, username):
+    """end all of a user's sessions if the app uses server-side sessions"""
+    if isinstance(app.session_interface, ServerSideSessionInterface):
+        return app.session_interface.revoke_user(username)
+    return 0
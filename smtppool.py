@@ -0,0 +1,88 @@
+from contextlib import contextmanager
+from threading import Lock
+import time
+from flask import current_app
+from flask_mail import Connection
+
+
+class SMTPPool:
+    """Keeps SMTP connections open between sends
+
+    Opening a connection to smtp.gmail.com costs a TLS handshake and a login,
+    so idle connections are kept for up to max_idle seconds and checked with
+    NOOP before they are reused. At most size connections are kept idle."""
+
+    def __init__(self, app=None):
+        self.size = 2
+        self.max_idle = 60
+        self.idle = []
+        self.opened = 0
+        self._lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """read pool settings from the app config"""
+        self.size = app.config.get('MAIL_POOL_SIZE', 2)
+        self.max_idle = app.config.get('MAIL_POOL_MAX_IDLE', 60)
+        self.close_all()
+
+    def _open(self):
+        conn = Connection(current_app.extensions['mail'])
+        conn.__enter__()
+        with self._lock:
+            self.opened += 1
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.__exit__(None, None, None)
+        except Exception:
+            pass
+
+    def _alive(self, conn, last_used):
+        if time.monotonic() - last_used > self.max_idle:
+            return False
+        if conn.host is None:
+            # opened while sending was suppressed
+            return conn.mail.suppress
+        try:
+            return conn.host.noop()[0] == 250
+        except Exception:
+            return False
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self.idle:
+                    break
+                conn, last_used = self.idle.pop()
+            if self._alive(conn, last_used):
+                return conn
+            self._close(conn)
+        return self._open()
+
+    def _checkin(self, conn):
+        with self._lock:
+            if len(self.idle) < self.size:
+                self.idle.append((conn, time.monotonic()))
+                return
+        self._close(conn)
+
+    @contextmanager
+    def connection(self):
+        """borrow an open connection; it goes back to the pool unless sending raised"""
+        conn = self._checkout()
+        try:
+            yield conn
+        except Exception:
+            self._close(conn)
+            raise
+        self._checkin(conn)
+
+    def close_all(self):
+        """close every idle connection"""
+        with self._lock:
+            idle, self.idle = self.idle, []
+        for conn, last_used in idle:
+            self._close(conn)
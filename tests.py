@@ -1,42 +1,185 @@
 from unittest import TestCase
-from app import app, mail
-from models import db, User, Feedback, bcrypt
+from app import create_app, mail, mail_queue, deletions, send_password_reset_links
+from deletion import AccountDeletions
+from models import db, AuthResult, User, Feedback, OutboundEmail, AccountDeletion, bcrypt, hasher
+from hashing import PasswordHasher, HasherSaturated
+from werkzeug.exceptions import TooManyRequests
 from flask import session
-from sqlalchemy import update
-
-app.config['TESTING'] = True
-app.config['MAIL_SUPPRESS_SEND'] = False
-app.config['WTF_CSRF_ENABLED'] = False
+from sqlalchemy import create_engine, event, insert, text, update
+from sqlalchemy.engine import make_url
+from flask_sqlalchemy.session import Session
+from config import TestingConfig
+from contextlib import contextmanager
+import threading
+import os
+import tempfile
+import unittest
+from usercache import UserCache, user_cache
+import userimport
+from userimport import UserImport
+from search import InvertedIndex
+from dbpool import DatabasePool, TimedQueuePool, db_pool
+from replicas import read_replicas
+from asyncdb import async_db, async_url
+from asyncviews import ASYNC_VIEWS, async_views
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+import sqlite3
+from metrics import Metrics, metrics
+from ratelimit import LoginRateLimiter, MemoryCounter, RedisCounter, login_limiter
+from flask import Flask
+from sessions import ServerSideSessionInterface, MemoryStore, FilesystemStore, RedisStore, revoke_user_sessions
+from flask_mail import Mail, Message
+from mailqueue import MailQueue
+from datetime import datetime
+import time
+import socket
+import re
+import csv
+import io
+import json
+import asyncio
+import importlib.util
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:
+    Controller = None
+try:
+    import psycopg2.errors
+except ImportError:
+    psycopg2 = None
+
+def worker_database_url(suffix=''):
+    """TEST_DATABASE_URL, or a database of its own per worker when the suite runs in parallel with pytest -n
+    (pytest-xdist). suffix names a further database alongside it, such as a replica. Missing Postgres databases are created"""
+    url = make_url(TestingConfig.SQLALCHEMY_DATABASE_URI)
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+    suffix = f'_{worker}{suffix}' if worker else suffix
+    if not suffix:
+        return url.render_as_string(hide_password=False)
+    if url.get_backend_name() == 'sqlite':
+        root, ext = os.path.splitext(url.database)
+        return url.set(database=f'{root}{suffix}{ext}').render_as_string(hide_password=False)
+    url = url.set(database=f'{url.database}{suffix}')
+    engine = create_engine(url.set(database='postgres'), isolation_level='AUTOCOMMIT')
+    with engine.connect() as conn:
+        if not conn.execute(text('SELECT 1 FROM pg_database WHERE datname = :name'), {'name': url.database}).scalar():
+            conn.execute(text(f'CREATE DATABASE "{url.database}"'))
+    engine.dispose()
+    return url.render_as_string(hide_password=False)
+
+class SuiteConfig(TestingConfig):
+    MAIL_SUPPRESS_SEND = False
+    SQLALCHEMY_DATABASE_URI = worker_database_url()
+    # a second database standing in for a replica, without replication; ReadReplicaTestCase fills it
+    SQLALCHEMY_REPLICA_URLS = [worker_database_url('_replica')]
+
+app = create_app(SuiteConfig)
+app.app_context().push()
+# deliver inline so the view tests can read mail.record_messages(); MailQueueTestCase covers the queue
+mail_queue.enabled = False
+# every read from the primary, which the fixtures fill; ReadReplicaTestCase covers the routing
+read_replicas.enabled = False
+
+if db.engine.dialect.name == 'sqlite':
+    # pysqlite only opens a transaction before DML, so a SAVEPOINT released outside one would commit.
+    # Take over BEGIN so DatabaseTestCase's rollback really undoes each test
+    @event.listens_for(db.engine, 'connect')
+    def sqlite_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(db.engine, 'begin')
+    def sqlite_begin(conn):
+        # straight to the driver, so count_queries and /metrics don't see it
+        conn.connection.dbapi_connection.execute('BEGIN')
 
 db.drop_all()
 db.create_all()
-
-class FeedbackViewsTestCase(TestCase):
-    """Tests for app view functions"""
+replica_engine = db.engines['replica0']
+db.metadata.drop_all(replica_engine)
+db.metadata.create_all(replica_engine)
+
+# hashed once per run, at TestingConfig's cost
+FIXTURE_USERS = [
+    {'username': 'JaneDoe', 'password': hasher.generate_password_hash('secretsecret!'), 'email': 'janedoe@gmail.com',
+     'first_name': 'Jane', 'last_name': 'Doe', 'is_admin': False},
+    {'username': 'JohnDoe', 'password': hasher.generate_password_hash('secret2secret2!'), 'email': 'johndoe@gmail.com',
+     'first_name': 'John', 'last_name': 'Doe', 'is_admin': True},
+    {'username': 'CamdenTadhg', 'password': hasher.generate_password_hash('passwordpassword!'), 'email': 'camdent@gmail.com',
+     'first_name': 'Camden', 'last_name': 'Tadhg', 'is_admin': False},
+]
+FIXTURE_FEEDBACK = [
+    {'title': 'testing 1', 'content': 'This is the first test feedback', 'username': 'JaneDoe'},
+    {'title': 'testing 2', 'content': 'This is the second test feedback', 'username': 'JohnDoe'},
+]
+
+def load_fixtures():
+    """replace every row with the fixture users and feedback, and commit"""
+    OutboundEmail.query.delete()
+    AccountDeletion.query.delete()
+    Feedback.query.delete()
+    User.query.delete()
+    db.session.execute(insert(User), FIXTURE_USERS)
+    db.session.execute(insert(Feedback), FIXTURE_FEEDBACK)
+    db.session.commit()
+    user_cache.clear()
+
+load_fixtures()
+
+class TransactionSession(Session):
+    """a session that runs everything on the connection it was given, not the app's engine"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        return bind or self.bind
+
+class DatabaseTestCase(TestCase):
+    """Runs each test inside a transaction that is rolled back afterwards. Commits by the code under test only
+    release SAVEPOINTs, so the fixtures loaded once at import are back for every test.
+    Subclasses that override setUp or tearDown call these too"""
 
     def setUp(self):
-        """Add sample users and feedback"""
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.app_session = db.session
+        db.session.remove()
+        db.session = db._make_scoped_session({'class_': TransactionSession, 'bind': self.connection,
+                                              'join_transaction_mode': 'create_savepoint'})
+        user_cache.clear()
 
-        Feedback.query.delete()
-        User.query.delete()
+    def tearDown(self):
+        db.session.remove()
+        db.session = self.app_session
+        self.transaction.rollback()
+        self.connection.close()
+        user_cache.clear()
+
+# transaction control from DatabaseTestCase, not the code being measured
+TRANSACTION_STATEMENTS = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+@contextmanager
+def count_queries():
+    """count the SQL statements run inside the block"""
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not statement.startswith(TRANSACTION_STATEMENTS):
+            statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+class FeedbackViewsTestCase(DatabaseTestCase):
+    """Tests for app view functions"""
 
-        user1 = User.register(username="JaneDoe", pwd="secretsecret!", email="janedoe@gmail.com", first_name = "Jane", last_name="Doe")
-        db.session.add(user1)
-        user2 = User.register(username="JohnDoe", pwd="secret2secret2!", email="johndoe@gmail.com", first_name="John", last_name="Doe")
-        db.session.add(user2)
-        user3 = User.register(username="CamdenTadhg", pwd="passwordpassword!", email="camdent@gmail.com", first_name="Camden", last_name="Tadhg")
-        db.session.add(user3)
-        db.session.commit()
-        stmt = update(User).where(User.username == "JohnDoe").values(is_admin=True)
-        db.session.execute(stmt)
-        db.session.commit()
-        
+    def setUp(self):
+        """Start from the fixture users and feedback"""
 
-        feedback1 = Feedback(title="testing 1", content="This is the first test feedback", username= 'JaneDoe')
-        feedback2 = Feedback(title="testing 2", content="This is the second test feedback", username='JohnDoe')
-        db.session.add(feedback1)
-        db.session.add(feedback2)
-        db.session.commit()
+        super().setUp()
+        login_limiter.reset()
 
     def tearDown(self):
         """Clean up any fouled transactions and clear session and outbox"""
@@ -49,7 +192,7 @@ class FeedbackViewsTestCase(TestCase):
             with mail.record_messages() as outbox: 
                 if outbox:
                     outbox.pop()
-        db.session.rollback()
+        super().tearDown()
     
     def test_display_home_unlogged(self):
         with app.test_client() as client:
@@ -239,6 +382,32 @@ class FeedbackViewsTestCase(TestCase):
             self.assertIn("invalid password", html)
             self.assertFalse(session.get('username'))
 
+    def test_login_rate_limited(self):
+        login_limiter.username_limit = 2
+        try:
+            with app.test_client() as client:
+                client.post('/login', data={"username": "JaneDoe", "password": "wrongwrong!"})
+                client.post('/login', data={"username": "JaneDoe", "password": "wrongwrong!"})
+                hasher.reset_stats()
+                with count_queries() as statements:
+                    resp = client.post('/login', data={"username": "JaneDoe", "password": "secretsecret!"})
+
+                self.assertEqual(resp.status_code, 429)
+                self.assertIn('Retry-After', resp.headers)
+                self.assertEqual(statements, [])
+                self.assertEqual(hasher.stats()['check']['count'], 0)
+                self.assertFalse(session.get('username'))
+        finally:
+            login_limiter.username_limit = 10
+
+    def test_login_user_failure_one_query(self):
+        with app.test_client() as client:
+            with count_queries() as statements:
+                client.post('/login', data={"username": "JaneCDoe", "password": "passwordpassword!"})
+                client.post('/login', data={"username": "JaneDoe", "password": "passwordpassword"})
+
+            self.assertEqual(len(statements), 2)
+
     def test_logout(self):
         with app.test_client() as client:
             with client.session_transaction() as change_session:
@@ -342,6 +511,121 @@ class FeedbackViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('Email not in database', html)
     
+    def request_reset_token(self, client):
+        """request a reset link for camdent@gmail.com and return the token from the email"""
+        with mail.record_messages() as outbox:
+            client.post('/passwordreset', data={'email': 'camdent@gmail.com'})
+        return re.search(r'prt=([\w.-]+)', outbox[0].html).group(1)
+
+    def test_reset_password_stores_hash(self):
+        with app.test_client() as client:
+            prt = self.request_reset_token(client)
+            camden = db.session.execute(db.select(User).where(User.email == 'camdent@gmail.com')).scalar()
+
+            self.assertNotEqual(camden.password_reset_token, prt)
+            self.assertEqual(camden.password_reset_token, User.hash_password_reset_token(prt))
+            self.assertGreater(camden.password_reset_expires_at, datetime.utcnow())
+
+    def test_update_password_expired_token(self):
+        with app.test_client() as client:
+            prt = self.request_reset_token(client)
+            db.session.execute(update(User).where(User.username == 'CamdenTadhg').values(password_reset_expires_at=datetime(2000, 1, 1)))
+            db.session.commit()
+            resp = client.get(f'/updatepassword?prt={prt}&email=camdent@gmail.com', follow_redirects=True)
+            html = resp.get_data(as_text=True)
+
+            self.assertIn('Unauthorized password', html)
+
+    def test_update_password_post_bad_token(self):
+        with app.test_client() as client:
+            prt = self.request_reset_token(client)
+            resp = client.post(f'/updatepassword?prt=1{prt}&email=camdent@gmail.com', data={'password':'newpassword!', 'password2': 'newpassword!'})
+
+            self.assertEqual(resp.location, '/')
+            self.assertFalse(User.authenticate('CamdenTadhg', 'newpassword!'))
+
+    def test_signed_reset_token_flow(self):
+        app.config['PASSWORD_RESET_MODE'] = 'signed'
+        try:
+            with app.test_client() as client:
+                with count_queries() as statements:
+                    prt = self.request_reset_token(client)
+
+                self.assertFalse([s for s in statements if s.startswith('UPDATE')])
+                resp = client.get(f'/updatepassword?prt={prt}&email=camdent@gmail.com')
+                self.assertIn('Update Password', resp.get_data(as_text=True))
+
+                resp = client.post(f'/updatepassword?prt={prt}&email=camdent@gmail.com', data={'password':'newpassword!', 'password2': 'newpassword!'})
+                self.assertEqual(resp.location, '/login')
+                self.assertTrue(User.authenticate('CamdenTadhg', 'newpassword!'))
+
+                # the token dies with the old password
+                resp = client.get(f'/updatepassword?prt={prt}&email=camdent@gmail.com', follow_redirects=True)
+                self.assertIn('Unauthorized password', resp.get_data(as_text=True))
+        finally:
+            app.config['PASSWORD_RESET_MODE'] = 'database'
+
+    def test_signed_reset_token_tampered(self):
+        app.config['PASSWORD_RESET_MODE'] = 'signed'
+        try:
+            with app.test_client() as client:
+                prt = self.request_reset_token(client)
+                resp = client.get(f'/updatepassword?prt={prt}x&email=camdent@gmail.com', follow_redirects=True)
+
+                self.assertIn('Unauthorized password', resp.get_data(as_text=True))
+        finally:
+            app.config['PASSWORD_RESET_MODE'] = 'database'
+
+    def test_send_password_reset_links(self):
+        with mail.record_messages() as outbox:
+            sent = send_password_reset_links(['camdent@gmail.com', 'janedoe@gmail.com', 'nobody@gmail.com'])
+
+            self.assertEqual(sent, 2)
+            self.assertEqual(len(outbox), 2)
+            for msg in outbox:
+                user = db.session.execute(db.select(User).where(User.email == msg.recipients[0])).scalar()
+                prt = re.search(r'prt=(\w+)', msg.html).group(1)
+                self.assertEqual(User.hash_password_reset_token(prt), user.password_reset_token)
+                self.assertIn(f'&email={user.email}', msg.html)
+                self.assertNotIn('__PRT__', msg.html)
+
+    def test_update_password_single_update(self):
+        with app.test_client() as client:
+            prt = self.request_reset_token(client)
+            with count_queries() as statements:
+                client.post(f'/updatepassword?prt={prt}&email=camdent@gmail.com', data={'password':'newpassword!', 'password2': 'newpassword!'})
+
+            updates = [s for s in statements if s.startswith('UPDATE')]
+            self.assertEqual(len(updates), 1)
+            camden = db.session.execute(db.select(User).where(User.username == 'CamdenTadhg')).scalar()
+            self.assertIsNone(camden.password_reset_token)
+            self.assertTrue(User.authenticate('CamdenTadhg', 'newpassword!'))
+
+    def test_update_password_hasher_saturated(self):
+        with app.test_client() as client:
+            prt = self.request_reset_token(client)
+            hasher._start()
+            taken = 0
+            while hasher.slots.acquire(blocking=False):
+                taken += 1
+            try:
+                resp = client.post(f'/updatepassword?prt={prt}&email=camdent@gmail.com', data={'password':'newpassword!', 'password2': 'newpassword!'})
+            finally:
+                for i in range(taken):
+                    hasher.slots.release()
+
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers['Retry-After'], str(hasher.retry_after))
+
+    def test_update_password_token_single_use(self):
+        with app.test_client() as client:
+            prt = self.request_reset_token(client)
+            client.post(f'/updatepassword?prt={prt}&email=camdent@gmail.com', data={'password':'newpassword!', 'password2': 'newpassword!'})
+            resp = client.post(f'/updatepassword?prt={prt}&email=camdent@gmail.com', data={'password':'otherpassword!', 'password2': 'otherpassword!'})
+
+            self.assertEqual(resp.location, '/')
+            self.assertFalse(User.authenticate('CamdenTadhg', 'otherpassword!'))
+
     def test_update_password_loggedin(self):
         with app.test_client() as client:
             with client.session_transaction() as change_session:
@@ -368,9 +652,8 @@ class FeedbackViewsTestCase(TestCase):
 
     def test_update_password_get(self):
         with app.test_client() as client:
-            client.post('/passwordreset', data={'email': 'camdent@gmail.com'})
-            camden = db.session.execute(db.select(User).where(User.email == 'camdent@gmail.com')).scalar()
-            resp = client.get(f'/updatepassword?prt={camden.password_reset_token}&email=camdent@gmail.com')
+            prt = self.request_reset_token(client)
+            resp = client.get(f'/updatepassword?prt={prt}&email=camdent@gmail.com')
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -378,9 +661,8 @@ class FeedbackViewsTestCase(TestCase):
 
     def test_update_password_unmatched_passwords(self):
         with app.test_client() as client:
-            client.post('/passwordreset', data={'email': 'camdent@gmail.com'})
-            camden = db.session.execute(db.select(User).where(User.email == 'camdent@gmail.com')).scalar()
-            resp = client.post(f'/updatepassword?prt=1{camden.password_reset_token}&email=camdent@gmail.com', data={'password':'sasdghwoiwg!', 'password2': 'kjhaskhagi!'})
+            prt = self.request_reset_token(client)
+            resp = client.post(f'/updatepassword?prt={prt}&email=camdent@gmail.com', data={'password':'sasdghwoiwg!', 'password2': 'kjhaskhagi!'})
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -388,18 +670,16 @@ class FeedbackViewsTestCase(TestCase):
 
     def test_update_password_correct(self):
         with app.test_client() as client:
-            client.post('/passwordreset', data={'email': 'camdent@gmail.com'})
-            camden = db.session.execute(db.select(User).where(User.email == 'camdent@gmail.com')).scalar()
-            resp = client.post(f'/updatepassword?prt=1{camden.password_reset_token}&email=camdent@gmail.com', data={'password':'passwordpassword!', 'password2': 'passwordpassword!'})
+            prt = self.request_reset_token(client)
+            resp = client.post(f'/updatepassword?prt={prt}&email=camdent@gmail.com', data={'password':'passwordpassword!', 'password2': 'passwordpassword!'})
 
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(resp.location, '/login')
 
     def test_update_password_correct_redirect(self):
         with app.test_client() as client:
-            client.post('/passwordreset', data={'email': 'camdent@gmail.com'})
-            camden = db.session.execute(db.select(User).where(User.email == 'camdent@gmail.com')).scalar()
-            resp = client.post(f'/updatepassword?prt=1{camden.password_reset_token}&email=camdent@gmail.com', data={'password':'passwordpassword!', 'password2': 'passwordpassword!'}, follow_redirects=True)
+            prt = self.request_reset_token(client)
+            resp = client.post(f'/updatepassword?prt={prt}&email=camdent@gmail.com', data={'password':'passwordpassword!', 'password2': 'passwordpassword!'}, follow_redirects=True)
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -535,6 +815,49 @@ class FeedbackViewsTestCase(TestCase):
             self.assertIn('Delete Account', html)
             self.assertIn('fa-trash', html)
             self.assertIn('testing 1', html)
+
+    def test_display_user_paginated(self):
+        for i in range(5):
+            db.session.add(Feedback(title=f"page test {i}", content="paginated", username='JaneDoe'))
+        db.session.commit()
+        app.config['FEEDBACK_PAGE_SIZE'] = 2
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as change_session:
+                    change_session['username'] = 'JaneDoe'
+                resp = client.get('/user/JaneDoe')
+                html = resp.get_data(as_text=True)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('testing 1', html)
+                self.assertIn('page test 0', html)
+                self.assertNotIn('page test 1', html)
+                self.assertIn('Next', html)
+                self.assertNotIn('Previous', html)
+
+                ids = [f.id for f in db.session.execute(db.select(Feedback).where(Feedback.username == 'JaneDoe').order_by(Feedback.id)).scalars()]
+                resp = client.get(f'/user/JaneDoe?after={ids[1]}')
+                html = resp.get_data(as_text=True)
+
+                self.assertIn('page test 1', html)
+                self.assertIn('page test 2', html)
+                self.assertNotIn('testing 1', html)
+                self.assertIn('Previous', html)
+
+                # a cursor before the first item is still the first page
+                html = client.get('/user/JaneDoe?after=0').get_data(as_text=True)
+
+                self.assertIn('testing 1', html)
+                self.assertNotIn('Previous', html)
+
+                resp = client.get(f'/user/JaneDoe?before={ids[2]}')
+                html = resp.get_data(as_text=True)
+
+                self.assertIn('testing 1', html)
+                self.assertIn('page test 0', html)
+                self.assertNotIn('Previous', html)
+        finally:
+            app.config['FEEDBACK_PAGE_SIZE'] = 20
     
     def test_delete_user_loggedout(self):
         with app.test_client() as client:
@@ -613,6 +936,114 @@ class FeedbackViewsTestCase(TestCase):
             self.assertEqual(session['username'], 'JohnDoe')
             self.assertEqual(session['admin'], True)
 
+    def test_display_user_cached(self):
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session['username'] = 'JaneDoe'
+            client.get('/user/JaneDoe')
+            client.get('/user/JaneDoe')
+
+            self.assertEqual(user_cache.stats()['misses'], 1)
+            self.assertEqual(user_cache.stats()['hits'], 1)
+
+    def test_delete_user_invalidates_cache(self):
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session['username'] = 'JaneDoe'
+            client.get('/user/JaneDoe')
+            client.post('/user/JaneDoe/delete')
+            with client.session_transaction() as change_session:
+                change_session['username'] = 'JohnDoe'
+            resp = client.get('/user/JaneDoe')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("We're sorry", html)
+
+    def test_delete_user_removes_feedback(self):
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session['username'] = 'JaneDoe'
+            client.post('/user/JaneDoe/delete')
+
+            self.assertIsNone(User.query.get('JaneDoe'))
+            self.assertEqual(Feedback.count_for_user('JaneDoe'), 0)
+            self.assertEqual(Feedback.count_for_user('JohnDoe'), 1)
+
+    def test_delete_user_background(self):
+        for i in range(5):
+            db.session.add(Feedback(title=f"bulk {i}", content="bulk", username='JaneDoe'))
+        db.session.commit()
+        deletions.threshold = 3
+        deletions.batch_size = 2
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as change_session:
+                    change_session['username'] = 'JohnDoe'
+                    change_session['admin'] = True
+                resp = client.post('/user/JaneDoe/delete', follow_redirects=True)
+                html = resp.get_data(as_text=True)
+
+                self.assertIn('Account deletion started', html)
+                deletions.wait('JaneDoe', 10)
+                resp = client.get('/user/JaneDoe/delete/status')
+
+                self.assertEqual(resp.json['state'], 'done')
+                self.assertEqual(resp.json['total'], 6)
+                self.assertEqual(resp.json['deleted'], 6)
+                # the progress is in the database, so another worker reports the same
+                self.assertEqual(AccountDeletions().status('JaneDoe'), resp.json)
+        finally:
+            deletions.threshold = 10000
+            deletions.batch_size = 1000
+        db.session.expire_all()
+        self.assertIsNone(User.query.get('JaneDoe'))
+        self.assertEqual(Feedback.count_for_user('JaneDoe'), 0)
+
+    def test_delete_own_account_background(self):
+        for i in range(5):
+            db.session.add(Feedback(title=f"bulk {i}", content="bulk", username='JaneDoe'))
+        db.session.commit()
+        deletions.threshold = 3
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as change_session:
+                    change_session['username'] = 'JaneDoe'
+                html = client.post('/user/JaneDoe/delete', follow_redirects=True).get_data(as_text=True)
+                status_url = re.search(r'/user/JaneDoe/delete/status\?token=[\w.-]+', html).group(0)
+                deletions.wait('JaneDoe', 10)
+
+                self.assertNotIn('username', session)
+                self.assertEqual(client.get(status_url).json['state'], 'done')
+                self.assertIsNone(client.get('/user/JaneDoe/delete/status').json)
+                self.assertIsNone(client.get(status_url.replace('JaneDoe', 'JohnDoe')).json)
+        finally:
+            deletions.threshold = 10000
+
+    def test_delete_user_background_restarts_stale_job(self):
+        # a deletion another worker is running, then one whose worker died
+        db.session.add(AccountDeletion(username='JaneDoe', state='running', total=1))
+        db.session.commit()
+        deletions.threshold = 0
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as change_session:
+                    change_session['username'] = 'JohnDoe'
+                    change_session['admin'] = True
+                client.post('/user/JaneDoe/delete')
+                self.assertEqual(deletions.status('JaneDoe')['total'], 1)
+                self.assertIsNotNone(User.query.get('JaneDoe'))
+
+                db.session.execute(update(AccountDeletion).values(updated_at=datetime(2000, 1, 1)))
+                db.session.commit()
+                client.post('/user/JaneDoe/delete')
+                deletions.wait('JaneDoe', 10)
+
+                self.assertEqual(client.get('/user/JaneDoe/delete/status').json['state'], 'done')
+        finally:
+            deletions.threshold = 10000
+        db.session.expire_all()
+        self.assertIsNone(User.query.get('JaneDoe'))
+
     def test_add_feedback_loggedout_get(self):
         with app.test_client() as client:
             resp = client.get('/user/JaneDoe/feedback/add')
@@ -771,6 +1202,32 @@ class FeedbackViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('testing 1', html)
     
+    def test_update_feedback_get_one_query(self):
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session['username'] = 'JaneDoe'
+            test_feedback = db.session.execute(db.select(Feedback).where(Feedback.title == "testing 1")).scalar()
+            with count_queries() as statements:
+                resp = client.get(f'/feedback/{test_feedback.id}/update')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(statements), 1)
+
+    def test_update_feedback_get_lazy_loader(self):
+        Feedback.user_loader = 'select'
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as change_session:
+                    change_session['username'] = 'JaneDoe'
+                test_feedback = db.session.execute(db.select(Feedback).where(Feedback.title == "testing 1")).scalar()
+                with count_queries() as statements:
+                    resp = client.get(f'/feedback/{test_feedback.id}/update')
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(len(statements), 2)
+        finally:
+            Feedback.user_loader = 'joined'
+
     def test_update_feedback_get_wrong_user(self):
         with app.test_client() as client:
             with client.session_transaction() as change_session:
@@ -858,6 +1315,17 @@ class FeedbackViewsTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('You must be logged in', html)
 
+    def test_delete_feedback_queries(self):
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session['username'] = 'JaneDoe'
+            test_feedback = db.session.execute(db.select(Feedback).where(Feedback.title == "testing 1")).scalar()
+            with count_queries() as statements:
+                resp = client.post(f'/feedback/{test_feedback.id}/delete')
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(len([s for s in statements if s.startswith('SELECT')]), 1)
+
     def test_delete_feedback_nofeedback(self):
         with app.test_client() as client:
             resp = client.post('/feedback/10000/delete')
@@ -922,24 +1390,19 @@ class FeedbackViewsTestCase(TestCase):
             self.assertNotIn('testing 1', html)
 
 
-class UserModelTestCase(TestCase):
+class UserModelTestCase(DatabaseTestCase):
     """Tests for the methods on the User model"""
 
     def setUp(self):
-        """Clean up any existing users"""
+        """Replace the fixtures with one user"""
 
+        super().setUp()
         Feedback.query.delete()
         User.query.delete()
 
         user = User.register(username="JaneDoe", pwd="secret", email="janedoe@gmail.com", first_name="Jane", last_name="Doe")
         db.session.add(user)
         db.session.commit()
-
-
-    def tearDown(self):
-        """Clean up any fouled transactions"""
-
-        db.session.rollback()
     
     def test_full_name(self):
         user = User.query.get('JaneDoe')
@@ -954,14 +1417,29 @@ class UserModelTestCase(TestCase):
         self.assertEqual(user.first_name, 'Jane')
     
     def test_authenticate_correct(self):
-        user = User.authenticate('JaneDoe', 'secret')
+        result = User.authenticate('JaneDoe', 'secret')
 
-        self.assertIsInstance(user, User)
-        self.assertEqual(user.first_name, 'Jane')
+        self.assertTrue(result)
+        self.assertEqual(result.status, AuthResult.OK)
+        self.assertIsInstance(result.user, User)
+        self.assertEqual(result.user.first_name, 'Jane')
 
     def test_authenticate_incorrect(self):
+        result = User.authenticate('JaneDoe', 'secret2')
+
+        self.assertFalse(result)
+        self.assertEqual(result.status, AuthResult.BAD_PASSWORD)
+        self.assertIsNone(result.user)
 
-        self.assertEqual(User.authenticate('JaneDoe', 'secret2'), False)
+    def test_authenticate_unknown_user(self):
+        hasher.reset_stats()
+        with count_queries() as statements:
+            result = User.authenticate('JohnDoe', 'secret')
+
+        self.assertFalse(result)
+        self.assertEqual(result.status, AuthResult.UNKNOWN_USER)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(hasher.stats()['check']['count'], 1)
     
     def test_get_password_reset_token(self):
         user = db.session.execute(db.select(User).where(User.username == 'JaneDoe')).scalar()
@@ -969,13 +1447,1021 @@ class UserModelTestCase(TestCase):
 
         self.assertEqual(len(prt), 32)
     
-    def test_update_password(self):
+    def test_from_password_reset_token(self):
         user = db.session.execute(db.select(User).where(User.username == 'JaneDoe')).scalar()
-        oldpassword = user.password
-        stmt = user.update_password('passwordpassword!', 'janedoe@gmail.com')
-        db.session.execute(stmt)
+        prt = user.issue_password_reset_token(60)
         db.session.commit()
-        user2 = db.session.execute(db.select(User).where(User.username == 'JaneDoe')).scalar()
-        newpassword = user2.password
 
-        self.assertNotEqual(oldpassword, newpassword)
\ No newline at end of file
+        self.assertEqual(User.from_password_reset_token(prt).username, 'JaneDoe')
+        self.assertIsNone(User.from_password_reset_token(prt + '1'))
+        self.assertIsNone(User.from_password_reset_token(None))
+
+    def test_purge_expired_reset_tokens(self):
+        user = db.session.execute(db.select(User).where(User.username == 'JaneDoe')).scalar()
+        prt = user.issue_password_reset_token(-1)
+        db.session.commit()
+
+        self.assertEqual(User.purge_expired_reset_tokens(), 1)
+        user = db.session.execute(db.select(User).where(User.username == 'JaneDoe')).scalar()
+        self.assertIsNone(user.password_reset_token)
+        self.assertIsNone(User.from_password_reset_token(prt))
+
+    def test_consume_password_reset_token(self):
+        user = db.session.execute(db.select(User).where(User.username == 'JaneDoe')).scalar()
+        prt = user.issue_password_reset_token(60)
+        db.session.commit()
+
+        self.assertEqual(User.consume_password_reset_token(prt, 'passwordpassword!'), 'JaneDoe')
+        db.session.commit()
+        self.assertIsNone(User.consume_password_reset_token(prt, 'otherpassword!'))
+        self.assertTrue(User.authenticate('JaneDoe', 'passwordpassword!'))
+
+
+class SlowBcrypt:
+    """stand-in for Bcrypt that blocks until released"""
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def generate_password_hash(self, pwd, rounds=None):
+        self.release.wait(5)
+        return b'hashed'
+
+
+class PasswordHasherTestCase(DatabaseTestCase):
+    """Tests for the bounded password hashing pool"""
+
+    def test_hash_and_check(self):
+        pool = PasswordHasher(bcrypt)
+        hashed = pool.generate_password_hash('secretsecret!')
+
+        self.assertTrue(pool.check_password_hash(hashed, 'secretsecret!'))
+        self.assertFalse(pool.check_password_hash(hashed, 'wrongwrong!'))
+        stats = pool.stats()
+        self.assertEqual(stats['hash']['count'], 1)
+        self.assertEqual(stats['check']['count'], 2)
+        pool.shutdown()
+
+    def test_saturated(self):
+        slow = SlowBcrypt()
+        pool = PasswordHasher(slow)
+        pool.max_workers = 1
+        pool.queue_size = 0
+        pool.retry_after = 3
+        worker = threading.Thread(target=pool.generate_password_hash, args=('secret',))
+        worker.start()
+        while pool.slots is None or pool.slots._value:
+            pass
+
+        with self.assertRaises(HasherSaturated) as cm:
+            pool.generate_password_hash('secret')
+        self.assertEqual(cm.exception.code, 503)
+        self.assertEqual(cm.exception.get_headers()[-1], ('Retry-After', '3'))
+        self.assertEqual(pool.stats()['rejected'], 1)
+        slow.release.set()
+        worker.join()
+        pool.shutdown()
+
+    def test_register_uses_pool(self):
+        hasher.reset_stats()
+        User.register(username="Superman", pwd="supermansuperman!", email="superman@gmail.com", first_name="Super", last_name="Man")
+
+        self.assertEqual(hasher.stats()['hash']['count'], 1)
+
+    def test_rehash_on_login(self):
+        Feedback.query.delete()
+        User.query.delete()
+        hasher.log_rounds = 4
+        user = User.register(username="Superman", pwd="supermansuperman!", email="superman@gmail.com", first_name="Super", last_name="Man")
+        db.session.add(user)
+        db.session.commit()
+        self.assertTrue(user.password.startswith('$2b$04$'))
+
+        hasher.log_rounds = 5
+        try:
+            self.assertTrue(User.authenticate('Superman', 'supermansuperman!'))
+        finally:
+            hasher.log_rounds = app.config['BCRYPT_LOG_ROUNDS']
+        user = User.query.get('Superman')
+        self.assertTrue(user.password.startswith('$2b$05$'))
+        self.assertTrue(hasher.check_password_hash(user.password, 'supermansuperman!'))
+
+
+class ServerSideSessionTestCase(TestCase):
+    """Tests for the server-side session stores"""
+
+    def setUp(self):
+        self.cookie_interface = app.session_interface
+
+    def tearDown(self):
+        app.session_interface = self.cookie_interface
+
+    def check_store(self, store):
+        store.set('abc', b'data', 60)
+        store.add_user_session('JaneDoe', 'abc', 60)
+        store.set('def', b'more', 60)
+        store.add_user_session('JaneDoe', 'def', 60)
+
+        self.assertEqual(store.get('abc'), b'data')
+        self.assertEqual(store.revoke_user('JaneDoe'), 2)
+        self.assertIsNone(store.get('abc'))
+        self.assertIsNone(store.get('def'))
+
+    def test_memory_store(self):
+        self.check_store(MemoryStore())
+
+    def test_memory_store_lru(self):
+        store = MemoryStore(max_entries=2)
+        store.set('a', b'1', 60)
+        store.set('b', b'2', 60)
+        store.get('a')
+        store.set('c', b'3', 60)
+
+        self.assertEqual(store.get('a'), b'1')
+        self.assertIsNone(store.get('b'))
+
+    def test_memory_store_ttl(self):
+        store = MemoryStore()
+        store.set('a', b'1', -1)
+
+        self.assertIsNone(store.get('a'))
+
+    def test_memory_store_prunes_user_index(self):
+        store = MemoryStore(max_entries=1)
+        store.set('a', b'1', 60)
+        store.add_user_session('JaneDoe', 'a', 60)
+        store.set('b', b'2', -1)
+        store.add_user_session('JohnDoe', 'b', 60)
+
+        self.assertNotIn('JaneDoe', store.users)
+        self.assertIsNone(store.get('b'))
+        self.assertEqual(store.users, {})
+        self.assertEqual(store.owners, {})
+
+    def test_filesystem_store(self):
+        self.check_store(FilesystemStore(tempfile.mkdtemp()))
+
+    @unittest.skipUnless(fakeredis, 'fakeredis is not installed')
+    def test_redis_store(self):
+        self.check_store(RedisStore(fakeredis.FakeRedis()))
+
+    @unittest.skipUnless(fakeredis, 'fakeredis is not installed')
+    def test_redis_store_prunes_user_index(self):
+        store = RedisStore(fakeredis.FakeRedis())
+        for sid in 'abc':
+            store.set(sid, b'1', 60)
+            store.add_user_session('JaneDoe', sid, 60)
+        # replaced at login, then expired
+        store.delete('a', 'JaneDoe')
+        store.client.delete('session:b')
+        store.set('d', b'2', 60)
+        store.add_user_session('JaneDoe', 'd', 60)
+
+        self.assertEqual(store.client.smembers('session:user:JaneDoe'), {b'c', b'd'})
+        self.assertEqual(store.revoke_user('JaneDoe'), 2)
+
+    def test_login_replaces_sid(self):
+        store = MemoryStore()
+        app.session_interface = ServerSideSessionInterface(store)
+        with app.test_client() as client:
+            # an anonymous visitor with something in their session, e.g. a flash
+            with client.session_transaction() as change_session:
+                change_session['_flashes'] = [('primary', 'Hello')]
+            anonymous_sid = client.get_cookie('session').value
+            client.post('/login', data={"username": "JaneDoe", "password": "secretsecret!"})
+            sid = client.get_cookie('session').value
+
+            self.assertNotEqual(sid, anonymous_sid)
+            self.assertIsNone(store.get(anonymous_sid))
+            self.assertEqual(store.users, {'JaneDoe': {sid}})
+            client.set_cookie('session', anonymous_sid)
+            self.assertIn('Please login', client.get('/').get_data(as_text=True))
+        db.session.rollback()
+
+    def test_revoke_user_sessions(self):
+        app.session_interface = ServerSideSessionInterface(MemoryStore())
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session['username'] = 'JaneDoe'
+            resp = client.get('/')
+            self.assertIn('My Account', resp.get_data(as_text=True))
+
+            self.assertEqual(revoke_user_sessions(app, 'JaneDoe'), 1)
+            resp = client.get('/')
+            self.assertIn('Please login', resp.get_data(as_text=True))
+
+
+class UserCacheTestCase(DatabaseTestCase):
+    """Tests for the read-through user cache"""
+
+    def setUp(self):
+        super().setUp()
+        self.cache = UserCache()
+
+    def test_read_through(self):
+        user = self.cache.get('JaneDoe')
+        cached = self.cache.get('JaneDoe')
+
+        self.assertEqual(user.email, 'janedoe@gmail.com')
+        self.assertEqual(cached.fullname, 'Jane Doe')
+        self.assertIsNone(cached.password)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_missing_user(self):
+        self.assertIsNone(self.cache.get('Nobody'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_lru_eviction(self):
+        self.cache.max_entries = 1
+        self.cache.put(User(username='a', email='a', first_name='a', last_name='a', is_admin=False))
+        self.cache.get('JaneDoe')
+
+        self.assertNotIn('a', self.cache.entries)
+        self.assertIn('JaneDoe', self.cache.entries)
+
+    def test_ttl_expiry(self):
+        self.cache.ttl = -1
+        self.cache.get('JaneDoe')
+        self.cache.get('JaneDoe')
+
+        self.assertEqual(self.cache.stats()['hits'], 0)
+
+    def test_invalidate(self):
+        self.cache.get('JaneDoe')
+        self.cache.invalidate('JaneDoe')
+
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+
+class RecordingHandler:
+    """aiosmtpd handler that keeps every message and counts connections"""
+
+    def __init__(self):
+        self.messages = []
+        self.connections = 0
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        self.connections += 1
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        return '250 OK'
+
+
+@unittest.skipUnless(Controller, 'aiosmtpd is not installed')
+class MailQueueTestCase(TestCase):
+    """Tests for the outbound email queue against a local SMTP server"""
+
+    def setUp(self):
+        self.handler = RecordingHandler()
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        self.controller = Controller(self.handler, hostname='127.0.0.1', port=port)
+        self.controller.start()
+        mail_state = app.extensions['mail']
+        self.mail_settings = (mail_state.server, mail_state.port, mail_state.use_ssl, mail_state.username, mail_state.suppress)
+        mail_state.server = '127.0.0.1'
+        mail_state.port = port
+        mail_state.use_ssl = False
+        mail_state.username = None
+        mail_state.suppress = False
+        mail_queue.pool.close_all()
+
+    def tearDown(self):
+        mail_queue.stop(5)
+        mail_queue.enabled = False
+        mail_state = app.extensions['mail']
+        mail_state.server, mail_state.port, mail_state.use_ssl, mail_state.username, mail_state.suppress = self.mail_settings
+        if self.controller.server:
+            self.controller.stop()
+        db.session.rollback()
+        # the delivery thread commits for real, so this class doesn't run inside DatabaseTestCase's transaction
+        load_fixtures()
+
+    def make_message(self, recipient):
+        msg = Message(subject='Queued', sender='theenbydeveloper@gmail.com', recipients=[recipient])
+        msg.html = '<p>queued</p>'
+        return msg
+
+    def test_send_pending_reuses_connection(self):
+        mail_queue.enqueue(self.make_message('one@example.com'))
+        mail_queue.enqueue(self.make_message('two@example.com'))
+
+        self.assertEqual(mail_queue.send_pending(), 2)
+        self.assertEqual(len(self.handler.messages), 2)
+        self.assertEqual(self.handler.connections, 1)
+        statuses = db.session.execute(db.select(OutboundEmail.status)).scalars().all()
+        self.assertEqual(statuses, ['sent', 'sent'])
+
+    def test_pool_reuses_connection_across_batches(self):
+        mail_queue.enqueue(self.make_message('one@example.com'))
+        mail_queue.send_pending()
+        mail_queue.enqueue(self.make_message('two@example.com'))
+        mail_queue.send_pending()
+
+        self.assertEqual(len(self.handler.messages), 2)
+        self.assertEqual(self.handler.connections, 1)
+
+    def test_pool_replaces_dead_connection(self):
+        with mail_queue.pool.connection() as conn:
+            conn.send(self.make_message('one@example.com'))
+        self.handler.connections = 0
+        idle_conn = mail_queue.pool.idle[0][0]
+        idle_conn.host.close()
+        with mail_queue.pool.connection() as conn:
+            conn.send(self.make_message('two@example.com'))
+
+        self.assertIsNot(conn, idle_conn)
+        self.assertEqual(self.handler.connections, 1)
+        self.assertEqual(len(self.handler.messages), 2)
+
+    def test_send_pending_retries_with_backoff(self):
+        mail_queue.enqueue(self.make_message('one@example.com'))
+        self.controller.stop()
+
+        self.assertEqual(mail_queue.send_pending(), 1)
+        email = db.session.execute(db.select(OutboundEmail)).scalar()
+        self.assertEqual(email.status, 'pending')
+        self.assertEqual(email.attempts, 1)
+        self.assertGreater(email.next_attempt_at, datetime.utcnow())
+        self.assertIsNotNone(email.last_error)
+        self.assertEqual(mail_queue.send_pending(), 0)
+
+    def test_gives_up_after_max_attempts(self):
+        email = mail_queue.enqueue(self.make_message('one@example.com'))
+        email.attempts = mail_queue.max_attempts - 1
+        db.session.commit()
+        self.controller.stop()
+
+        mail_queue.send_pending()
+        email = db.session.execute(db.select(OutboundEmail)).scalar()
+        self.assertEqual(email.status, 'failed')
+
+    def test_fresh_app_delivers_pending_mail(self):
+        # queued before a restart: nothing is running to deliver it
+        mail_queue.enqueue(self.make_message('one@example.com'))
+        mail_state = app.extensions['mail']
+        other = Flask(__name__)
+        other.config.update(SQLALCHEMY_DATABASE_URI=app.config['SQLALCHEMY_DATABASE_URI'], MAIL_SERVER=mail_state.server,
+                            MAIL_PORT=mail_state.port, MAIL_USE_SSL=False, MAIL_USERNAME=None, MAIL_SUPPRESS_SEND=False)
+        db.init_app(other)
+        queue = MailQueue(other, Mail(other))
+        other.route('/')(lambda: '')
+
+        try:
+            other.test_client().get('/')
+            for i in range(50):
+                if self.handler.messages:
+                    break
+                time.sleep(0.1)
+        finally:
+            queue.stop(5)
+        self.assertEqual(len(self.handler.messages), 1)
+
+    def test_mail_worker_command(self):
+        mail_queue.enqueue(self.make_message('one@example.com'))
+        mail_queue.enqueue(self.make_message('two@example.com'))
+
+        result = app.test_cli_runner().invoke(args=['mail-worker', '--once'])
+
+        self.assertIn('Attempted 2 emails', result.output)
+        self.assertEqual(len(self.handler.messages), 2)
+        self.assertEqual(OutboundEmail.query.filter_by(status='sent').count(), 2)
+
+    def test_route_queues_email(self):
+        mail_queue.enabled = True
+        with app.test_client() as client:
+            resp = client.post('/getusername', data={'email': 'camdent@gmail.com'})
+
+            self.assertEqual(resp.status_code, 302)
+        for i in range(50):
+            db.session.rollback()
+            if db.session.execute(db.select(OutboundEmail.status)).scalar() == 'sent':
+                break
+            time.sleep(0.1)
+        self.assertEqual(db.session.execute(db.select(OutboundEmail.status)).scalar(), 'sent')
+        self.assertEqual(len(self.handler.messages), 1)
+
+
+class MetricsTestCase(TestCase):
+    """Tests for the per-request instrumentation"""
+
+    def setUp(self):
+        user_cache.clear()
+        metrics.reset()
+
+    def tearDown(self):
+        db.session.rollback()
+        # outside DatabaseTestCase's transaction, whose SAVEPOINTs would be counted as the app's SQL
+        load_fixtures()
+
+    def test_counts_sql_and_templates(self):
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session['username'] = 'JaneDoe'
+            client.get('/user/JaneDoe')
+            resp = client.get('/metrics')
+            text = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('feedback_requests_total{endpoint="main.display_user",method="GET",status="200"} 1', text)
+            self.assertIn('feedback_sql_statements_total{endpoint="main.display_user"} 2', text)
+            self.assertIn('feedback_template_seconds_total{endpoint="main.display_user"}', text)
+
+    def test_counts_bcrypt(self):
+        with app.test_client() as client:
+            client.post('/login', data={"username": "JaneDoe", "password": "secretsecret!"})
+            text = client.get('/metrics').get_data(as_text=True)
+
+            self.assertIn('feedback_bcrypt_seconds_total{endpoint="main.login_user"}', text)
+            self.assertNotIn('feedback_bcrypt_seconds_total{endpoint="main.login_user"} 0\n', text)
+
+    def test_pool_gauge(self):
+        text = app.test_client().get('/metrics').get_data(as_text=True)
+
+        self.assertIn('# TYPE feedback_db_pool_checked_out gauge', text)
+        self.assertIn('# TYPE feedback_db_pool_wait_seconds_total counter', text)
+
+    def test_refuses_other_clients(self):
+        resp = app.test_client().get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.5'})
+
+        self.assertEqual(resp.status_code, 403)
+        self.assertNotIn('feedback_requests_total', resp.get_data(as_text=True))
+
+    def test_token(self):
+        client = app.test_client()
+        remote = {'REMOTE_ADDR': '203.0.113.5'}
+        metrics.token = 'scraper'
+        try:
+            wrong = client.get('/metrics', environ_base=remote, headers={'Authorization': 'Bearer guess'})
+            right = client.get('/metrics', environ_base=remote, headers={'Authorization': 'Bearer scraper'})
+        finally:
+            metrics.token = None
+
+        self.assertEqual(wrong.status_code, 403)
+        self.assertEqual(right.status_code, 200)
+
+    def test_disabled(self):
+        other = Flask(__name__)
+        Metrics(other)
+
+        self.assertNotIn('metrics', other.view_functions)
+        self.assertFalse(other.before_request_funcs)
+
+
+class RateLimiterTestCase(TestCase):
+    """Tests for the sliding window login limiter"""
+
+    def check_counter(self, counter):
+        self.assertEqual(counter.hit('k', 60, 120.0), 1)
+        self.assertEqual(counter.hit('k', 60, 130.0), 2)
+        # halfway through the next window half of the old count still applies
+        self.assertEqual(counter.hit('k', 60, 210.0), 2)
+        self.assertEqual(counter.hit('k', 60, 400.0), 1)
+
+    def test_memory_counter(self):
+        self.check_counter(MemoryCounter())
+
+    @unittest.skipUnless(fakeredis, 'fakeredis is not installed')
+    def test_redis_counter(self):
+        self.check_counter(RedisCounter(fakeredis.FakeRedis()))
+
+    def test_ip_limit(self):
+        limiter = LoginRateLimiter()
+        limiter.ip_limit = 1
+        limiter.check('a', '10.0.0.1')
+
+        with self.assertRaises(TooManyRequests):
+            limiter.check('b', '10.0.0.1')
+        limiter.check('c', '10.0.0.2')
+
+
+class FeedbackApiTestCase(DatabaseTestCase):
+    """Tests for the /api/v1 feedback routes"""
+
+    def setUp(self):
+        """Start from the fixtures: JaneDoe, JohnDoe (an admin) and one feedback item each"""
+
+        super().setUp()
+        ids = dict(db.session.execute(db.select(Feedback.username, Feedback.id)).all())
+        self.jane_id = ids['JaneDoe']
+        self.john_id = ids['JohnDoe']
+
+    def client_as(self, username, admin=False):
+        client = app.test_client()
+        with client.session_transaction() as change_session:
+            change_session['username'] = username
+            if admin:
+                change_session['admin'] = True
+        return client
+
+    def test_list_loggedout(self):
+        resp = app.test_client().get('/api/v1/users/JaneDoe/feedback')
+
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.get_json()['error'], 'Unauthorized')
+
+    def test_list_etag(self):
+        client = self.client_as('JaneDoe')
+        resp = client.get('/api/v1/users/JaneDoe/feedback')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([item['title'] for item in resp.get_json()['items']], ['testing 1'])
+        etag = resp.headers['ETag']
+        resp = client.get('/api/v1/users/JaneDoe/feedback', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        client.patch(f'/api/v1/feedback/{self.jane_id}', json={'title': 'changed'})
+        resp = client.get('/api/v1/users/JaneDoe/feedback', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_create_batch_one_insert(self):
+        client = self.client_as('JaneDoe')
+        with count_queries() as statements:
+            resp = client.post('/api/v1/users/JaneDoe/feedback', json={'items': [{'title': f'batch {i}', 'content': 'x'} for i in range(5)]})
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual([item['title'] for item in resp.get_json()['items']], [f'batch {i}' for i in range(5)])
+        # SQLite can't match RETURNING rows to the parameters of a multi-row INSERT, so SQLAlchemy inserts it a row at a time
+        inserts = 1 if db.engine.dialect.name == 'postgresql' else 5
+        self.assertEqual(len([s for s in statements if s.startswith('INSERT')]), inserts)
+        self.assertEqual(Feedback.count_for_user('JaneDoe'), 6)
+
+    def test_create_invalid_item_rolls_back_batch(self):
+        client = self.client_as('JaneDoe')
+        resp = client.post('/api/v1/users/JaneDoe/feedback', json={'items': [{'title': 'ok', 'content': 'x'}, {'title': 'x' * 101}]})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('1', resp.get_json()['errors'])
+        self.assertEqual(Feedback.count_for_user('JaneDoe'), 1)
+
+    def test_create_wrong_user(self):
+        resp = self.client_as('JaneDoe').post('/api/v1/users/JohnDoe/feedback', json={'title': 'no', 'content': 'no'})
+
+        self.assertEqual(resp.status_code, 403)
+        self.assertEqual(Feedback.count_for_user('JohnDoe'), 1)
+
+    def test_create_requires_json(self):
+        resp = self.client_as('JaneDoe').post('/api/v1/users/JaneDoe/feedback', data={'title': 'form', 'content': 'form'})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_update_batch_admin(self):
+        resp = self.client_as('JohnDoe', admin=True).patch('/api/v1/feedback', json={'items': [
+            {'id': self.jane_id, 'title': 'admin edit'}, {'id': self.john_id, 'content': 'new content'}]})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(db.session.get(Feedback, self.jane_id).title, 'admin edit')
+        self.assertEqual(db.session.get(Feedback, self.john_id).content, 'new content')
+
+    def test_update_batch_wrong_user_changes_nothing(self):
+        resp = self.client_as('JaneDoe').patch('/api/v1/feedback', json={'items': [
+            {'id': self.jane_id, 'title': 'mine'}, {'id': self.john_id, 'title': 'not mine'}]})
+
+        # someone else's feedback looks the same as feedback that doesn't exist
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(db.session.get(Feedback, self.jane_id).title, 'testing 1')
+
+    def test_update_loggedout_before_validation(self):
+        resp = app.test_client().patch('/api/v1/feedback', json={'items': [{'title': 'x' * 101}]})
+
+        self.assertEqual(resp.status_code, 401)
+
+    def test_delete_wrong_user_not_found(self):
+        resp = self.client_as('JaneDoe').delete(f'/api/v1/feedback/{self.john_id}')
+
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(Feedback.count_for_user('JohnDoe'), 1)
+
+    def test_delete_batch_one_delete(self):
+        client = self.client_as('JohnDoe', admin=True)
+        with count_queries() as statements:
+            resp = client.delete('/api/v1/feedback', json={'ids': [self.jane_id, self.john_id]})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len([s for s in statements if s.startswith('DELETE')]), 1)
+        self.assertEqual(Feedback.query.count(), 0)
+
+    def test_delete_missing(self):
+        resp = self.client_as('JaneDoe').delete('/api/v1/feedback', json={'ids': [self.jane_id, 100000]})
+
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(Feedback.count_for_user('JaneDoe'), 1)
+
+    def test_export_ndjson(self):
+        resp = self.client_as('JaneDoe').get('/api/v1/users/JaneDoe/feedback/export')
+        lines = resp.get_data(as_text=True).splitlines()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('Content-Length', resp.headers)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['title'] for line in lines], ['testing 1'])
+
+    def test_export_csv_batches(self):
+        app.config['EXPORT_BATCH_SIZE'] = 2
+        try:
+            self.client_as('JaneDoe').post('/api/v1/users/JaneDoe/feedback', json={'items': [{'title': f'batch {i}', 'content': 'a, "quoted"\nline'} for i in range(4)]})
+            resp = self.client_as('JaneDoe').get('/api/v1/users/JaneDoe/feedback/export?format=csv')
+        finally:
+            app.config['EXPORT_BATCH_SIZE'] = 1000
+        rows = list(csv.reader(io.StringIO(resp.get_data(as_text=True))))
+
+        self.assertEqual(rows[0], ['id', 'username', 'title', 'content'])
+        self.assertEqual([row[2] for row in rows[1:]], ['testing 1'] + [f'batch {i}' for i in range(4)])
+        self.assertEqual(rows[2][3], 'a, "quoted"\nline')
+
+    def test_export_wrong_user(self):
+        resp = self.client_as('JaneDoe').get('/api/v1/users/JohnDoe/feedback/export')
+
+        self.assertEqual(resp.status_code, 403)
+
+    def test_export_all_admin_only(self):
+        self.assertEqual(self.client_as('JaneDoe').get('/api/v1/feedback/export').status_code, 403)
+        resp = self.client_as('JohnDoe', admin=True).get('/api/v1/feedback/export')
+
+        self.assertEqual(len(resp.get_data(as_text=True).splitlines()), 2)
+
+
+    def test_search_admin_only(self):
+        resp = self.client_as('JaneDoe').get('/api/v1/feedback/search?q=testing')
+
+        self.assertEqual(resp.status_code, 403)
+
+    def test_search_ranks_title_matches_first(self):
+        client = self.client_as('JohnDoe', admin=True)
+        client.post('/api/v1/users/JaneDoe/feedback', json={'items': [
+            {'title': 'about the parking lot', 'content': 'it is full'},
+            {'title': 'lunch', 'content': 'the parking lot needs lights'},
+            {'title': 'unrelated', 'content': 'nothing here'}]})
+        resp = client.get('/api/v1/feedback/search?q=Parking lot')
+        items = resp.get_json()['items']
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([item['title'] for item in items], ['about the parking lot', 'lunch'])
+        self.assertGreater(items[0]['rank'], items[1]['rank'])
+
+    def test_search_pages_and_sees_new_feedback(self):
+        client = self.client_as('JohnDoe', admin=True)
+        self.assertEqual(client.get('/api/v1/feedback/search?q=widget').get_json()['items'], [])
+        client.post('/api/v1/users/JaneDoe/feedback', json={'items': [{'title': f'widget {i}', 'content': 'x'} for i in range(25)]})
+        first = client.get('/api/v1/feedback/search?q=widget').get_json()
+        second = client.get('/api/v1/feedback/search?q=widget&page=2').get_json()
+
+        self.assertEqual((len(first['items']), first['next']), (20, 2))
+        self.assertEqual((len(second['items']), second['next']), (5, None))
+
+
+class UserImportTestCase(DatabaseTestCase):
+    """Tests for the bulk user import"""
+
+    def setUp(self):
+        """Start with one existing user"""
+
+        super().setUp()
+        Feedback.query.delete()
+        User.query.filter(User.username != 'JaneDoe').delete()
+        db.session.commit()
+
+    def test_import_csv(self):
+        users = io.StringIO('username,password,email,first_name,last_name\n'
+                            'alice,passwordpassword!,alice@example.com,Alice,Smith\n'
+                            'bob,short,bob@example.com,Bob,Smith\n'
+                            'carol,passwordpassword!,carol@example.com,Carol,\n')
+        importer = UserImport(workers=2)
+
+        self.assertEqual(importer.run(users, 'csv'), 1)
+        self.assertEqual(sorted({number for number, message in importer.errors}), [3, 4])
+        self.assertIn((4, 'Last name is required.'), importer.errors)
+        alice = db.session.get(User, 'alice')
+        self.assertTrue(User.authenticate('alice', 'passwordpassword!'))
+        self.assertFalse(alice.is_admin)
+
+    def test_import_duplicates(self):
+        users = io.StringIO('\n'.join(json.dumps(row) for row in [
+            {'username': 'JaneDoe', 'password': 'passwordpassword!', 'email': 'new@example.com', 'first_name': 'J', 'last_name': 'D'},
+            {'username': 'alice', 'password': 'passwordpassword!', 'email': 'janedoe@gmail.com', 'first_name': 'A', 'last_name': 'S'},
+            {'username': 'bob', 'password': 'passwordpassword!', 'email': 'bob@example.com', 'first_name': 'B', 'last_name': 'S'},
+            {'username': 'bob', 'password': 'passwordpassword!', 'email': 'bob2@example.com', 'first_name': 'B', 'last_name': 'S'},
+        ]) + '\nnot json\n')
+        importer = UserImport(batch_size=2, workers=2)
+
+        self.assertEqual(importer.run(users, 'jsonl'), 1)
+        self.assertEqual(importer.errors, [(1, 'Username JaneDoe is taken'), (2, 'Email janedoe@gmail.com is already registered'),
+                                           (4, 'Username bob is taken'), (5, 'Not a JSON object.')])
+        self.assertEqual(User.query.count(), 2)
+
+    def import_racing(self, copy_users):
+        """import alice and bob as if JaneDoe had taken alice's email after the duplicate check ran"""
+        users = io.StringIO('username,password,email,first_name,last_name\n'
+                            'alice,passwordpassword!,janedoe@gmail.com,Alice,Smith\n'
+                            'bob,passwordpassword!,bob@example.com,Bob,Smith\n')
+        importer = UserImport(workers=2)
+        checked, copy = userimport.existing, userimport.copy_users
+        userimport.existing = lambda usernames, emails: (set(), set())
+        userimport.copy_users = copy_users
+        try:
+            importer.run(users, 'csv')
+        finally:
+            userimport.existing, userimport.copy_users = checked, copy
+        return importer
+
+    def test_clash_during_insert_falls_back(self):
+        importer = self.import_racing(userimport.copy_users)
+
+        self.assertEqual(importer.imported, 1)
+        self.assertEqual([number for number, message in importer.errors], [2])
+        self.assertIsNotNone(db.session.get(User, 'bob'))
+        self.assertIsNone(db.session.get(User, 'alice'))
+
+    @unittest.skipUnless(psycopg2, 'psycopg2 is not installed')
+    def test_clash_during_copy_falls_back(self):
+        def copy_users(rows):
+            raise psycopg2.errors.UniqueViolation('duplicate key value violates unique constraint "users_email_key"')
+
+        importer = self.import_racing(copy_users)
+
+        self.assertEqual(importer.imported, 1)
+        self.assertEqual([number for number, message in importer.errors], [2])
+
+    def test_insert_each_reports_clashes(self):
+        importer = UserImport()
+        importer.insert_each([(7, {'username': 'alice', 'password': 'x', 'email': 'janedoe@gmail.com', 'first_name': 'A', 'last_name': 'S'}),
+                              (8, {'username': 'bob', 'password': 'x', 'email': 'bob@example.com', 'first_name': 'B', 'last_name': 'S'})])
+
+        self.assertEqual(importer.imported, 1)
+        self.assertEqual([number for number, message in importer.errors], [7])
+
+
+class InvertedIndexTestCase(TestCase):
+    """Tests for the in-memory search index used off Postgres"""
+
+    def test_every_term_must_match(self):
+        index = InvertedIndex()
+        index.add(1, 'red apple', 'sweet')
+        index.add(2, 'green apple', 'sour')
+
+        self.assertEqual([i for score, i in index.search('APPLE red')], [1])
+        self.assertEqual(index.search('banana apple'), [])
+        self.assertEqual(index.search('!!'), [])
+
+    def test_rare_terms_and_titles_score_higher(self):
+        index = InvertedIndex()
+        index.add(1, 'apple', 'pie')
+        index.add(2, 'pie', 'apple')
+        index.add(3, 'apple crumble', 'dessert')
+
+        self.assertEqual([i for score, i in index.search('apple')], [1, 3, 2])
+
+
+class DatabasePoolTestCase(TestCase):
+    """Tests for the connection pool settings and timeouts"""
+
+    def test_engine_options(self):
+        options = db_pool.engine_options({'SQLALCHEMY_DATABASE_URI': 'postgresql:///feedback', 'DB_POOL_SIZE': 3, 'DB_MAX_OVERFLOW': 0})
+
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertEqual((options['pool_size'], options['max_overflow']), (3, 0))
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertNotIn('connect_args', options)
+        self.assertEqual(db_pool.engine_options({'SQLALCHEMY_DATABASE_URI': 'sqlite:///feedback.db'}), {})
+
+    def test_pgbouncer_disables_prepared_statements(self):
+        options = db_pool.engine_options({'SQLALCHEMY_DATABASE_URI': 'postgresql+asyncpg:///feedback', 'DB_PGBOUNCER': True})
+        self.assertEqual(options['connect_args']['statement_cache_size'], 0)
+        options = db_pool.engine_options({'SQLALCHEMY_DATABASE_URI': 'postgresql+psycopg:///feedback', 'DB_PGBOUNCER': True})
+        self.assertIsNone(options['connect_args']['prepare_threshold'])
+
+    def test_checkout_wait_recorded(self):
+        pool = TimedQueuePool(lambda: sqlite3.connect(':memory:'), pool_size=1, max_overflow=0, timeout=5)
+        db_pool.reset_stats()
+        first = pool.connect()
+        threading.Timer(0.1, first.close).start()
+        second = pool.connect()
+        second.close()
+
+        waits = db_pool.stats()['waits']
+        self.assertEqual(waits['count'], 2)
+        self.assertGreaterEqual(waits['max'], 0.05)
+
+    def test_pool_timeout_is_503(self):
+        other = Flask(__name__)
+        other.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        DatabasePool(other)
+
+        @other.route('/')
+        def busy():
+            raise PoolTimeout()
+
+        resp = other.test_client().get('/')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+
+    def test_exports_have_no_statement_timeout(self):
+        self.assertEqual(app.view_functions['api.export_user_feedback'].statement_timeout, 0)
+        self.assertFalse(hasattr(app.view_functions['main.display_user'], 'statement_timeout'))
+
+
+class ReadReplicaTestCase(TestCase):
+    """Tests for sending read-only requests to a replica. The replica database holds different feedback from the
+    primary, so each response shows which one it was read from"""
+
+    def setUp(self):
+        read_replicas.enabled = True
+        with replica_engine.begin() as conn:
+            conn.execute(Feedback.__table__.delete())
+            conn.execute(User.__table__.delete())
+            conn.execute(insert(User.__table__), FIXTURE_USERS)
+            conn.execute(insert(Feedback.__table__), {'title': 'from the replica', 'content': 'replicated', 'username': 'JaneDoe'})
+        user_cache.clear()
+
+    def tearDown(self):
+        read_replicas.enabled = False
+        db.session.remove()
+        load_fixtures()
+
+    def login(self, client):
+        with client.session_transaction() as change_session:
+            change_session['username'] = 'JaneDoe'
+
+    def test_read_only_route_reads_replica(self):
+        with app.test_client() as client:
+            self.login(client)
+            html = client.get('/user/JaneDoe').get_data(as_text=True)
+            self.assertIn('from the replica', html)
+            self.assertNotIn('testing 1', html)
+
+    def test_writes_go_to_primary(self):
+        with app.test_client() as client:
+            self.login(client)
+            resp = client.post('/user/JaneDoe/feedback/add', data={'title': 'new feedback', 'content': 'written'})
+            self.assertEqual(resp.status_code, 302)
+        self.assertIsNotNone(Feedback.query.filter_by(title='new feedback').first())
+        with replica_engine.connect() as conn:
+            self.assertEqual(conn.execute(text("SELECT count(*) FROM feedback WHERE title = 'new feedback'")).scalar(), 0)
+
+    def test_reads_own_writes(self):
+        with app.test_client() as client:
+            self.login(client)
+            client.post('/user/JaneDoe/feedback/add', data={'title': 'new feedback', 'content': 'written'})
+            html = client.get('/user/JaneDoe').get_data(as_text=True)
+            self.assertIn('new feedback', html)
+            self.assertIn('testing 1', html)
+
+            # once the window has passed, back to the replica
+            with client.session_transaction() as change_session:
+                change_session['db_wrote_at'] -= read_replicas.sticky_seconds
+            html = client.get('/user/JaneDoe').get_data(as_text=True)
+            self.assertIn('from the replica', html)
+
+    def test_writes_not_remembered_when_off(self):
+        read_replicas.enabled = False
+        with app.test_client() as client:
+            client.post('/passwordreset', data={'email': 'janedoe@gmail.com'})
+            self.assertNotIn('db_wrote_at', session)
+            self.login(client)
+            client.post('/user/JaneDoe/feedback/add', data={'title': 'new feedback', 'content': 'written'})
+            self.assertNotIn('db_wrote_at', session)
+
+    def test_other_clients_still_read_replica(self):
+        with app.test_client() as client:
+            self.login(client)
+            client.post('/user/JaneDoe/feedback/add', data={'title': 'new feedback', 'content': 'written'})
+        with app.test_client() as client:
+            self.login(client)
+            self.assertIn('from the replica', client.get('/user/JaneDoe').get_data(as_text=True))
+
+    def test_unmarked_routes_read_primary(self):
+        self.assertFalse(hasattr(app.view_functions['main.login_user'], 'replica_reads'))
+        with app.test_client() as client:
+            # 'testing 1' is only on the primary
+            self.login(client)
+            feedback = Feedback.query.filter_by(title='testing 1').one()
+            resp = client.post(f'/feedback/{feedback.id}/delete')
+            self.assertEqual(resp.status_code, 302)
+        self.assertIsNone(db.session.get(Feedback, feedback.id))
+
+    def test_dml_in_read_only_request_goes_to_primary(self):
+        with app.test_request_context('/user/JaneDoe'):
+            self.assertIs(db.session.get_bind(), replica_engine)
+            self.assertIs(db.session.get_bind(clause=update(Feedback)), db.engine)
+            db.session.remove()
+
+    def test_api_reads_replica(self):
+        with app.test_client() as client:
+            self.login(client)
+            resp = client.get('/api/v1/users/JaneDoe/feedback')
+            self.assertEqual([item['title'] for item in resp.json['items']], ['from the replica'])
+
+
+def async_ready():
+    """flask[async], aiosmtplib and the async driver for the test database are all installed"""
+    driver = async_url(app.config['SQLALCHEMY_DATABASE_URI']).get_driver_name()
+    return all(importlib.util.find_spec(name) for name in ('asgiref', 'aiosmtplib', driver))
+
+@unittest.skipUnless(Controller, 'aiosmtpd is not installed')
+@unittest.skipUnless(async_ready(), 'flask[async], aiosmtplib or the async database driver is not installed')
+class AsyncModeTestCase(TestCase):
+    """Tests for the async views and the async sessions, hashing and mail they use. Async sessions have connections
+    of their own, so like MailQueueTestCase this commits for real and reloads the fixtures afterwards"""
+
+    def setUp(self):
+        self.sync_views = {endpoint: app.view_functions[endpoint] for endpoint in ASYNC_VIEWS}
+        # what create_app does with ASYNC_MODE on
+        async_db.init_app(app)
+        async_views.init_app(app, mail_queue)
+        db.session.remove()
+        user_cache.clear()
+        self.handler = RecordingHandler()
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        self.controller = Controller(self.handler, hostname='127.0.0.1', port=port)
+        self.controller.start()
+        mail_state = app.extensions['mail']
+        self.mail_settings = (mail_state.server, mail_state.port, mail_state.use_ssl, mail_state.username, mail_state.suppress)
+        mail_state.server = '127.0.0.1'
+        mail_state.port = port
+        mail_state.use_ssl = False
+        mail_state.username = None
+        mail_state.suppress = False
+
+    def tearDown(self):
+        app.view_functions.update(self.sync_views)
+        async_db.dispose()
+        mail_queue.stop(5)
+        mail_queue.enabled = False
+        mail_state = app.extensions['mail']
+        mail_state.server, mail_state.port, mail_state.use_ssl, mail_state.username, mail_state.suppress = self.mail_settings
+        if self.controller.server:
+            self.controller.stop()
+        db.session.remove()
+        load_fixtures()
+
+    def test_login(self):
+        with app.test_client() as client:
+            resp = client.post('/login', data={"username": "JaneDoe", "password": "secretsecret!"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, '/user/JaneDoe')
+            self.assertEqual(session['username'], 'JaneDoe')
+
+    def test_login_failures(self):
+        with app.test_client() as client:
+            html = client.post('/login', data={"username": "JaneDoe", "password": "wrongwrongwrong!"}).get_data(as_text=True)
+            self.assertIn('Invalid password', html)
+            html = client.post('/login', data={"username": "Nobody", "password": "secretsecret!"}).get_data(as_text=True)
+            self.assertIn('Invalid username', html)
+            self.assertNotIn('username', session)
+
+    def test_login_rehashes(self):
+        hasher.log_rounds = 5
+        try:
+            with app.test_client() as client:
+                client.post('/login', data={"username": "JaneDoe", "password": "secretsecret!"})
+        finally:
+            hasher.log_rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.assertTrue(db.session.get(User, 'JaneDoe').password.startswith('$2b$05$'))
+
+    def test_password_reset_sends_email(self):
+        with app.test_client() as client:
+            resp = client.post('/passwordreset', data={'email': 'janedoe@gmail.com'})
+            self.assertEqual(resp.status_code, 302)
+        self.assertEqual(len(self.handler.messages), 1)
+        self.assertIsNotNone(db.session.get(User, 'JaneDoe').password_reset_token)
+
+    def test_send_async_queues(self):
+        mail_queue.enabled = True
+        msg = Message(subject='Queued', sender='theenbydeveloper@gmail.com', recipients=['one@example.com'])
+        msg.html = '<p>queued</p>'
+        email = asyncio.run(mail_queue.send_async(msg))
+
+        self.assertEqual(email.recipients, 'one@example.com')
+        deadline = time.monotonic() + 5
+        while not self.handler.messages and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(self.handler.messages), 1)
+
+    def test_api_reads(self):
+        with app.test_client() as client:
+            with client.session_transaction() as change_session:
+                change_session['username'] = 'JaneDoe'
+            resp = client.get('/api/v1/users/JaneDoe/feedback')
+            self.assertEqual([item['title'] for item in resp.json['items']], ['testing 1'])
+            resp = client.get('/api/v1/users/JaneDoe/feedback', headers={'If-None-Match': resp.headers['ETag']})
+            self.assertEqual(resp.status_code, 304)
+            feedback_id = Feedback.query.filter_by(title='testing 1').one().id
+            self.assertEqual(client.get(f'/api/v1/feedback/{feedback_id}').json['title'], 'testing 1')
+            resp = client.get('/api/v1/users/Nobody/feedback')
+            self.assertEqual((resp.status_code, resp.json['error']), (404, 'Not Found'))
+
+    def test_hasher_async(self):
+        async def check_all():
+            pw_hash = await hasher.generate_password_hash_async('secretsecret!')
+            return await asyncio.gather(*(hasher.check_password_hash_async(pw_hash, pwd) for pwd in ('secretsecret!', 'wrong')))
+
+        hasher.reset_stats()
+        self.assertEqual(asyncio.run(check_all()), [True, False])
+        stats = hasher.stats()
+        self.assertEqual((stats['hash']['count'], stats['check']['count']), (1, 2))
@@ -0,0 +1,87 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+from werkzeug.exceptions import NotFound
+from models import db, User
+
+# password hashes and reset tokens are never cached
+CACHED_COLUMNS = ('username', 'email', 'first_name', 'last_name', 'is_admin')
+
+
+class UserCache:
+    """Read-through cache of user rows with a TTL and LRU eviction
+
+    Entries are plain column snapshots, and lookups return a detached User
+    built from them, so a cached user can be rendered and compared but is
+    never tied to a database session. The cache is per process: writes in
+    this process invalidate it right away, other workers see changes once
+    the TTL runs out."""
+
+    def __init__(self, app=None):
+        self.enabled = True
+        self.ttl = 60
+        self.max_entries = 1024
+        self.entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """read cache settings from the app config"""
+        self.enabled = app.config.get('USER_CACHE_ENABLED', True)
+        self.ttl = app.config.get('USER_CACHE_TTL', 60)
+        self.max_entries = app.config.get('USER_CACHE_SIZE', 1024)
+        self.clear()
+
+    def get(self, username):
+        """return the user with this username, or None if there isn't one"""
+        if self.enabled:
+            with self._lock:
+                entry = self.entries.get(username)
+                if entry is not None and entry[0] > time.time():
+                    self.entries.move_to_end(username)
+                    self.hits += 1
+                    return User(**entry[1])
+                self.misses += 1
+        user = db.session.get(User, username)
+        if user is not None and self.enabled:
+            self.put(user)
+        return user
+
+    def get_or_404(self, username):
+        """return the user with this username or raise NotFound"""
+        user = self.get(username)
+        if user is None:
+            raise NotFound()
+        return user
+
+    def put(self, user):
+        """store a snapshot of a user's columns"""
+        snapshot = {column: getattr(user, column) for column in CACHED_COLUMNS}
+        with self._lock:
+            self.entries[user.username] = (time.time() + self.ttl, snapshot)
+            self.entries.move_to_end(user.username)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, username):
+        """drop a user from the cache after it changes"""
+        with self._lock:
+            self.entries.pop(username, None)
+
+    def clear(self):
+        """drop every entry and reset the counters"""
+        with self._lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """return hit/miss counters and the current size"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+user_cache = UserCache()
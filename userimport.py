@@ -0,0 +1,150 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
+import csv
+import io
+import json
+import os
+from werkzeug.datastructures import MultiDict
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from forms import RegisterForm
+from models import db, bcrypt, hasher, User
+try:
+    # COPY runs on the raw psycopg2 cursor, so its errors reach us unwrapped by SQLAlchemy
+    from psycopg2 import IntegrityError as CopyIntegrityError
+except ImportError:
+    CopyIntegrityError = IntegrityError
+
+FIELDS = ('username', 'password', 'email', 'first_name', 'last_name')
+
+
+def read_rows(file, fmt):
+    """yield (line number, row dict) from a CSV file with a header row or a JSONL file"""
+    if fmt == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield number, row if isinstance(row, dict) else {'_error': 'Not a JSON object.'}
+
+
+def validate_row(row):
+    """check a row with RegisterForm's rules; returns a list of error messages"""
+    if '_error' in row:
+        return [row['_error']]
+    values = {key: row.get(key) for key in FIELDS}
+    values['password2'] = row.get('password2', values['password'])
+    if not all(value is None or isinstance(value, str) for value in values.values()):
+        return ['Every field must be a string.']
+    form = RegisterForm(formdata=MultiDict({key: value for key, value in values.items() if value is not None}), meta={'csrf': False})
+    errors = [message for messages in form.errors.values() for message in messages] if not form.validate() else []
+    if not errors and values['password'] != values['password2']:
+        errors.append('Passwords do not match')
+    return errors
+
+
+def existing(usernames, emails):
+    """return the usernames and emails already in the users table, in one query"""
+    rows = db.session.execute(db.select(User.username, User.email)
+                              .where(User.username.in_(usernames) | User.email.in_(emails))).all()
+    return {row.username for row in rows}, {row.email for row in rows}
+
+
+def copy_users(rows):
+    """insert rows with COPY on Postgres, or one multi-row INSERT elsewhere"""
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql' and connection.dialect.driver == 'psycopg2':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([row[key] for key in FIELDS] + ['f'])
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(f'COPY users ({", ".join(FIELDS)}, is_admin) FROM STDIN WITH (FORMAT csv)', buffer)
+    else:
+        db.session.execute(insert(User), [{**row, 'is_admin': False} for row in rows])
+
+
+class UserImport:
+    """Creates accounts in bulk from CSV or JSONL
+
+    Rows are handled in batches: each is validated with RegisterForm's rules,
+    checked for usernames and emails that are taken (in the file or the
+    database) with one query, hashed across a process pool and inserted
+    with COPY or a multi-row INSERT. Bad rows are reported by line number and
+    skipped; the rest of the batch still goes in."""
+
+    def __init__(self, batch_size=1000, workers=None):
+        self.batch_size = batch_size
+        self.workers = workers or os.cpu_count()
+        self.imported = 0
+        self.errors = []
+        self.seen_usernames = set()
+        self.seen_emails = set()
+
+    def run(self, file, fmt):
+        """import every row of file; returns the number of users created"""
+        rows = read_rows(file, fmt)
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                batch = list(islice(rows, self.batch_size))
+                if not batch:
+                    break
+                self.import_batch(batch, executor)
+        return self.imported
+
+    def reject(self, number, message):
+        self.errors.append((number, message))
+
+    def import_batch(self, batch, executor):
+        valid = []
+        for number, row in batch:
+            messages = validate_row(row)
+            if messages:
+                for message in messages:
+                    self.reject(number, message)
+            else:
+                valid.append((number, {key: row[key] for key in FIELDS}))
+        taken_usernames, taken_emails = existing([row['username'] for n, row in valid], [row['email'] for n, row in valid])
+        accepted = []
+        for number, row in valid:
+            if row['username'] in taken_usernames or row['username'] in self.seen_usernames:
+                self.reject(number, f"Username {row['username']} is taken")
+            elif row['email'] in taken_emails or row['email'] in self.seen_emails:
+                self.reject(number, f"Email {row['email']} is already registered")
+            else:
+                self.seen_usernames.add(row['username'])
+                self.seen_emails.add(row['email'])
+                accepted.append((number, row))
+        if not accepted:
+            return
+        chunksize = max(1, len(accepted) // (self.workers * 4))
+        hashes = executor.map(bcrypt.generate_password_hash, [row['password'] for n, row in accepted],
+                              repeat(hasher.log_rounds), chunksize=chunksize)
+        for (number, row), pw_hash in zip(accepted, hashes):
+            row['password'] = pw_hash.decode('utf8')
+        try:
+            copy_users([row for n, row in accepted])
+            db.session.commit()
+            self.imported += len(accepted)
+        except (IntegrityError, CopyIntegrityError):
+            # someone registered one of these since the check; insert one at a time to find which
+            db.session.rollback()
+            self.insert_each(accepted)
+
+    def insert_each(self, accepted):
+        for number, row in accepted:
+            try:
+                db.session.execute(insert(User), [{**row, 'is_admin': False}])
+                db.session.commit()
+                self.imported += 1
+            except IntegrityError:
+                db.session.rollback()
+                self.reject(number, f"Username {row['username']} or email {row['email']} is already registered")